@@ -18,17 +18,27 @@
 # Contact: Gene Shuman <gene@valimail.com>
 #
 
-import importlib.resources
 import re
 import sys
-import copy
-from email.utils import getaddresses
-from authheaders.dmarc_lookup import dns_query, receiver_record, receiver_record_walk, get_org_domain
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from authheaders.dmarc_lookup import dns_query, domain_exists, get_existence_cache, receiver_record, receiver_record_walk, receiver_record_walk_iter, get_org_domain
+from authheaders.psddmarc import get_psd_registry
+from authheaders.dnscache import DNSCache, call_dnsfunc, negative_ttl, query_ttl
+from authheaders.policycache import PolicyCache
+from authheaders.keycache import KeyCache
+from authheaders.arccache import ARCCache
+from authheaders.budget import Budget, BudgetExceeded
+from authheaders.metrics import Metrics, MetricsRecorder, instrument_dnsfunc, stage
+from authheaders.message import ParsedMessage, StreamedMessage, parse_message, get_from_addresses
+from authheaders.signer import Signer, get_signer
 from authres import SPFAuthenticationResult, DKIMAuthenticationResult, AuthenticationResultsHeader
 from authres.arc import ARCAuthenticationResult
 from authres.dmarc import DMARCAuthenticationResult
-from dkim import ARC, DKIM, arc_verify, dkim_verify, DKIMException, rfc822_parse
+from dkim import ARC, CV_Fail, DKIM, arc_verify, dkim_verify, DKIMException
 from dns.exception import DNSException
+from dns.resolver import NXDOMAIN, NoAnswer
 
 # Please accept my appologies for doing this
 try:
@@ -38,11 +48,78 @@ except ImportError:
 
 __all__ = [
     "authenticate_message",
+    "authenticate_and_seal",
+    "check_dkim_signatures",
     "sign_message",
-    "chain_validation"
+    "chain_validation",
+    "DNSCache",
+    "PolicyCache",
+    "KeyCache",
+    "ARCCache",
+    "Budget",
+    "BudgetExceeded",
+    "Metrics",
+    "MetricsRecorder",
+    "ParsedMessage",
+    "StreamedMessage",
+    "Signer"
     ]
 
 
+#: The outcome of DMARC policy discovery for a From domain.  policy is the
+#: effective policy (after sp/np), None if the record has no p tag.  ttl is
+#: the least TTL of the DNS answers it was discovered from: the time left for
+#: answers from a DNSCache, the SOA negative TTL for NXDOMAIN and NoAnswer,
+#: and a default for answers that do not carry a TTL.
+DMARCPolicy = namedtuple('DMARCPolicy', ['record', 'orgdomain', 'psddomain', 'result_comment', 'policy', 'adkim', 'aspf', 'ttl'], defaults=(None,))
+
+
+class _TTLRecorder(object):
+    # Passes lookups through to dnsfunc (or resolves them with dnspython),
+    # noting the least TTL of the answers
+
+    #: TTL assumed for answers that don't carry one
+    default_ttl = 300
+
+    def __init__(self, dnsfunc=None):
+        self.dnsfunc = dnsfunc
+        self.ttl = None
+        self.lock = threading.Lock()
+        # A DNSCache the answers come from, through any wrappers
+        self.cache = dnsfunc
+        while self.cache is not None and not isinstance(self.cache, DNSCache):
+            self.cache = getattr(self.cache, 'dnsfunc', None)
+
+    def __call__(self, name, qtype='TXT', **kwargs):
+        if self.dnsfunc is None:
+            answer, ttl = query_ttl(name, qtype, kwargs.get('timeout'), default_negative_ttl=self.default_ttl)
+            self.add_ttl(ttl)
+            return answer
+        try:
+            answer = call_dnsfunc(self.dnsfunc, name, qtype, **kwargs)
+        except NXDOMAIN as e:
+            responses = list(e.kwargs.get('responses', {}).values())
+            self.add_ttl(negative_ttl(responses[0] if responses else None, self.default_ttl))
+            raise
+        except NoAnswer as e:
+            self.add_ttl(negative_ttl(e.kwargs.get('response'), self.default_ttl))
+            raise
+        ttl = None
+        if self.cache is not None:
+            ttl = self.cache.remaining_ttl(name, qtype)
+        if ttl is None:
+            rrset = getattr(answer, 'rrset', None)
+            ttl = rrset.ttl if rrset is not None else self.default_ttl
+        self.add_ttl(ttl)
+        return answer
+
+    def add_ttl(self, ttl):
+        if ttl is not None:
+            with self.lock:
+                if self.ttl is None or ttl < self.ttl:
+                    self.ttl = ttl
+
+
 def get_domain_part(address):
     '''Return domain part of an email address'''
     if sys.version_info < (3, 0) and isinstance(address, str):
@@ -55,49 +132,46 @@ def get_domain_part(address):
 
 def check_psddmarc_list(psdname, dnsfunc=dns_query):
     """Check psddmarc.org list of PSD DMARC participants"""
-    try:
-        # If the PSD registry is locally available, use it.
-        ref = importlib.resources.files('authheaders') / 'psddmarc.csv'
-        with importlib.resources.as_file(ref) as psdfile_name:
-            with open(psdfile_name) as psd_file:
-                psds = []
-                for line in psd_file.readlines():
-                    sp = line.split(',')
-                    if sp[1] == 'current':
-                        psds.append(sp[0][1:])
-                if psdname in psds:
-                    return True
-                else:
-                    return False
-    except:
-        # If not, use the DNS query list.
-        psd_list_host = '.psddmarc.org'
-        psd_lookup = psdname + psd_list_host
-        answer = dnsfunc(psd_lookup)
-        if answer:
-            return True
-        else:
-            return False
+    return get_psd_registry().check(psdname, dnsfunc=dnsfunc)
 
 
-def dmarc_per_from(from_domain, spf_result=None, dkim_result=None, dnsfunc=None, psddmarc=False, dmarcbis=False, policy_only=False):
-    """DMARC result for a single From domain."""
-    original_from = from_domain
+def discover_policy(from_domain, dnsfunc=None, psddmarc=False, dmarcbis=False, parallel_walk=False, policy_cache=None, metrics=None):
+    """DMARC policy discovery for a single From domain.
+
+    Does all of the DNS work for dmarc_per_from, which does not depend on the
+    SPF or DKIM results, so it can be done before (or while) they are
+    computed.
+    @param policy_cache: An optional PolicyCache to serve the policy from
+    @param metrics: An optional Metrics for instrumentation
+    @return: A DMARCPolicy
+    """
+    dnsfunc = instrument_dnsfunc(dnsfunc, metrics)
+    with stage(metrics, 'dmarc.discovery'):
+        if policy_cache is None:
+            return _discover_policy(from_domain, dnsfunc, psddmarc, dmarcbis, parallel_walk)
+        key = (from_domain, bool(psddmarc), bool(dmarcbis))
+        discovered = policy_cache.lookup(key)
+        if metrics is not None:
+            metrics.incr('dmarc.policy_cache.misses' if discovered is None else 'dmarc.policy_cache.hits')
+        if discovered is None:
+            discovered = _discover_policy(from_domain, dnsfunc, psddmarc, dmarcbis, parallel_walk)
+            policy_cache.store(key, discovered)
+        return discovered
+
+
+def _discover_policy(from_domain, dnsfunc, psddmarc, dmarcbis, parallel_walk):
+    lookup = _TTLRecorder(dnsfunc)
+    result_comment = None
     psddomain = False
     if not dmarcbis: # It's all different in the future
         # Get dmarc record for domain
-        if(dnsfunc):
-            record, orgdomain = receiver_record(from_domain, dnsfunc=dnsfunc)
-        else:
-            record, orgdomain = receiver_record(from_domain)
+        record, orgdomain = receiver_record(from_domain, dnsfunc=lookup)
         # Report if DMARC record is From Domain or Org Domain
         if record and orgdomain:
             result_comment = 'Used Org Domain Record'
-            policydomain = orgdomain
         elif record:
             result_comment = 'Used From Domain Record'
             orgdomain = from_domain
-            policydomain = None
 
         # Get psddmarc record if doing PSD DMARC, no DMARC record, and PSD is
         #  listed
@@ -107,31 +181,51 @@ def dmarc_per_from(from_domain, spf_result=None, dkim_result=None, dnsfunc=None,
                 if check_psddmarc_list(org_domain.split('.',1)[-1],
                                        dnsfunc=dnsfunc):
                     record, _ = receiver_record(org_domain.split('.',1)[-1],
-                                                dnsfunc=dnsfunc)
+                                                dnsfunc=lookup)
             else:
                 if check_psddmarc_list(org_domain.split('.',1)[-1]):
-                    record, _ = receiver_record(org_domain.split('.',1)[-1])
+                    record, _ = receiver_record(org_domain.split('.',1)[-1],
+                                                dnsfunc=lookup)
             if record:
                 psddomain = org_domain.split('.',1)[-1]
                 result_comment = 'Used Public Suffix Domain Record'
     else:
         # Get dmarc record for domain (tree walk)
-        # TODO: Not very efficient.  Always does tree walk, even if not
-        # really needed.  receiver_record_walk does sequential DNS lookups
-        # vice parallel.
+        # The walk is lazy and stops as soon as a record settles the org
+        # domain: a psd=n record, or a psd=y From domain record, with no PSD
+        # registry listed domain above it.  Otherwise the whole tree is
+        # needed to find the org domain.
         orgdomain = False
         record = None
-        if(dnsfunc):
-            treeresults = receiver_record_walk(from_domain, dnsfunc=dnsfunc)
-        else:
-            treeresults = receiver_record_walk(from_domain)
+        walk = receiver_record_walk_iter(from_domain, dnsfunc=lookup, parallel=parallel_walk)
+        treeresults = OrderedDict()
+        listed = {}
+        def is_listed(dmn):
+            if dmn not in listed:
+                if dnsfunc:
+                    listed[dmn] = check_psddmarc_list(dmn, dnsfunc=dnsfunc)
+                else:
+                    listed[dmn] = check_psddmarc_list(dmn)
+            return listed[dmn]
+        settled = True
+        try:
+            for dmn, rec in walk:
+                treeresults[dmn] = rec
+                psd = rec.get('psd')
+                if psd == 'n' or (psd == 'y' and dmn == from_domain):
+                    if settled and not any(is_listed(d) for d in treeresults):
+                        break
+                    settled = False
+                elif psd == 'y':
+                    settled = False
+        finally:
+            walk.close()
         # Then find org domain, per DMARCbis 07
         # Fake psd=yes (since no one publishes this yet) - FIXME later
         for dmn, rec in reversed(list(treeresults.items())):
-            if check_psddmarc_list(dmn):
-                treeresults[dmn]['psd'] = 'y'
+            if is_listed(dmn):
+                treeresults[dmn] = dict(rec, psd='y')
                 break
-        orgresults = copy.deepcopy(treeresults)
         psddomain = False
         for dmn, rec in list(treeresults.items()):
             try:
@@ -188,6 +282,7 @@ def dmarc_per_from(from_domain, spf_result=None, dkim_result=None, dnsfunc=None,
                 result_comment = 'From domain has no DMARC record'
 
 
+    policy = adkim = aspf = None
     if record and record.get('p'): # DMARC P tag is mandatory
         # find policy
         policy = record['p']
@@ -208,15 +303,12 @@ def dmarc_per_from(from_domain, spf_result=None, dkim_result=None, dnsfunc=None,
 
         if orgdomain or psddomain:
             if np:
-                exists = False
-                for qtype in ['a', 'mx', 'aaaa']:
-                    if(dnsfunc):
-                        res = dnsfunc(from_domain)
-                    else:
-                        res = dns_query(from_domain, qtype)
-                    if res:
-                        exists = True
-                        break
+                if(dnsfunc):
+                    probe = lookup
+                else:
+                    probe = _TTLRecorder(get_existence_cache())
+                exists = domain_exists(from_domain, dnsfunc=probe)
+                lookup.add_ttl(probe.ttl)
                 if exists:
                     policy = sp
                 else:
@@ -227,6 +319,40 @@ def dmarc_per_from(from_domain, spf_result=None, dkim_result=None, dnsfunc=None,
         adkim = record.get('adkim', 'r')
         aspf  = record.get('aspf',  'r')
 
+    return DMARCPolicy(record, orgdomain, psddomain, result_comment, policy, adkim, aspf, lookup.ttl)
+
+
+def _dkim_aligned(from_domain, header_d, adkim):
+    if adkim == "s":
+        return from_domain == header_d
+    if adkim == "r":
+        return get_org_domain(from_domain) == get_org_domain(header_d)
+    return False
+
+
+def dmarc_per_from(from_domain, spf_result=None, dkim_result=None, dnsfunc=None, psddmarc=False, dmarcbis=False, policy_only=False, parallel_walk=False, discovered=None, policy_cache=None, metrics=None):
+    """DMARC result for a single From domain.
+    @param dkim_result: A DKIMAuthenticationResult, or a list of them (one
+    per signature), any of which may give DKIM alignment
+    @param discovered: A DMARCPolicy from discover_policy for from_domain, if
+    policy discovery has already been done
+    @param policy_cache: An optional PolicyCache for policy discovery
+    @param metrics: An optional Metrics for instrumentation
+    @return: (result, result_comment, from_domain, policy), with a temperror
+    result if dnsfunc is a Budget's and it runs out during discovery (which
+    is raised when policy_only)
+    """
+    original_from = from_domain
+    if discovered is None:
+        try:
+            discovered = discover_policy(from_domain, dnsfunc=dnsfunc, psddmarc=psddmarc, dmarcbis=dmarcbis, parallel_walk=parallel_walk, policy_cache=policy_cache, metrics=metrics)
+        except BudgetExceeded as e:
+            if policy_only:
+                raise
+            return ('temperror', str(e), from_domain, None)
+    record, orgdomain, psddomain, result_comment, policy, adkim, aspf = discovered[:7]
+
+    if record and record.get('p'): # DMARC P tag is mandatory
         # get result
         result = "fail"
         if not policy_only and spf_result and spf_result.result == "pass":
@@ -242,10 +368,10 @@ def dmarc_per_from(from_domain, spf_result=None, dkim_result=None, dnsfunc=None,
             elif aspf == "r" and get_org_domain(from_domain) == get_org_domain(mail_from_domain):
                 result = "pass"
 
-        if not policy_only and dkim_result and dkim_result.result == "pass":
-            if adkim == "s" and from_domain == dkim_result.header_d:
-                result = "pass"
-            elif adkim == "r" and get_org_domain(from_domain) == get_org_domain(dkim_result.header_d):
+        if not policy_only and dkim_result:
+            # Any one aligned signature is enough
+            dkim_results = dkim_result if isinstance(dkim_result, list) else [dkim_result]
+            if any(r.result == "pass" and _dkim_aligned(from_domain, r.header_d, adkim) for r in dkim_results):
                 result = "pass"
     else:
         # If no DMARC record, no result
@@ -267,21 +393,48 @@ def dmarc_per_from(from_domain, spf_result=None, dkim_result=None, dnsfunc=None,
     else:
         return(result, result_comment, from_domain, policy)
 
-def check_spf(ip, mail_from, helo):
-    res, reason = spf.check2(ip, mail_from, helo)
+def check_spf(ip, mail_from, helo, budget=None):
+    """ Check SPF with pyspf.
+    @param budget: An optional Budget.  pyspf is given the time left as its
+    query time limit, and the result is temperror if it is already spent.
+    pyspf's own queries are not charged to it
+    """
+    if budget is not None:
+        if budget.exhausted():
+            return SPFAuthenticationResult(result='temperror', reason='DNS budget exceeded', smtp_mailfrom=mail_from, smtp_helo=helo)
+        remaining = budget.remaining()
+        if remaining is not None:
+            res, reason = spf.check2(ip, mail_from, helo, timeout=remaining, querytime=remaining)
+        else:
+            res, reason = spf.check2(ip, mail_from, helo)
+    else:
+        res, reason = spf.check2(ip, mail_from, helo)
     if res is not None:
         return SPFAuthenticationResult(result=res, reason=reason, smtp_mailfrom=mail_from, smtp_helo=helo)
     else:
         return SPFAuthenticationResult(result=None, reason=None, smtp_mailfrom=mail_from, smtp_helo=helo)
 
 
-def check_dkim(msg, dnsfunc=None):
+def check_dkim(msg, dnsfunc=None, metrics=None, key_cache=None):
+    """ Verify the first DKIM signature of a message.
+    @param msg: an RFC822 formatted message (with either \\n or \\r\\n line endings) or a ParsedMessage
+    @param dnsfunc: An optional dns lookup function (intended for testing)
+    @param metrics: An optional Metrics for instrumentation
+    @param key_cache: An optional KeyCache of parsed public keys
+    """
+    if metrics is None:
+        return _check_dkim(msg, dnsfunc, key_cache=key_cache)
+    with stage(metrics, 'dkim'):
+        return _check_dkim(msg, instrument_dnsfunc(dnsfunc, metrics), key_cache=key_cache)
+
+
+def _check_dkim(msg, dnsfunc, idx=0, key_cache=None):
     try:
-        d = DKIM(msg)
+        d = parse_message(msg).dkim(key_cache=key_cache)
         if(dnsfunc):
-            res = d.verify(dnsfunc=dnsfunc) and 'pass' or 'fail'
+            res = d.verify(idx=idx, dnsfunc=dnsfunc) and 'pass' or 'fail'
         else:
-            res = d.verify() and 'pass' or 'fail'
+            res = d.verify(idx=idx) and 'pass' or 'fail'
     except DKIMException as e:
         res = 'fail'
     except DNSException as e:
@@ -297,14 +450,79 @@ def check_dkim(msg, dnsfunc=None):
         return DKIMAuthenticationResult(result=None)
 
 
-def check_arc(msg, logger=None, dnsfunc=None):
+def check_dkim_signatures(msg, dnsfunc=None, executor=None, aligned=None, metrics=None, key_cache=None):
+    """ Verify every DKIM signature of a message, concurrently.
+    @param msg: an RFC822 formatted message (with either \\n or \\r\\n line endings) or a ParsedMessage
+    @param dnsfunc: An optional dns lookup function (intended for testing)
+    @param executor: An optional concurrent.futures.Executor to verify the
+    signatures on (default a thread pool for the duration of the call)
+    @param aligned: An optional function of the list of passing
+    DKIMAuthenticationResults found so far, returning True once they are
+    all that is needed (e.g. DMARC alignment).  Signatures not verified by
+    then are skipped
+    @param metrics: An optional Metrics for instrumentation
+    @param key_cache: An optional KeyCache of parsed public keys
+    @return: A list of DKIMAuthenticationResult, one per signature verified,
+    in header order.  A message with no signature gives check_dkim's result
+    """
+    if metrics is None:
+        return _check_dkim_signatures(msg, dnsfunc, executor, aligned, key_cache)
+    with stage(metrics, 'dkim'):
+        return _check_dkim_signatures(msg, instrument_dnsfunc(dnsfunc, metrics), executor, aligned, key_cache)
+
+
+def _check_dkim_signatures(msg, dnsfunc, executor, aligned, key_cache):
+    msg = parse_message(msg)
+    try:
+        count = sum(1 for x in msg.headers if x[0].lower() == b"dkim-signature")
+    except Exception:
+        count = 0
+    if count <= 1:
+        return [_check_dkim(msg, dnsfunc, key_cache=key_cache)]
+    if isinstance(msg, StreamedMessage):
+        # Hash the streamed body for all of the signatures before they are
+        # checked in parallel
+        msg.body_digests(msg._signature_specs())
+
+    pool = None
+    if executor is None:
+        executor = pool = ThreadPoolExecutor(max_workers=count)
+    futures = OrderedDict((executor.submit(_check_dkim, msg, dnsfunc, idx, key_cache), idx) for idx in range(count))
+    results = [None] * count
+    passes = []
+    try:
+        for future in as_completed(futures):
+            result = results[futures[future]] = future.result()
+            if result.result == 'pass':
+                passes.append(result)
+                if aligned is not None and aligned(passes):
+                    break
+    finally:
+        for future in futures:
+            future.cancel()
+        if pool is not None:
+            pool.shutdown(wait=False)
+    return [result for result in results if result is not None]
+
+
+def check_arc(msg, logger=None, dnsfunc=None, metrics=None, key_cache=None, arc_cache=None):
     """ Compute the chain validation status of an inbound message.
-    @param msg: an RFC822 formatted message (with either \\n or \\r\\n line endings)
+    @param msg: an RFC822 formatted message (with either \\n or \\r\\n line endings) or a ParsedMessage
     @param logger: An optional logger
     @param dnsfunc: An optional dns lookup function (intended for testing)
+    @param metrics: An optional Metrics for instrumentation
+    @param key_cache: An optional KeyCache of parsed public keys
+    @param arc_cache: An optional ARCCache of the outcomes of verifying
+    earlier ARC sets
     """
+    if metrics is None:
+        return _check_arc(msg, logger, dnsfunc, key_cache, arc_cache)
+    with stage(metrics, 'arc'):
+        return _check_arc(msg, logger, instrument_dnsfunc(dnsfunc, metrics), key_cache, arc_cache)
 
-    a = ARC(msg)
+
+def _check_arc(msg, logger, dnsfunc, key_cache, arc_cache):
+    a = parse_message(msg).arc(key_cache=key_cache, arc_cache=arc_cache)
     try:
         if(dnsfunc):
             cv, results, comment = a.verify(dnsfunc=dnsfunc)
@@ -312,6 +530,8 @@ def check_arc(msg, logger=None, dnsfunc=None):
             cv, results, comment = a.verify()
     except DKIMException as e:
         cv, results, comment = CV_Fail, [], "%s" % e
+    except BudgetExceeded as e:
+        return ARCAuthenticationResult(result='temperror', result_comment="%s" % e)
     except DNSException as e:
         cv, results, comment = CV_Fail, [], "%s" % e
     except Exception as e:
@@ -324,13 +544,71 @@ def check_arc(msg, logger=None, dnsfunc=None):
         return ARCAuthenticationResult(result='none', result_comment=comment)
 
 
-def check_dmarc(msg, spf_result=None, dkim_result=None, dnsfunc=None, psddmarc=False, dmarcbis=False):
+def prefetch_policies(msg, executor, dnsfunc=None, psddmarc=False, dmarcbis=False, parallel_walk=False, policy_cache=None, metrics=None):
+    """Start DMARC policy discovery for each From domain of msg on executor.
+    @return: A dict of From domain to concurrent.futures.Future, for
+    check_dmarc's policies parameter
+    """
+    policies = {}
+    for from_header in parse_message(msg).from_addresses:
+        try:
+            from_domain = get_domain_part(from_header)
+        except IndexError:
+            continue
+        if from_domain not in policies:
+            policies[from_domain] = executor.submit(discover_policy, from_domain, dnsfunc=dnsfunc, psddmarc=psddmarc, dmarcbis=dmarcbis, parallel_walk=parallel_walk, policy_cache=policy_cache, metrics=metrics)
+    return policies
+
+
+def _discovered(policies, from_domain):
+    if policies and from_domain in policies:
+        policy = policies[from_domain]
+        return policy.result() if isinstance(policy, Future) else policy
+    return None
+
+
+def _dmarc_dkim(msg, dnsfunc, psddmarc, dmarcbis, parallel_walk, policies, policy_cache, metrics, key_cache):
+    # Verify the DKIM signatures for DMARC alone, stopping once each From
+    # domain with a policy has an aligned pass.  Returns the results and the
+    # policies discovered to decide that.
+    policies = dict(policies or {})
+    try:
+        from_domains = set(get_domain_part(x) for x in msg.from_addresses)
+        for from_domain in from_domains:
+            if from_domain not in policies:
+                policies[from_domain] = discover_policy(from_domain, dnsfunc=dnsfunc, psddmarc=psddmarc, dmarcbis=dmarcbis, parallel_walk=parallel_walk, policy_cache=policy_cache, metrics=metrics)
+        discovered = dict((from_domain, _discovered(policies, from_domain)) for from_domain in from_domains)
+    except Exception:
+        # Left to check_dmarc to report
+        return check_dkim_signatures(msg, dnsfunc=dnsfunc, metrics=metrics, key_cache=key_cache), policies
+
+    def aligned(passes):
+        return all(not (policy.record and policy.record.get('p')) or
+                   any(_dkim_aligned(from_domain, r.header_d, policy.adkim) for r in passes)
+                   for from_domain, policy in discovered.items())
+
+    return check_dkim_signatures(msg, dnsfunc=dnsfunc, aligned=aligned, metrics=metrics, key_cache=key_cache), policies
+
+
+def check_dmarc(msg, spf_result=None, dkim_result=None, dnsfunc=None, psddmarc=False, dmarcbis=False, parallel_walk=False, policies=None, policy_cache=None, metrics=None):
+    """ Compute the DMARC result for a message.
+    @param msg: an RFC822 formatted message (with either \\n or \\r\\n line endings) or a ParsedMessage
+    @param dkim_result: A DKIMAuthenticationResult, or a list of them as
+    from check_dkim_signatures
+    @param policies: An optional dict of From domain to a Future of its
+    DMARCPolicy, as returned by prefetch_policies, or to the DMARCPolicy
+    @param policy_cache: An optional PolicyCache for policy discovery
+    @param metrics: An optional Metrics for instrumentation
+    """
+    if metrics is None:
+        return _check_dmarc(msg, spf_result, dkim_result, dnsfunc, psddmarc, dmarcbis, parallel_walk, policies, policy_cache, None)
+    with stage(metrics, 'dmarc'):
+        return _check_dmarc(msg, spf_result, dkim_result, instrument_dnsfunc(dnsfunc, metrics), psddmarc, dmarcbis, parallel_walk, policies, policy_cache, metrics)
+
 
+def _check_dmarc(msg, spf_result, dkim_result, dnsfunc, psddmarc, dmarcbis, parallel_walk, policies, policy_cache, metrics):
     # get from domain
-    headers, _ = rfc822_parse(msg)
-    from_headers = [a[1] for a in getaddresses(x[1].replace(b'\r\n', b'')
-        .decode(errors='ignore').strip() for x in headers
-        if x[0].lower() == b"from")]
+    from_headers = parse_message(msg).from_addresses
 
     if len(from_headers) > 1:
         # multi-from processing per RFC 7489 6.6.1
@@ -343,11 +621,17 @@ def check_dmarc(msg, spf_result=None, dkim_result=None, dnsfunc=None, psddmarc=F
                 result_comment = 'Unable to extract From domain: {0}'.format(from_header)
                 return DMARCAuthenticationResult(result=result, result_comment=result_comment, header_from='none', policy='none')
             try:
-                domain_results.append(dmarc_per_from(from_domain, spf_result=spf_result, dkim_result=dkim_result, dnsfunc=dnsfunc, psddmarc=psddmarc, dmarcbis=dmarcbis))
+                domain_results.append(dmarc_per_from(from_domain, spf_result=spf_result, dkim_result=dkim_result, dnsfunc=dnsfunc, psddmarc=psddmarc, dmarcbis=dmarcbis, parallel_walk=parallel_walk, discovered=_discovered(policies, from_domain), policy_cache=policy_cache, metrics=metrics))
             except dmarc_lookup.DMARCException as result_comment:
                 result = 'permerror'
                 return DMARCAuthenticationResult(result=result, result_comment=result_comment, header_from=from_domain, policy='none')
+            except BudgetExceeded as e:
+                return DMARCAuthenticationResult(result='temperror', result_comment=str(e), header_from=from_domain)
 
+        for domain in domain_results:
+            if domain[0] == 'temperror':
+                result, result_comment, from_domain, policy = domain
+                return DMARCAuthenticationResult(result=result, result_comment=result_comment, header_from=from_domain)
         for domain in domain_results:
             if domain[3] == 'reject':
                 result, result_comment, from_domain, policy = domain
@@ -370,10 +654,12 @@ def check_dmarc(msg, spf_result=None, dkim_result=None, dnsfunc=None, psddmarc=F
             result_comment = 'Unable to extract From domain: {0}'.format(from_header)
             return DMARCAuthenticationResult(result=result, result_comment=result_comment, header_from='none', policy='none')
         try:
-            result, result_comment, from_domain, policy = dmarc_per_from(from_domain, spf_result=spf_result, dkim_result=dkim_result, dnsfunc=dnsfunc, psddmarc=psddmarc, dmarcbis=dmarcbis)
+            result, result_comment, from_domain, policy = dmarc_per_from(from_domain, spf_result=spf_result, dkim_result=dkim_result, dnsfunc=dnsfunc, psddmarc=psddmarc, dmarcbis=dmarcbis, parallel_walk=parallel_walk, discovered=_discovered(policies, from_domain), policy_cache=policy_cache, metrics=metrics)
         except dmarc_lookup.DMARCException as result_comment:
             result = 'permerror'
             return DMARCAuthenticationResult(result=result, result_comment=result_comment, header_from=from_domain, policy='none')
+        except BudgetExceeded as e:
+            return DMARCAuthenticationResult(result='temperror', result_comment=str(e), header_from=from_domain)
 
     else:
         result = 'none'
@@ -384,65 +670,182 @@ def check_dmarc(msg, spf_result=None, dkim_result=None, dnsfunc=None, psddmarc=F
         return DMARCAuthenticationResult(result=result, header_from=from_domain)
 
 
-def authenticate_message(msg, authserv_id, prev=None, spf=False, dkim=True, arc=False, dmarc=True, ip=None, mail_from=None, helo=None, dnsfunc=None, psddmarc=False, dmarcbis=False):
+def authenticate_message(msg, authserv_id, prev=None, spf=False, dkim=True, arc=False, dmarc=True, ip=None, mail_from=None, helo=None, dnsfunc=None, psddmarc=False, dmarcbis=False, parallel_walk=False, executor=None, policy_cache=None, metrics=None, dkim_all=False, key_cache=None, arc_cache=None, timeout=None, max_dns_queries=None):
     """Authenticate an RFC822 message and return the Authentication-Results header
-    @param msg: an RFC822 formatted message (with either \\n or \\r\\n line endings)
+    @param msg: an RFC822 formatted message (with either \\n or \\r\\n line endings) or a ParsedMessage
     @param authserv_id: The id of the server performing the authentication
     @param prev: an existing authentication results header to append results to
     @param spf: Perform SPF check
     @param dkim: Perform DKIM check
+    @param dkim_all: Verify every DKIM signature, concurrently (see
+    check_dkim_signatures), reporting a result for each rather than for only
+    the first.  With dkim False, the signatures are verified for DMARC
+    alone, stopping once an aligned pass is found
     @param dmarc: Perform DMARC check
     @param psddmarc: Perform PSD DMARC check (RFC 9091)
     @param dmarcbis: Use DMARCbis policy discovery and alignment
+    @param parallel_walk: (DMARCbis) Do the DNS tree walk lookups in parallel
+    @param executor: An optional concurrent.futures.Executor.  If given, the
+    SPF, DKIM and ARC checks and DMARC policy discovery are all run on it at
+    once, and DMARC alignment is done when they are finished
     @param arc: Perform ARC chain validation check
     @param ip: (SPF) IP address of incoming request
     @param mail_from: (SPF) Sender declared in MAIL FROM
     @param helo: (SPF) EHLO/HELO domain of incoming message
-    @param dnsfunc: An optional dns lookup function (intended for testing)
+    @param dnsfunc: An optional dns lookup function (intended for testing) or
+    a DNSCache shared by the DKIM, ARC and DMARC lookups
+    @param policy_cache: An optional PolicyCache of DMARC policies
+    @param key_cache: An optional KeyCache of DKIM public keys, for DKIM and
+    ARC verification
+    @param arc_cache: An optional ARCCache, so ARC sets verified before are
+    not verified again
+    @param metrics: An optional Metrics, sent stage timings and DNS and
+    cache counters (see authheaders.metrics)
+    @param timeout: Seconds the message's DNS lookups may take in all.  A
+    check still needing DNS after that reports temperror (see
+    authheaders.budget)
+    @param max_dns_queries: Number of DNS queries the DKIM, ARC and DMARC
+    checks may make, with the same effect as timeout once they are spent.
+    SPF queries, made by pyspf, are not counted
     @return: The Authentication-Results header
     """
 
     if spf and 'spf' not in sys.modules:
         raise Exception('pyspf must be installed manually for spf authentication')
 
+    # The budget goes outside the instrumentation, so metrics still see a
+    # DNSCache's hits and misses, and cache hits are not charged
+    dnsfunc = instrument_dnsfunc(dnsfunc, metrics)
+    budget = None
+    if timeout is not None or max_dns_queries is not None:
+        budget = Budget(timeout, max_dns_queries)
+        dnsfunc = budget.wrap(dnsfunc)
+
+    if metrics is None:
+        return _authenticate_message(msg, authserv_id, prev, spf, dkim, arc, dmarc, ip, mail_from, helo, dnsfunc, psddmarc, dmarcbis, parallel_walk, executor, policy_cache, None, dkim_all, key_cache, arc_cache, budget)
+    with stage(metrics, 'authenticate_message'):
+        return _authenticate_message(msg, authserv_id, prev, spf, dkim, arc, dmarc, ip, mail_from, helo, dnsfunc, psddmarc, dmarcbis, parallel_walk, executor, policy_cache, metrics, dkim_all, key_cache, arc_cache, budget)
+
+
+def _check_spf(ip, mail_from, helo, metrics, budget=None):
+    with stage(metrics, 'spf'):
+        return check_spf(ip, mail_from, helo, budget)
+
+
+def _authenticate_message(msg, authserv_id, prev, spf, dkim, arc, dmarc, ip, mail_from, helo, dnsfunc, psddmarc, dmarcbis, parallel_walk, executor, policy_cache, metrics, dkim_all, key_cache, arc_cache, budget):
+    # Parsed once, on first use, for all of the checks below
+    msg = parse_message(msg)
+    if metrics is not None:
+        with stage(metrics, 'parse'):
+            try:
+                msg.headers
+            except Exception:
+                # Raised again by the checks, as it would have been
+                pass
+
     results = []
     if prev:
         arobj = AuthenticationResultsHeader.parse(prev)
         results = arobj.results
 
     spf_result  = next((x for x in results if type(x) == SPFAuthenticationResult), None)
-    dkim_result = next((x for x in results if type(x) == DKIMAuthenticationResult), None)
+    dkim_results = [x for x in results if type(x) == DKIMAuthenticationResult]
+    dkim_result = (dkim_results if dkim_all else dkim_results[0]) if dkim_results else None
     arc_result  = next((x for x in results if type(x) == ARCAuthenticationResult), None)
 
+    spf_future = dkim_future = arc_future = policies = None
+    if executor is not None:
+        if isinstance(msg, StreamedMessage) and ((dkim and not dkim_result) or (arc and not arc_result)):
+            # Hash the streamed body for DKIM and ARC before they are checked
+            # in parallel
+            try:
+                msg.body_digests(msg._signature_specs())
+            except Exception:
+                # Raised again by the checks, as it would have been
+                pass
+        if spf and not spf_result:
+            spf_future = executor.submit(_check_spf, ip, mail_from, helo, metrics, budget)
+        if dkim and not dkim_result:
+            dkim_future = executor.submit(check_dkim_signatures if dkim_all else check_dkim, msg, dnsfunc=dnsfunc, metrics=metrics, key_cache=key_cache)
+        if arc and not arc_result:
+            arc_future = executor.submit(check_arc, msg, None, dnsfunc=dnsfunc, metrics=metrics, key_cache=key_cache, arc_cache=arc_cache)
+        if dmarc:
+            policies = prefetch_policies(msg, executor, dnsfunc=dnsfunc, psddmarc=psddmarc, dmarcbis=dmarcbis, parallel_walk=parallel_walk, policy_cache=policy_cache, metrics=metrics)
+
     if spf and not spf_result:
-        spf_result = check_spf(ip, mail_from, helo)
+        if spf_future:
+            spf_result = spf_future.result()
+        else:
+            spf_result = _check_spf(ip, mail_from, helo, metrics, budget)
         results.append(spf_result)
 
     if dkim and not dkim_result:
-        dkim_result = check_dkim(msg, dnsfunc=dnsfunc)
-        results.append(dkim_result)
+        if dkim_future:
+            dkim_result = dkim_future.result()
+        elif dkim_all:
+            dkim_result = check_dkim_signatures(msg, dnsfunc=dnsfunc, metrics=metrics, key_cache=key_cache)
+        else:
+            dkim_result = check_dkim(msg, dnsfunc=dnsfunc, metrics=metrics, key_cache=key_cache)
+        if dkim_all:
+            results.extend(dkim_result)
+        else:
+            results.append(dkim_result)
 
     if arc and not arc_result:
-        arc_result = check_arc(msg, None, dnsfunc=dnsfunc)
+        if arc_future:
+            arc_result = arc_future.result()
+        else:
+            arc_result = check_arc(msg, None, dnsfunc=dnsfunc, metrics=metrics, key_cache=key_cache, arc_cache=arc_cache)
         results.append(arc_result)
 
     if dmarc:
-        dmarc_result = check_dmarc(msg, spf_result, dkim_result, dnsfunc=dnsfunc, psddmarc=psddmarc, dmarcbis=dmarcbis)
+        if dkim_all and not dkim and not dkim_result:
+            dkim_result, policies = _dmarc_dkim(msg, dnsfunc, psddmarc, dmarcbis, parallel_walk, policies, policy_cache, metrics, key_cache)
+        dmarc_result = check_dmarc(msg, spf_result, dkim_result, dnsfunc=dnsfunc, psddmarc=psddmarc, dmarcbis=dmarcbis, parallel_walk=parallel_walk, policies=policies, policy_cache=policy_cache, metrics=metrics)
         results.append(dmarc_result)
 
     auth_res = AuthenticationResultsHeader(authserv_id=authserv_id, results=results)
     return str(auth_res)
 
+
+def authenticate_and_seal(msg, authserv_id, selector, domain, privkey, sig_headers, timestamp=None, logger=None, standardize=False, **kwargs):
+    """Authenticate a message, with ARC chain validation, and add the next ARC
+    set, as authenticate_message followed by sign_message(sig='ARC') on the
+    message with the Authentication-Results header added would.  The message
+    is parsed once, body hashes are shared by verification and signing, and
+    the chain validation status is taken from the results directly.
+    @param msg: an RFC822 formatted message (with either \\n or \\r\\n line endings) or a ParsedMessage
+    @param authserv_id: The id of the server performing the authentication
+    and sealing
+    @param selector: the DKIM selector value for the ARC set
+    @param domain: the DKIM domain value for the ARC set
+    @param privkey: a PKCS#1 private key in base64-encoded text form
+    @param sig_headers: a list of strings indicating which headers are to be signed
+    @param timestamp: (for ARC testing) a manual timestamp to use for ARC signature generation
+    @param logger: An optional logger
+    @param standardize: A testing flag for arc to output a standardized header format
+    @param kwargs: Other arguments of authenticate_message (arc is always True)
+    @return: (The Authentication-Results header, the ARC set header fields)
+    """
+    msg = parse_message(msg)
+    kwargs['arc'] = True
+    res = authenticate_message(msg, authserv_id, **kwargs)
+    # Parsed as sign_message would parse it (dropping comments), not the message
+    results = AuthenticationResultsHeader.parse(res).results
+    signer = get_signer(selector, domain, privkey, sig_headers)
+    return res, signer.arc_seal(msg, authserv_id.encode('utf-8'), results, timestamp=timestamp, standardize=standardize, logger=logger)
+
 def sign_message(msg, selector, domain, privkey, sig_headers, sig='DKIM', srv_id=None,
                  identity=None, length=None, canonicalize=(b'relaxed', b'relaxed'), timestamp=None,
                  logger=None, standardize=False):
     """Sign an RFC822 message and return the ARC or DKIM header(s)
-    @param msg: an RFC822 formatted message (with either \\n or \\r\\n line endings)
+    @param msg: an RFC822 formatted message (with either \\n or \\r\\n line endings) or a ParsedMessage
     @param selector: the DKIM selector value for the signature
     @param domain: the DKIM domain value for the signature
     @param privkey: a PKCS#1 private key in base64-encoded text form
     @param sig_headers: a list of strings indicating which headers are to be signed
-    @param sig: "DKIM" or "ARC"
+    @param sig: "DKIM", "ARC" or "DKIM+ARC" (a DKIM signature and an ARC set
+    covering it, with the message parsed and its body hashed once)
     @param srv_id: an authserv_id to identify AR headers to sign
     @param identity: (DKIM) the DKIM identity value for the signature (default "@"+domain)
     @param length: (DKIM) true if the l= tag should be included to indicate body length (default False)
@@ -450,12 +853,12 @@ def sign_message(msg, selector, domain, privkey, sig_headers, sig='DKIM', srv_id
     @param timestamp: (for ARC testing) a manual timestamp to use for ARC signature generation
     @param logger: An optional logger
     @param standardize: A testing flag for arc to output a standardized header format
-    @return: The DKIM-Message-Signature, or ARC set headers
+    @return: The DKIM-Message-Signature, or ARC set headers (for "DKIM+ARC",
+    the ARC set headers followed by the DKIM-Signature)
     @raises: DKIMException if mis-configured
+
+    The parsed key is kept (see signer.get_signer), so signing more messages
+    with the same key does not parse it again.
     """
 
-    if sig=="DKIM":
-        return DKIM(msg, logger=logger).sign(selector, domain, privkey, include_headers=sig_headers,
-                              identity=identity, length=length, canonicalize=canonicalize)
-    else:
-        return ARC(msg, logger=logger).sign(selector, domain, privkey, srv_id, include_headers=sig_headers, timestamp=timestamp, standardize=standardize)
+    return get_signer(selector, domain, privkey, sig_headers).sign(msg, sig=sig, srv_id=srv_id, identity=identity, length=length, canonicalize=canonicalize, timestamp=timestamp, logger=logger, standardize=standardize)
@@ -0,0 +1,116 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""Cache of ARC set verification outcomes, keyed by seal hash."""
+
+import hashlib
+from dkim import get_txt, select_headers
+from dkim.canonicalization import Relaxed
+from authheaders.dnscache import TTLCache
+
+__all__ = [
+    "ARCCache",
+    "CachedInstanceVerifier",
+    "seal_hash",
+    ]
+
+
+def seal_hash(headers, arc_headers_w_instance, instance):
+    """Return a hex digest of everything the verification of an ARC set
+    depends on other than the message body and DNS: the ARC header fields of
+    the set and the sets before it, and the header fields its ARC-Seal
+    covers, as dkim picks them from the message.
+    @param headers: the message header fields, as dkim.ARC.headers
+    @param arc_headers_w_instance: as from dkim.ARC.sorted_arc_headers
+    @param instance: the i= instance of the set
+    """
+    arc_headers = [x[1] for x in arc_headers_w_instance if x[0] <= instance]
+    as_include_headers = [x[0].lower() for x in arc_headers]
+    as_include_headers.reverse()
+    sealed = select_headers(Relaxed.canonicalize_headers(headers), as_include_headers[:-1])
+    h = hashlib.sha256(str(instance).encode('ascii'))
+    for name, value in arc_headers + sealed:
+        h.update(b"\0" + name.lower() + b":" + value)
+    return h.hexdigest()
+
+
+class ARCCache(TTLCache):
+    """Cache of per instance ARC verification outcomes.
+
+    Pass an instance as the arc_cache argument of authenticate_message (or
+    of check_arc) and the ARC sets before the most recent one are not
+    verified again when their seal hash has been seen: only sets added since
+    cost DNS lookups and signature checks.  The most recent set is always
+    verified, as its ARC-Message-Signature covers the message as it is now.
+    Only sets whose ARC-Seal validated are cached, so the chain validation
+    result is the same as without the cache.
+
+    An outcome is reused for as long as it is cached, even if the sealer's
+    key has changed since, which is what a trusted intermediary re-checking
+    chains it has verified before wants.
+
+    @param max_entries: Number of outcomes kept in memory before the least
+    recently used one is evicted
+    @param store: An optional dict like object (e.g. a shelve.Shelf)
+    outcomes are also written to and read from, to keep them across
+    processes or restarts
+    """
+
+    def __init__(self, max_entries=10000, store=None):
+        super(ARCCache, self).__init__(max_entries)
+        self.store = store
+
+    # get and put (of TTLCache) return and take the outcome (a dict, as from
+    # dkim.ARC.verify_instance) of verifying the ARC set with a seal hash;
+    # these read from and write through to the store
+
+    def _get(self, key):
+        found, output = super(ARCCache, self)._get(key)
+        if not found and self.store is not None:
+            output = self.store.get(key)
+            found = output is not None
+            if found:
+                super(ARCCache, self)._put(key, output)
+        return found, output
+
+    def _put(self, key, output, ttl=None):
+        super(ARCCache, self)._put(key, output, ttl)
+        if self.store is not None:
+            self.store[key] = output
+
+
+class CachedInstanceVerifier(object):
+    """Mixin for dkim.ARC taking the outcomes of verifying ARC sets before
+    the most recent one from arc_cache, when it is set."""
+
+    arc_cache = None
+
+    def verify_instance(self, arc_headers_w_instance, instance, dnsfunc=get_txt):
+        if self.arc_cache is None or not arc_headers_w_instance:
+            return super(CachedInstanceVerifier, self).verify_instance(arc_headers_w_instance, instance, dnsfunc=dnsfunc)
+        key = seal_hash(self.headers, arc_headers_w_instance, instance)
+        # Sorted most recent first
+        if instance < arc_headers_w_instance[0][0]:
+            found, output = self.arc_cache.get(key)
+            if found:
+                return dict(output)
+        output = super(CachedInstanceVerifier, self).verify_instance(arc_headers_w_instance, instance, dnsfunc=dnsfunc)
+        if output['as-valid']:
+            self.arc_cache.put(key, dict(output))
+        return output
@@ -0,0 +1,269 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""asyncio support for authenticate_message.
+
+The DNS names a message needs are resolved concurrently with an awaitable
+dnsfunc and the usual checks then run against the answers, so the
+Authentication-Results header is the same as authenticate_message's.
+"""
+
+import asyncio
+import functools
+import sys
+import dns.asyncresolver
+import dns.exception
+import dns.resolver
+from authres import SPFAuthenticationResult, DKIMAuthenticationResult, AuthenticationResultsHeader
+from authres.arc import ARCAuthenticationResult
+from dkim import DnsTimeoutError
+from dkim.util import parse_tag_value
+from authheaders import check_arc, check_dkim, check_dmarc, check_spf, get_domain_part
+from authheaders.budget import BudgetExceeded
+from authheaders.message import get_from_addresses, parse_message
+from authheaders.dmarc_lookup import get_org_domain, walk_hosts
+from authheaders.dnscache import call_dnsfunc
+from authheaders.psddmarc import PSD_LIST_HOST, get_psd_registry
+
+__all__ = [
+    "authenticate_message_async",
+    "dns_query_async",
+    ]
+
+#: Re-runs of a check allowed to resolve names it asked for that were not
+#: prefetched (e.g. the org domain record when the From domain has none).
+MAX_LOOKUP_ROUNDS = 10
+
+
+async def dns_query_async(name, qtype='TXT', timeout=5):
+    """Default awaitable dnsfunc, using dnspython's asyncio resolver.
+
+    bytes names (DKIM key lookups) are answered with the TXT data, as dkim's
+    get_txt does, and str names with the dns.resolver.Answer, as
+    dmarc_lookup.dns_query does.
+    """
+    txt = isinstance(name, bytes)
+    if txt:
+        try:
+            name = name.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    try:
+        answer = await dns.asyncresolver.resolve(name, qtype, lifetime=timeout,
+                                                 search=txt or None)
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.resolver.NoNameservers):
+        return None
+    except (dns.resolver.NoResolverConfiguration, dns.exception.Timeout) as e:
+        if txt:
+            raise DnsTimeoutError('{0}: {1}'.format(type(e).__name__, e))
+        raise
+    if txt:
+        return b"".join(answer.rrset[0].strings)
+    return answer
+
+
+class PrefetchedLookup(object):
+    """Synchronous dnsfunc answering from already resolved names (raising the
+    lookup error, if there was one).  Names that were not resolved are
+    answered with None and recorded in misses.
+    @param answers: A dict of (name, qtype) to the answer or lookup error
+    @param unresolved: An optional exception to raise for names that were
+    not resolved, rather than answering None
+    """
+
+    def __init__(self, answers, unresolved=None):
+        self.answers = answers
+        self.unresolved = unresolved
+        self.misses = set()
+
+    def __call__(self, name, qtype='TXT', **kwargs):
+        key = (name, qtype)
+        if key in self.answers:
+            answer = self.answers[key]
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+        self.misses.add(key)
+        if self.unresolved is not None:
+            raise self.unresolved
+        return None
+
+
+def unresolved_error():
+    """The error a check sees for names still missing after
+    MAX_LOOKUP_ROUNDS, so it reports temperror rather than a result computed
+    without them."""
+    return BudgetExceeded("DNS names unresolved after %d lookup rounds" % MAX_LOOKUP_ROUNDS)
+
+
+async def _resolve(keys, answers, dnsfunc, timeout):
+    async def query(name, qtype):
+        return await call_dnsfunc(dnsfunc, name, qtype, timeout=timeout)
+
+    keys = [key for key in set(keys) if key not in answers]
+    # Lookup errors are kept and raised to the check that asks for the name,
+    # so they are handled just as they are by authenticate_message.
+    results = await asyncio.gather(*(query(name, qtype) for name, qtype in keys),
+                                   return_exceptions=True)
+    answers.update(zip(keys, results))
+
+
+async def _run_check(check, answers, dnsfunc, timeout, executor, *args, **kwargs):
+    # The checks verify signatures, which is CPU bound, so they run in the
+    # executor rather than on the event loop
+    loop = asyncio.get_running_loop()
+    for _ in range(MAX_LOOKUP_ROUNDS):
+        lookup = PrefetchedLookup(answers)
+        result = await loop.run_in_executor(executor, functools.partial(check, *args, dnsfunc=lookup, **kwargs))
+        if not lookup.misses:
+            return result
+        await _resolve(lookup.misses, answers, dnsfunc, timeout)
+    lookup = PrefetchedLookup(answers, unresolved_error())
+    return await loop.run_in_executor(executor, functools.partial(check, *args, dnsfunc=lookup, **kwargs))
+
+
+def _key_name(fields):
+    return (fields[b's'] + b"._domainkey." + fields[b'd'] + b".", 'TXT')
+
+
+def dkim_names(headers):
+    """DNS names needed to verify the first DKIM signature."""
+    for name, value in headers:
+        if name.lower() == b'dkim-signature':
+            try:
+                return [_key_name(parse_tag_value(value))]
+            except Exception:
+                return []
+    return []
+
+
+def arc_names(msg):
+    """DNS names needed to verify every ARC set."""
+    names = []
+    try:
+        _, arc_headers = parse_message(msg).arc().sorted_arc_headers()
+    except Exception:
+        return names
+    for _, (name, value) in arc_headers:
+        if name.lower() in (b'arc-seal', b'arc-message-signature'):
+            try:
+                names.append(_key_name(parse_tag_value(value)))
+            except Exception:
+                pass
+    return names
+
+
+def dmarc_names(headers, psddmarc=False, dmarcbis=False):
+    """DNS names DMARC policy discovery is likely to need."""
+    names = []
+    # The PSD registry is looked up in DNS if there is no local copy
+    psd_dns = (psddmarc or dmarcbis) and get_psd_registry().registry() is None
+    for from_header in get_from_addresses(headers):
+        try:
+            from_domain = get_domain_part(from_header)
+        except IndexError:
+            continue
+        if dmarcbis:
+            hosts = walk_hosts(from_domain)
+        else:
+            hosts = [from_domain, get_org_domain(from_domain)]
+        names.extend(('_dmarc.' + host, 'TXT') for host in hosts)
+        if psd_dns:
+            if dmarcbis:
+                psds = hosts
+            else:
+                psds = [get_org_domain(from_domain).split('.', 1)[-1]]
+            names.extend((psd + PSD_LIST_HOST, 'TXT') for psd in psds)
+    return names
+
+
+async def authenticate_message_async(msg, authserv_id, prev=None, spf=False, dkim=True, arc=False, dmarc=True, ip=None, mail_from=None, helo=None, dnsfunc=None, psddmarc=False, dmarcbis=False, timeout=5, executor=None):
+    """Authenticate an RFC822 message in an asyncio context and return the
+    Authentication-Results header.  See authenticate_message for the
+    parameters, other than:
+    @param dnsfunc: An optional awaitable dns lookup function, called as
+    dnsfunc(name, timeout=timeout) for TXT records and
+    dnsfunc(name, qtype=qtype, timeout=timeout) otherwise (default dns_query_async)
+    @param timeout: DNS lookup timeout in seconds
+    @param executor: executor for the blocking pyspf check and the CPU bound
+    DKIM, ARC and DMARC checks (default is the event loop's default executor)
+    @return: The Authentication-Results header
+    """
+
+    if spf and 'spf' not in sys.modules:
+        raise Exception('pyspf must be installed manually for spf authentication')
+    if dnsfunc is None:
+        dnsfunc = dns_query_async
+
+    results = []
+    if prev:
+        arobj = AuthenticationResultsHeader.parse(prev)
+        results = arobj.results
+
+    spf_result  = next((x for x in results if type(x) == SPFAuthenticationResult), None)
+    dkim_result = next((x for x in results if type(x) == DKIMAuthenticationResult), None)
+    arc_result  = next((x for x in results if type(x) == ARCAuthenticationResult), None)
+
+    # SPF, the DNS prefetch and then the DKIM and ARC checks run together,
+    # gathered before DMARC, which needs their results.
+    futures = []
+    spf_future = dkim_future = arc_future = None
+    if spf and not spf_result:
+        # pyspf has no asyncio API, so it runs in an executor meanwhile.
+        spf_future = asyncio.get_running_loop().run_in_executor(executor, check_spf, ip, mail_from, helo)
+        futures.append(spf_future)
+
+    msg = parse_message(msg)
+    names = []
+    if dkim and not dkim_result:
+        names.extend(dkim_names(msg.headers))
+    if arc and not arc_result:
+        names.extend(arc_names(msg))
+    if dmarc:
+        names.extend(dmarc_names(msg.headers, psddmarc=psddmarc, dmarcbis=dmarcbis))
+    answers = {}
+
+    async def prefetched(check, *args, **kwargs):
+        await prefetch
+        return await _run_check(check, answers, dnsfunc, timeout, executor, msg, *args, **kwargs)
+
+    prefetch = asyncio.ensure_future(_resolve(names, answers, dnsfunc, timeout))
+    futures.append(prefetch)
+    if dkim and not dkim_result:
+        dkim_future = asyncio.ensure_future(prefetched(check_dkim))
+        futures.append(dkim_future)
+    if arc and not arc_result:
+        arc_future = asyncio.ensure_future(prefetched(check_arc, None))
+        futures.append(arc_future)
+    await asyncio.gather(*futures)
+
+    for future in (spf_future, dkim_future, arc_future):
+        if future is not None:
+            results.append(future.result())
+    if spf_future is not None:
+        spf_result = spf_future.result()
+    if dkim_future is not None:
+        dkim_result = dkim_future.result()
+
+    if dmarc:
+        dmarc_result = await _run_check(check_dmarc, answers, dnsfunc, timeout, executor, msg, spf_result, dkim_result, psddmarc=psddmarc, dmarcbis=dmarcbis)
+        results.append(dmarc_result)
+
+    auth_res = AuthenticationResultsHeader(authserv_id=authserv_id, results=results)
+    return str(auth_res)
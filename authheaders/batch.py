@@ -0,0 +1,175 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""Authenticate many messages per call.
+
+The DNS names each message needs are collected up front, so a name shared
+by many messages in a batch (the same From domain, DKIM d=/selector or ARC
+signer) is resolved only once.  The DKIM, ARC and DMARC checks then run on
+a process pool against the resolved answers.
+"""
+
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+import dns.resolver
+from authres import SPFAuthenticationResult, DKIMAuthenticationResult, AuthenticationResultsHeader
+from authres.arc import ARCAuthenticationResult
+from authheaders import authenticate_message, check_spf
+from authheaders.asyncsupport import MAX_LOOKUP_ROUNDS, PrefetchedLookup, arc_names, dkim_names, dmarc_names, unresolved_error
+from authheaders.dnscache import DNSCache, call_dnsfunc
+from authheaders.message import ParsedMessage, message_bytes
+
+__all__ = [
+    "BatchMessage",
+    "authenticate_messages",
+    ]
+
+#: A message and its SMTP metadata, as given to authenticate_message.
+BatchMessage = namedtuple('BatchMessage', ['msg', 'ip', 'mail_from', 'helo', 'prev'], defaults=(None, None, None, None))
+
+
+def _authenticate(msg, authserv_id, prev, answers, kwargs, last=False):
+    # Runs in the worker: no DNS here, names that were not prefetched are
+    # answered with None and reported back so the message can be re-run.
+    # On the last run they are lookup errors instead.
+    lookup = PrefetchedLookup(answers, unresolved_error() if last else None)
+    res = authenticate_message(msg, authserv_id, prev=prev, dnsfunc=lookup, **kwargs)
+    return res, lookup.misses
+
+
+def _query(dnsfunc, name, qtype):
+    try:
+        answer = call_dnsfunc(dnsfunc, name, qtype)
+    except Exception as e:
+        # Raised to the check that asks for the name, as it would have been
+        return e
+    if isinstance(answer, dns.resolver.Answer):
+        # Answers are sent to the workers, so only keep what the checks use
+        answer = [str(rdata) for rdata in answer]
+    return answer
+
+
+class _Item(object):
+    def __init__(self, item, authserv_id, spf, dkim, arc, dmarc, psddmarc, dmarcbis):
+        if not isinstance(item, tuple):
+            item = BatchMessage(item)
+        item = BatchMessage(*item)
+        # Only the message bytes are sent to the workers
+        msg = message_bytes(item.msg)
+        self.msg = msg
+        self.prev = item.prev
+        results = []
+        if item.prev:
+            results = AuthenticationResultsHeader.parse(item.prev).results
+        self.prev_results = results
+        self.spf = spf and not any(type(x) == SPFAuthenticationResult for x in results)
+        self.spf_args = (item.ip, item.mail_from, item.helo)
+
+        parsed = ParsedMessage(msg)
+        self.names = set()
+        try:
+            if dkim and not any(type(x) == DKIMAuthenticationResult for x in results):
+                self.names.update(dkim_names(parsed.headers))
+            if arc and not any(type(x) == ARCAuthenticationResult for x in results):
+                self.names.update(arc_names(parsed))
+            if dmarc:
+                self.names.update(dmarc_names(parsed.headers, psddmarc=psddmarc, dmarcbis=dmarcbis))
+        except Exception:
+            # A malformed message fails in the worker, as it would in
+            # authenticate_message
+            pass
+
+    def add_spf(self, authserv_id, spf_result):
+        # authenticate_message takes an SPF result from prev as its own, so
+        # passing it there gives the same header as checking it in place.
+        self.prev = str(AuthenticationResultsHeader(authserv_id=authserv_id, results=self.prev_results + [spf_result]))
+
+
+def authenticate_messages(messages, authserv_id, spf=False, dkim=True, arc=False, dmarc=True, dnsfunc=None, psddmarc=False, dmarcbis=False, executor=None, batch_size=100, dns_workers=16):
+    """Authenticate RFC822 messages in bulk, yielding their
+    Authentication-Results headers in the order the messages were given.
+    @param messages: An iterable of messages, each an RFC822 formatted
+    message, a ParsedMessage or a BatchMessage (or tuple) of the message and
+    its SMTP metadata: (msg, ip, mail_from, helo, prev).  A streamed message
+    (file object, mmap or iterable of bytes) is read whole
+    @param authserv_id: The id of the server performing the authentication
+    @param spf: Perform SPF check
+    @param dkim: Perform DKIM check
+    @param arc: Perform ARC chain validation check
+    @param dmarc: Perform DMARC check
+    @param dnsfunc: An optional dns lookup function.  Lookups are made in
+    this process and cached for the whole run (see DNSCache)
+    @param psddmarc: Perform PSD DMARC check (RFC 9091)
+    @param dmarcbis: Use DMARCbis policy discovery and alignment
+    @param executor: An optional concurrent.futures.Executor for the checks
+    (default is a process pool for the duration of the call)
+    @param batch_size: Number of messages whose lookups are deduplicated and
+    checked together
+    @param dns_workers: Number of threads making DNS (and SPF) lookups
+    @return: A generator of Authentication-Results headers
+    """
+
+    if spf and 'spf' not in sys.modules:
+        raise Exception('pyspf must be installed manually for spf authentication')
+    if not isinstance(dnsfunc, DNSCache):
+        dnsfunc = DNSCache(dnsfunc)
+    kwargs = dict(dkim=dkim, arc=arc, dmarc=dmarc, psddmarc=psddmarc, dmarcbis=dmarcbis)
+
+    pool = None
+    if executor is None:
+        executor = pool = ProcessPoolExecutor()
+    resolver = ThreadPoolExecutor(max_workers=dns_workers)
+    answers = {}
+    try:
+        messages = iter(messages)
+        while True:
+            items = [_Item(item, authserv_id, spf, **kwargs) for item in islice(messages, batch_size)]
+            if not items:
+                break
+
+            spf_futures = [(item, resolver.submit(check_spf, *item.spf_args)) for item in items if item.spf]
+            pending = items
+            results = {}
+            for rounds in range(MAX_LOOKUP_ROUNDS + 1):
+                names = set().union(*(item.names for item in pending)) - set(answers)
+                answers.update(zip(names, resolver.map(lambda key: _query(dnsfunc, *key), names)))
+                for item, future in spf_futures:
+                    item.add_spf(authserv_id, future.result())
+                spf_futures = []
+                last = rounds == MAX_LOOKUP_ROUNDS
+                futures = [(item, executor.submit(_authenticate, item.msg, authserv_id, item.prev, {key: answers[key] for key in item.names}, kwargs, last)) for item in pending]
+                pending = []
+                for item, future in futures:
+                    results[item], misses = future.result()
+                    if misses:
+                        item.names.update(misses)
+                        pending.append(item)
+                if not pending:
+                    break
+
+            for item in items:
+                yield results[item]
+            # Later batches get answers from dnsfunc's cache
+            answers.clear()
+    finally:
+        resolver.shutdown(wait=False)
+        if pool is not None:
+            pool.shutdown()
@@ -0,0 +1,135 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""Incremental DKIM body canonicalization and hashing.
+
+Gives the same digests as hashing dkim's canonicalize_body of the whole body,
+but reads the body a chunk at a time.  Chunks are split at line ends, and
+the canonicalization regexps all work within a line, so each run of
+complete lines is canonicalized on its own.  Only trailing empty lines are
+held back (as a count), since whether they are hashed depends on what
+follows them.
+"""
+
+import re
+from dkim.canonicalization import Relaxed, compress_whitespace, strip_trailing_whitespace
+
+__all__ = [
+    "hash_body",
+    ]
+
+CRLF = b"\r\n"
+LINE_END_RE = re.compile(b"\r?\n")
+
+
+class _Truncated(object):
+    # A hash fed at most length bytes (the l= tag)
+
+    def __init__(self, h, length):
+        self.h = h
+        self.remaining = length
+
+    def update(self, data):
+        if self.remaining is None:
+            self.h.update(data)
+        elif self.remaining > 0:
+            self.h.update(data[:self.remaining])
+            self.remaining -= min(len(data), self.remaining)
+
+
+class BodyCanonicalizer(object):
+    """Canonicalizes a body given as runs of complete lines, writing the
+    result to one or more hashes.
+    @param body_algorithm: dkim.canonicalization.Simple or Relaxed
+    @param sinks: objects with an update method, fed the canonicalized body
+    """
+
+    def __init__(self, body_algorithm, sinks):
+        self.relaxed = body_algorithm is Relaxed
+        self.sinks = sinks
+        self.empty_lines = 0
+        self.length = 0
+
+    def _write(self, data):
+        if self.empty_lines:
+            data = CRLF * self.empty_lines + data
+            self.empty_lines = 0
+        self.length += len(data)
+        for sink in self.sinks:
+            sink.update(data)
+
+    def update(self, lines):
+        """Add CRLF terminated lines to the body."""
+        if self.relaxed:
+            lines = compress_whitespace(strip_trailing_whitespace(lines))
+        end = len(lines)
+        while lines.endswith(CRLF, 0, end):
+            end -= 2
+        if end == 0:
+            self.empty_lines += len(lines) // 2
+        else:
+            self._write(lines[:end + 2])
+            self.empty_lines = (len(lines) - end) // 2 - 1
+
+    def final(self, rest):
+        """Add the unterminated last line of the body, and finish it."""
+        if self.relaxed:
+            rest = compress_whitespace(rest)
+        if rest:
+            self._write(rest + CRLF)
+        elif not self.length and not self.relaxed:
+            # The simple canonicalization of an empty body is one CRLF
+            self.empty_lines = 0
+            self._write(CRLF)
+
+
+def hash_body(chunks, specs):
+    """Hash a body read a chunk at a time.
+    @param chunks: an iterable of bytes, the message body (after the blank
+    line ending the headers) with CRLF or LF line endings
+    @param specs: an iterable of (body_algorithm, hasher, length) tuples:
+    the canonicalization (dkim.canonicalization.Simple or Relaxed), a
+    hashlib constructor and the l= length, or None for the whole body
+    @return: A dict of each spec to (digest, canonicalized body length)
+    """
+    specs = set(specs)
+    hashes = {}
+    canonicalizers = []
+    for body_algorithm in set(spec[0] for spec in specs):
+        sinks = []
+        for spec in specs:
+            if spec[0] is body_algorithm:
+                hashes[spec] = spec[1]()
+                sinks.append(_Truncated(hashes[spec], spec[2]))
+        canonicalizers.append((body_algorithm, BodyCanonicalizer(body_algorithm, sinks)))
+
+    rest = b""
+    for chunk in chunks:
+        rest += chunk
+        end = rest.rfind(b"\n") + 1
+        if end:
+            lines = LINE_END_RE.sub(CRLF, rest[:end])
+            rest = rest[end:]
+            for _, canonicalizer in canonicalizers:
+                canonicalizer.update(lines)
+    for _, canonicalizer in canonicalizers:
+        canonicalizer.final(rest)
+
+    lengths = dict((body_algorithm, c.length) for body_algorithm, c in canonicalizers)
+    return dict((spec, (h.digest(), lengths[spec[0]])) for spec, h in hashes.items())
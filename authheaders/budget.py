@@ -0,0 +1,166 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""Per message deadline and DNS query budget.
+
+authenticate_message's timeout and max_dns_queries arguments create a
+Budget for the message and route every DNS query of the DKIM, ARC and DMARC
+checks through it.  A query made after the deadline, or beyond the query
+limit, raises BudgetExceeded instead of going to DNS, and queries that are
+made get no more than the time left as their timeout.  The checks report
+temperror for BudgetExceeded, so a message takes at most about timeout
+seconds however slow DNS is.  SPF, which pyspf resolves itself, is given
+the time left as its query time limit, but its queries are not counted
+against the query limit (pyspf applies the RFC 7208 lookup limits).
+"""
+
+import threading
+import time
+import dns.exception
+from dkim import DnsTimeoutError
+from authheaders.dnscache import DNSCache, call_dnsfunc
+from authheaders.metrics import InstrumentedDNS, default_dnsfunc
+
+__all__ = [
+    "Budget",
+    "BudgetExceeded",
+    "BudgetedDNS",
+    ]
+
+
+class BudgetExceeded(dns.exception.DNSException):
+    """The deadline has passed or the DNS query budget is spent."""
+
+
+class Budget(object):
+    """A deadline and DNS query limit shared by the checks of one message.
+
+    @param timeout: Seconds from now until the deadline, None for no deadline
+    @param max_queries: Number of DNS queries allowed, None for no limit
+    """
+
+    def __init__(self, timeout=None, max_queries=None):
+        self.clock = time.monotonic
+        self.deadline = None if timeout is None else self.clock() + timeout
+        self.max_queries = max_queries
+        self.queries = 0
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        """Seconds left until the deadline, or None if there is none."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - self.clock())
+
+    def expired(self):
+        """True once the deadline has passed."""
+        return self.deadline is not None and self.clock() >= self.deadline
+
+    def exhausted(self):
+        """True once the deadline has passed or the queries are used up."""
+        return self.expired() or (self.max_queries is not None and self.queries >= self.max_queries)
+
+    def charge(self):
+        """Count a DNS query against the budget.
+        @raises: BudgetExceeded if it is not allowed
+        """
+        with self.lock:
+            if self.expired():
+                raise BudgetExceeded("deadline passed")
+            if self.max_queries is not None and self.queries >= self.max_queries:
+                raise BudgetExceeded("DNS query budget of %d spent" % self.max_queries)
+            self.queries += 1
+
+    def wrap(self, dnsfunc):
+        """Return dnsfunc (None for the default resolvers) wrapped to charge
+        its queries to this budget."""
+        return BudgetedDNS(dnsfunc, self)
+
+
+class BudgetedDNS(object):
+    """dnsfunc charging each query to a Budget.
+
+    A timeout the caller passes (as dkim does for key lookups) is cut to the
+    time left.  A wrapped dnsfunc that takes no timeout argument is not
+    passed one, so it is only bounded by the checks made before each query.
+    When the wrapped dnsfunc is a DNSCache (possibly behind InstrumentedDNS)
+    only the queries it sends upstream are charged, not its cached answers.
+
+    @param dnsfunc: the dns lookup function to wrap, or None
+    @param budget: the Budget to charge
+    """
+
+    def __init__(self, dnsfunc, budget):
+        self.dnsfunc = dnsfunc
+        self.budget = budget
+
+    def __eq__(self, other):
+        # Compares as the wrapped dnsfunc, as metrics.InstrumentedDNS does
+        if isinstance(other, BudgetedDNS):
+            return self.dnsfunc == other.dnsfunc
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((BudgetedDNS, self.dnsfunc))
+
+    def __call__(self, name, qtype='TXT', **kwargs):
+        budget = self.budget
+        clipped = []
+
+        def charge(kwargs):
+            budget.charge()
+            remaining = budget.remaining()
+            if remaining is not None and ('timeout' in kwargs or _default_resolver(self.dnsfunc)):
+                timeout = kwargs.get('timeout', remaining)
+                clipped.append(remaining <= timeout)
+                kwargs = dict(kwargs, timeout=min(timeout, remaining))
+            return kwargs
+
+        try:
+            if _cache_lookup(self.dnsfunc):
+                # Answers from the cache cost nothing, only the queries it
+                # makes upstream are charged
+                return self.dnsfunc.lookup(name, qtype, charge, **kwargs)[0]
+            kwargs = charge(kwargs)
+            if self.dnsfunc is None:
+                return default_dnsfunc(name, qtype, **kwargs)
+            return call_dnsfunc(self.dnsfunc, name, qtype, **kwargs)
+        except Exception as e:
+            if isinstance(e, BudgetExceeded):
+                raise
+            # A query cut short by the deadline.  A resolver given the time
+            # left may give up just before the deadline passes.
+            if budget.expired() or (any(clipped) and isinstance(e, (dns.exception.Timeout, DnsTimeoutError))):
+                raise BudgetExceeded("deadline passed: %s" % e)
+            raise
+
+
+def _cache_lookup(dnsfunc):
+    # A DNSCache, or one behind InstrumentedDNS: both have lookup
+    if isinstance(dnsfunc, InstrumentedDNS):
+        dnsfunc = dnsfunc.dnsfunc
+    return isinstance(dnsfunc, DNSCache)
+
+
+def _default_resolver(dnsfunc):
+    # True if queries end up with the package's own resolvers, which take a
+    # timeout
+    while isinstance(dnsfunc, (InstrumentedDNS, DNSCache)):
+        dnsfunc = dnsfunc.dnsfunc
+    return dnsfunc is None
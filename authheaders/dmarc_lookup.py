@@ -19,10 +19,9 @@
 #
 ############################################################################
 from __future__ import absolute_import, unicode_literals, print_function
-import importlib.resources
 try:
     # typing is needed by mypy, but is unused otherwise
-    from typing import Dict, Text  # noqa: F401
+    from typing import Dict, Iterator, List, Text  # noqa: F401
 except ImportError:
     pass
 from dns.resolver import (resolve, NXDOMAIN, NoAnswer, NoNameservers)
@@ -33,6 +32,9 @@ except ImportError:
     from publicsuffix import PublicSuffixList
 import sys
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from authheaders.dnscache import DNSCache, call_dnsfunc
+from authheaders.psl import get_org_domain_cache, get_suffix_index, reload_suffix_index
 
 class DMARCException(Exception):
     """Base class for DMARC errors."""
@@ -66,9 +68,9 @@ def answer_to_dict(answer):
     retval['v'] = 'DMARC1'
     return retval
 
-def dns_query(name, qtype='TXT'):
+def dns_query(name, qtype='TXT', timeout=None):
     try:
-        return resolve(name, qtype)
+        return resolve(name, qtype, lifetime=timeout)
     except (NXDOMAIN, NoAnswer, NoNameservers):
         return None
 
@@ -87,10 +89,10 @@ def lookup_receiver_record(host, dnsfunc=dns_query):
 
     answer = dnsfunc(dmarcHost)
 
-    # This is because dns_query returns a dns.resolver.Answer object while the
-    # test suite dnsfunc returns a string (which does not have quotes on it
-    # like the dns.resolver object).
-    if dnsfunc != dns_query:
+    # This is because dns_query (and DNSCache) returns a dns.resolver.Answer
+    # object while the test suite dnsfunc returns a string (which does not
+    # have quotes on it like the dns.resolver object).
+    if isinstance(answer, str):
         if answer:
             answer = ['"' + answer + '"']
 
@@ -145,12 +147,35 @@ def receiver_record(host, dnsfunc=dns_query):
 
     return (retval, newHost)
 
-def receiver_record_walk(host, dnsfunc=dns_query):
-    # type: (str), dnsfunc(optional) -> (Dict[unicode, unicode])
+def walk_hosts(host):
+    # type: (str) -> List[str]
+    '''Return the hosts queried by the DMARCbis tree walk, longest first.
+    >>> walk_hosts('a.b.c.d.e.example.com')
+    ['a.b.c.d.e.example.com', 'd.e.example.com', 'e.example.com', 'example.com', 'com']
+    >>> walk_hosts('_dmarc.example.com')
+    ['example.com', 'com']
+    '''
+    hostSansDmarc = host if host[:7] != '_dmarc.' else host[7:]
+    hosts = [hostSansDmarc]
+    tree = hostSansDmarc.split('.')
+    if len(tree) < 5:
+        level = len(tree) - 1
+    else:
+        level = 4
+    while level > 0:
+        hosts.append('.'.join(tree[(len(tree) - level):len(tree)]))
+        level -= 1
+    return hosts
+
+def receiver_record_walk(host, dnsfunc=dns_query, parallel=False, executor=None):
+    # type: (str), dnsfunc(optional), bool, Executor(optional) -> (Dict[unicode, unicode])
     '''Get the DMARC receiver record for a host using the DMARCbis-07 tree
     walk.
     :param str host: The host to lookup.
     :param dnsfunc.  a function from domain names to txt records for DNS lookup
+    :param parallel.  issue all of the tree walk queries at once
+    :param executor.  a concurrent.futures.Executor for the parallel queries
+                      (default is a thread pool for the duration of the call)
     :returns: The DMARC reciever record for the host.
     :rtype:  A dict of {tag => value} results
 
@@ -166,27 +191,97 @@ def receiver_record_walk(host, dnsfunc=dns_query):
 
     Return a list of results for each step in the tree walk.
     '''
-    hostSansDmarc = host if host[:7] != '_dmarc.' else host[7:]
-
     result = OrderedDict()
-    retval = lookup_receiver_record(hostSansDmarc, dnsfunc)
-    if retval:
-        result[hostSansDmarc] = retval
-
-    # walk the tree
-    tree = hostSansDmarc.split('.')
-    if len(tree) < 5:
-        level = len(tree) - 1
-    else:
-        level = 4
-    while level > 0:
-        newHost = '.'.join(tree[(len(tree) - level):len(tree)])
-        level -= 1
-        retval = lookup_receiver_record(newHost, dnsfunc)
-        if retval:
-            result[newHost] = retval
+    for newHost, retval in receiver_record_walk_iter(host, dnsfunc, parallel, executor):
+        result[newHost] = retval
     return result
 
+def receiver_record_walk_iter(host, dnsfunc=dns_query, parallel=False, executor=None):
+    # type: (str), dnsfunc(optional), bool, Executor(optional) -> Iterator[(str, Dict[unicode, unicode])]
+    '''Lazily walk the DNS tree as :func:`receiver_record_walk` does.
+    :param str host: The host to lookup.
+    :param dnsfunc.  a function from domain names to txt records for DNS lookup
+    :param parallel.  issue all of the tree walk queries at once
+    :param executor.  a concurrent.futures.Executor for the parallel queries
+    :returns: A generator of (host, {tag => value}) for each level of the
+              walk, longest first, that has a DMARC record.
+
+    Sequential lookups are only made as the generator is advanced, so a
+    caller that stops early does not pay for the rest of the walk.  Parallel
+    lookups still not started when the generator is closed are cancelled.
+    '''
+    hosts = walk_hosts(host)
+
+    if not parallel:
+        for newHost in hosts:
+            retval = lookup_receiver_record(newHost, dnsfunc)
+            if retval:
+                yield newHost, retval
+        return
+
+    pool = None
+    if executor is None:
+        executor = pool = ThreadPoolExecutor(max_workers=len(hosts))
+    futures = [executor.submit(lookup_receiver_record, newHost, dnsfunc) for newHost in hosts]
+    try:
+        for newHost, future in zip(hosts, futures):
+            retval = future.result()
+            if retval:
+                yield newHost, retval
+    finally:
+        for future in futures:
+            future.cancel()
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+
+#: Record types looked up to decide whether a domain exists (DMARC np=)
+EXISTENCE_QTYPES = ('A', 'MX', 'AAAA')
+
+_existence_cache = DNSCache()
+
+
+def get_existence_cache():
+    '''Return the :class:`DNSCache` :func:`domain_exists` uses when no
+    dnsfunc is given.'''
+    return _existence_cache
+
+def domain_exists(domain, dnsfunc=None, parallel=True, executor=None):
+    # type: (str), dnsfunc(optional), bool, Executor(optional) -> bool
+    '''Check whether a domain exists, for the DMARC np= policy.
+    :param str domain: The domain to check.
+    :param dnsfunc.  a function called as dnsfunc(domain, qtype=qtype) for DNS
+                     lookup (default is a shared, TTL aware :class:`DNSCache`),
+                     or as dnsfunc(domain) if it takes no qtype
+    :param parallel.  issue the A, MX and AAAA queries at once
+    :param executor.  a concurrent.futures.Executor for the parallel queries
+                      (default is a thread pool for the duration of the call)
+    :returns: True if any of A, MX or AAAA has an answer.
+
+    A domain with no A, MX or AAAA records (NXDOMAIN or NODATA) is treated
+    as non-existent.  The check stops at the first answer found.
+    '''
+    if dnsfunc is None:
+        dnsfunc = _existence_cache
+
+    if not parallel:
+        return any(call_dnsfunc(dnsfunc, domain, qtype) for qtype in EXISTENCE_QTYPES)
+
+    pool = None
+    if executor is None:
+        executor = pool = ThreadPoolExecutor(max_workers=len(EXISTENCE_QTYPES))
+    futures = [executor.submit(call_dnsfunc, dnsfunc, domain, qtype) for qtype in EXISTENCE_QTYPES]
+    try:
+        for future in as_completed(futures):
+            if future.result():
+                return True
+        return False
+    finally:
+        for future in futures:
+            future.cancel()
+        if pool is not None:
+            pool.shutdown(wait=False)
+
 
 def get_org_domain_from_suffix_list(location, domain):
     with open(location) as suffixList:
@@ -195,13 +290,11 @@ def get_org_domain_from_suffix_list(location, domain):
 
 
 def get_org_domain(domain):
-    try:
-        from authheaders.findpsl import location
-        return get_org_domain_from_suffix_list(location, domain)
-    except ModuleNotFoundError:
-        ref = importlib.resources.files('authheaders') / 'public_suffix_list.txt'
-        with importlib.resources.as_file(ref) as location:
-            return get_org_domain_from_suffix_list(location, domain)
+    '''Get the organizational domain for a domain from the Public Suffix List.
+    The list is parsed once per process, see :func:`reload_suffix_index`, and
+    results are memoized, see :func:`get_org_domain_cache`.
+    '''
+    return get_org_domain_cache().get_org_domain(domain)
 
 def _test():
     import doctest, dmarc_lookup
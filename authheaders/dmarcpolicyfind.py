@@ -2,8 +2,81 @@
 
 
 import argparse
+import csv
+import json
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import authheaders
+from authheaders.dnscache import DNSCache
+
+#: Columns of the bulk mode output, as in verbose output
+FIELDS = ['original_from', 'policydomain', 'result_comment', 'policy', 'record', 'orgdomain']
+
+
+def _find_policy(domain, psddmarc, dmarcbis, dnsfunc):
+    try:
+        return authheaders.dmarc_per_from(domain, spf_result=None, dkim_result=None, dnsfunc=dnsfunc, psddmarc=psddmarc, dmarcbis=dmarcbis, policy_only=True)
+    except Exception as e:
+        return [domain, None, 'Error: {0}'.format(e), None, None, None]
+
+
+def read_domains(lines):
+    """Domains from lines of text, one per line.  Blank lines and lines
+    starting with # are skipped."""
+    for line in lines:
+        domain = line.strip()
+        if domain and not domain.startswith('#'):
+            yield domain
+
+
+def find_policies(domains, psddmarc=False, dmarcbis=False, dnsfunc=None, jobs=16):
+    """Find the DMARC policy of many domains, yielding results in order.
+
+    At most jobs domains are looked up at once.  Lookups share dnsfunc
+    (default is a DNSCache for the whole run), so a record many domains have
+    in common (e.g. an org domain or PSD record) is only queried once.
+    @param domains: An iterable of domains
+    @param dnsfunc: An optional dns lookup function
+    @param jobs: Number of domains looked up concurrently
+    @return: A generator of [original_from, policydomain, result_comment,
+    policy, record, orgdomain] lists, as from dmarc_per_from, with
+    result_comment 'Error: ...' if the lookup failed
+    """
+    if dnsfunc is None:
+        dnsfunc = DNSCache()
+    futures = deque()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        try:
+            for domain in domains:
+                while futures and (len(futures) >= jobs or futures[0].done()):
+                    yield futures.popleft().result()
+                futures.append(executor.submit(_find_policy, domain, psddmarc, dmarcbis, dnsfunc))
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def _record_text(record):
+    if not record:
+        return ''
+    return '; '.join('{0}={1}'.format(tag, value) for tag, value in record.items())
+
+
+def write_results(results, out, fmt='csv'):
+    """Write find_policies results as CSV (with a header row) or JSON lines."""
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(FIELDS)
+    for res in results:
+        if fmt == 'csv':
+            writer.writerow(res[:4] + [_record_text(res[4])] + res[5:])
+        else:
+            row = dict(zip(FIELDS, res))
+            row['record'] = row['record'] or None
+            out.write(json.dumps(row) + '\n')
 
 
 def main():
@@ -18,18 +91,32 @@ def main():
     This script checks to see which policy is relevant to a domain based on
     these methods.
     @param domain: Policy domain to locate.
+    @param f: Bulk mode: file of domains to locate, one per line (- for
+    stdin), written as CSV or JSON lines
+    @param j: (bulk mode) Number of domains looked up concurrently
+    @param format: (bulk mode) Output format, csv or json
     @param s: Policy selection logic to use, default DMARC.
     @param v: Verbose output:
       [original_from, policydomain, result_comment, policy, record, orgdomain]
-    @param q: Quiet output
+    @param q: Quiet output.  In bulk mode, exit 0 only if every domain has
+    a policy
 
     [1] https://datatracker.ietf.org/doc/draft-ietf-dmarc-dmarcbis Section 4.5
         DNS Tree Walk
     """
     parser = argparse.ArgumentParser(
         description='Find DMARC policy for a domain.',)
-    parser.add_argument('domain', action="store",
+    parser.add_argument('domain', action="store", nargs='?',
                         help='Usually From: domain of an email')
+    parser.add_argument('-f', '--file', type=argparse.FileType('r'),
+                        help='Bulk mode: read domains from FILE, one per \
+                        line (- for stdin)')
+    parser.add_argument('-j', '--jobs', type=int, default=16,
+                        help='Bulk mode: number of domains looked up \
+                        concurrently: Default is 16')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv',
+                        help='Bulk mode output: CSV or JSON lines: Default \
+                        is csv')
     parser.add_argument('-s', '--select',
                         choices=['DMARC', 'PSD', 'DMARCbis'], default='DMARC',
                         help='Select policy discovery method: Default is \
@@ -41,6 +128,10 @@ def main():
                         help='turn quiet mode on.  Exit 0 == policy found.  \
                         Exit 1 == no policy found.')
     args=parser.parse_args()
+    if (args.domain is None) == (args.file is None):
+        parser.error('give either a domain or --file')
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
 
     if args.select == 'DMARC':
         psddmarc = False
@@ -52,6 +143,16 @@ def main():
         psddmarc=False
         dmarcbis=True
 
+    if args.file is not None:
+        results = find_policies(read_domains(args.file), psddmarc=psddmarc, dmarcbis=dmarcbis, jobs=args.jobs)
+        if not args.quiet:
+            write_results(results, sys.stdout, args.format)
+        elif all(res[4] for res in results):
+            sys.exit(0)
+        else:
+            sys.exit(1)
+        return
+
     res = authheaders.dmarc_per_from(args.domain, spf_result=None, dkim_result=None, dnsfunc=None, psddmarc=psddmarc, dmarcbis=dmarcbis, policy_only=True)
     if not args.quiet:
         if args.verbose:
@@ -0,0 +1,274 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""TTL aware, LRU bounded cache of DNS answers usable as a dnsfunc, and the
+TTLCache it and the package's other caches are built on."""
+
+import inspect
+import threading
+import time
+from collections import OrderedDict
+import dns.exception
+import dns.rdatatype
+import dns.resolver
+from dkim import DnsTimeoutError
+
+__all__ = [
+    "DNSCache",
+    "TTLCache",
+    "call_dnsfunc",
+    "query_ttl",
+    ]
+
+
+def negative_ttl(response, default):
+    """Return the negative caching TTL for a response per RFC 2308 Section 5:
+    the lesser of the SOA record TTL and its MINIMUM field."""
+    if response is not None:
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+    return default
+
+
+def _takes_qtype(dnsfunc):
+    try:
+        params = inspect.signature(dnsfunc).parameters.values()
+    except (TypeError, ValueError):
+        return True
+    return any(p.name == 'qtype' or p.kind == p.VAR_KEYWORD for p in params)
+
+
+def call_dnsfunc(dnsfunc, name, qtype='TXT', **kwargs):
+    """Make a query with a user supplied dnsfunc.  TXT queries are made as
+    dnsfunc(name, **kwargs), other types as dnsfunc(name, qtype=qtype,
+    **kwargs).  A dnsfunc that takes no qtype argument, written for TXT
+    lookups only, is called as dnsfunc(name, **kwargs) for every type, as
+    it was before the np= existence check asked for A, MX and AAAA.
+    """
+    if qtype == 'TXT' or not _takes_qtype(dnsfunc):
+        return dnsfunc(name, **kwargs)
+    return dnsfunc(name, qtype=qtype, **kwargs)
+
+
+def query_ttl(name, qtype='TXT', timeout=None, txt=False, default_negative_ttl=300):
+    """Resolve a query with dnspython, returning (answer, ttl).  NXDOMAIN
+    and NoAnswer give (None, the SOA negative TTL), server failures (None, 0).
+    @param txt: True for dkimpy key lookups, which use the resolver's search
+    list and raise DnsTimeoutError on timeouts
+    """
+    try:
+        answer = dns.resolver.resolve(name, qtype, raise_on_no_answer=False,
+                                      lifetime=timeout, search=txt or None)
+    except dns.resolver.NXDOMAIN as e:
+        responses = list(e.responses().values())
+        return None, negative_ttl(responses[0] if responses else None, default_negative_ttl)
+    except dns.resolver.NoNameservers:
+        # Server failures are not cached
+        return None, 0
+    except (dns.resolver.NoResolverConfiguration, dns.exception.Timeout) as e:
+        if txt:
+            raise DnsTimeoutError('{0}: {1}'.format(type(e).__name__, e))
+        raise
+    if answer.rrset is None:
+        return None, negative_ttl(answer.response, default_negative_ttl)
+    return answer, answer.rrset.ttl
+
+
+class TTLCache(object):
+    """Thread safe, LRU bounded cache whose entries may expire.
+
+    The bookkeeping shared by DNSCache, PolicyCache, KeyCache, ARCCache,
+    psl.OrgDomainCache and the PSD registry's DNS answers.  Entries are
+    (value, expiry time) pairs, the expiry time None for entries kept until
+    they are evicted.  Subclasses keep the get and put signatures, naming
+    operations of their own differently (e.g. PolicyCache.lookup).
+
+    @param max_entries: Number of entries kept before the least recently
+    used one is evicted
+    @param max_ttl: Upper bound for any TTL, None for no bound
+    """
+
+    def __init__(self, max_entries=10000, max_ttl=None):
+        self.max_entries = max_entries
+        self.max_ttl = max_ttl
+        self.clock = time.monotonic
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return (found, value) for a key, counting hits and misses."""
+        with self.lock:
+            found, value = self._get(key)
+            self._count(found)
+            return found, value
+
+    def put(self, key, value, ttl=None):
+        """Cache a value for ttl seconds, or until it is evicted if ttl is
+        None.  A ttl of 0 or less is not cached."""
+        with self.lock:
+            self._put(key, value, ttl)
+
+    def time_left(self, key):
+        """Return the seconds left before an entry expires, or None if it is
+        not cached or does not expire."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] is None:
+                return None
+            return max(entry[1] - self.clock(), 0)
+
+    def stats(self):
+        """Return a dict of hit, miss and entry counts and the hit rate."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries),
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def clear(self):
+        """Drop all entries and reset the counters."""
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    # The methods below are called with the lock held
+
+    def _get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[1] is None or entry[1] > self.clock():
+                self.entries.move_to_end(key)
+                return True, entry[0]
+            del self.entries[key]
+        return False, None
+
+    def _put(self, key, value, ttl=None):
+        expires = None
+        if ttl is not None:
+            if self.max_ttl is not None:
+                ttl = min(ttl, self.max_ttl)
+            if ttl <= 0:
+                return
+            expires = self.clock() + ttl
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _count(self, found):
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+
+class DNSCache(TTLCache):
+    """Caching dnsfunc shared by DKIM, ARC and DMARC lookups.
+
+    Pass an instance as the dnsfunc argument of authenticate_message (or of
+    check_dkim, check_arc and check_dmarc) and repeat queries are answered
+    from memory until their TTL expires.
+
+    Without a wrapped dnsfunc, queries are resolved with dnspython.  Names
+    given as bytes (dkimpy key lookups) are answered with the TXT data, as
+    dkim's own get_txt does; names given as str are answered with the
+    dns.resolver.Answer, as dmarc_lookup.dns_query does.  NXDOMAIN and
+    NoAnswer results are cached for the SOA negative TTL (RFC 2308).
+
+    When dnsfunc is given, its return values are cached for default_ttl
+    seconds (or the TTL of the answer, when it is a dns.resolver.Answer) and
+    empty results for negative_ttl seconds.
+
+    @param dnsfunc: An optional dns lookup function to wrap
+    @param max_entries: Number of answers kept before the least recently used
+    one is evicted
+    @param default_ttl: TTL for answers that do not carry one
+    @param negative_ttl: TTL for empty answers without an SOA record
+    @param max_ttl: Upper bound for any cached TTL
+    """
+
+    def __init__(self, dnsfunc=None, max_entries=10000, default_ttl=300,
+                 negative_ttl=300, max_ttl=86400):
+        super(DNSCache, self).__init__(max_entries, max_ttl)
+        self.dnsfunc = dnsfunc
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+
+    def __call__(self, name, qtype='TXT', **kwargs):
+        return self.lookup(name, qtype, **kwargs)[0]
+
+    def _key(self, name, qtype):
+        if isinstance(name, bytes):
+            try:
+                name = name.decode('utf-8')
+            except UnicodeDecodeError:
+                return None
+        return (name.lower().rstrip('.'), qtype.upper())
+
+    def lookup(self, name, qtype='TXT', on_miss=None, **kwargs):
+        """Answer a query as a dnsfunc does.
+        @param on_miss: An optional function called with kwargs before a
+        query goes upstream, returning the kwargs to query with.  It may
+        raise instead, e.g. budget.BudgetExceeded
+        @return: (answer, True if it came from the cache)
+        """
+        key = self._key(name, qtype)
+        if key is None:
+            return None, False
+
+        found, answer = self.get(key)
+        if not found:
+            if on_miss is not None:
+                kwargs = on_miss(kwargs)
+            if self.dnsfunc is not None:
+                answer, ttl = self._query_wrapped(name, qtype, kwargs)
+            else:
+                txt = isinstance(name, bytes)
+                answer, ttl = query_ttl(name.decode('utf-8') if txt else name, qtype,
+                                        kwargs.get('timeout'), txt, self.negative_ttl)
+            self.put(key, answer, ttl)
+
+        if self.dnsfunc is None and isinstance(name, bytes):
+            return self._txt_data(answer), found
+        return answer, found
+
+    def _query_wrapped(self, name, qtype, kwargs):
+        answer = call_dnsfunc(self.dnsfunc, name, qtype, **kwargs)
+        if not answer:
+            return answer, self.negative_ttl
+        rrset = getattr(answer, 'rrset', None)
+        if rrset is not None:
+            return answer, rrset.ttl
+        return answer, self.default_ttl
+
+    def remaining_ttl(self, name, qtype='TXT'):
+        """Return the seconds left before the cached answer to a query
+        expires, or None if it is not cached."""
+        return self.time_left(self._key(name, qtype))
+
+    def _txt_data(self, answer):
+        if not answer:
+            return None
+        if isinstance(answer, dns.resolver.Answer):
+            return b"".join(answer.rrset[0].strings)
+        return answer
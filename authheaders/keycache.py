@@ -0,0 +1,152 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""TTL aware, LRU bounded cache of parsed DKIM public keys."""
+
+import binascii
+import time
+from collections import namedtuple
+from dkim import DnsTimeoutError, KeyFormatError, evaluate_pk, get_txt
+from dkim.util import InvalidTagValueList, parse_tag_value
+from authheaders.dnscache import DNSCache, TTLCache, query_ttl
+
+__all__ = [
+    "CachedKeyVerifier",
+    "DKIMKey",
+    "KeyCache",
+    ]
+
+#: A parsed DKIM key record: the public key and its size, type and tlsrpt
+#: service flag as from dkim.evaluate_pk, and the record's tags.
+DKIMKey = namedtuple('DKIMKey', ['pk', 'keysize', 'ktag', 'seqtlsrpt', 'tags'])
+
+
+class KeyCache(TTLCache):
+    """Cache of DKIM public keys, parsed, by selector and domain.
+
+    Pass an instance as the key_cache argument of authenticate_message (or
+    of check_dkim, check_dkim_signatures and check_arc) and signatures by a
+    selector seen before, whether DKIM-Signature, ARC-Message-Signature or
+    ARC-Seal, are verified without a DNS lookup or decoding the key again.
+    A key is kept for the TTL of its DNS answer (default_ttl when dnsfunc
+    returns only the TXT data).  Missing and malformed keys are kept for
+    negative_ttl, and DNS errors are not cached.
+
+    Keys are not keyed by dnsfunc, so a cache should only be used with one
+    dnsfunc.
+
+    @param max_entries: Number of keys kept before the least recently used
+    one is evicted
+    @param default_ttl: TTL for keys whose DNS answers do not carry one
+    @param negative_ttl: TTL for missing or unusable keys
+    @param max_ttl: Upper bound for any cached TTL
+    """
+
+    def __init__(self, max_entries=10000, default_ttl=300, negative_ttl=300, max_ttl=86400):
+        super(KeyCache, self).__init__(max_entries, max_ttl)
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+
+    def load(self, selector, domain, dnsfunc=None, timeout=5):
+        """Return the DKIMKey for a selector and domain, from the cache or
+        from DNS.
+        @param selector: the s= tag, as bytes
+        @param domain: the d= tag, as bytes
+        @param dnsfunc: the dns lookup function the signature is being
+        verified with (default dkim's get_txt)
+        @raises: KeyFormatError for a missing or malformed key, and
+        DnsTimeoutError
+        """
+        key = (selector.lower(), domain.lower())
+        found, entry = self.get(key)
+        if not found:
+            name = selector + b"._domainkey." + domain + b"."
+            txt, ttl = self._query(name, dnsfunc, timeout)
+            try:
+                entry = self._parse(name, txt)
+            except KeyFormatError as e:
+                entry = e
+                ttl = min(ttl, self.negative_ttl)
+            self.put(key, entry, ttl)
+        if isinstance(entry, KeyFormatError):
+            raise entry
+        return entry
+
+    def _parse(self, name, txt):
+        try:
+            pk, keysize, ktag, seqtlsrpt = evaluate_pk(name, txt)
+            tags = parse_tag_value(txt.encode('ascii') if isinstance(txt, str) else txt)
+        except binascii.Error as e:
+            raise KeyFormatError('KeyFormatError: {0}'.format(e))
+        except InvalidTagValueList as e:
+            raise KeyFormatError(e)
+        return DKIMKey(pk, keysize, ktag, seqtlsrpt, tags)
+
+    def _query(self, name, dnsfunc, timeout):
+        # (TXT data, TTL), resolving with dnspython (directly or through a
+        # DNSCache) when there's no dnsfunc that would hide the TTL
+        if dnsfunc is None or dnsfunc is get_txt:
+            try:
+                answer, ttl = query_ttl(name.decode('utf-8'), 'TXT', timeout, True, self.negative_ttl)
+            except UnicodeDecodeError:
+                return None, self.negative_ttl
+            if answer is None:
+                return None, ttl
+        elif isinstance(dnsfunc, DNSCache) and dnsfunc.dnsfunc is None:
+            # Queried by str name for the dns.resolver.Answer
+            try:
+                answer = dnsfunc(name.decode('utf-8'), timeout=timeout)
+            except UnicodeDecodeError:
+                return None, self.negative_ttl
+        else:
+            answer = dnsfunc(name, timeout=timeout)
+        if not answer:
+            return answer, self.negative_ttl
+        rrset = getattr(answer, 'rrset', None)
+        if rrset is None:
+            return answer, self.default_ttl
+        ttl = rrset.ttl
+        expiration = getattr(answer, 'expiration', None)
+        if expiration is not None:
+            # What is left of it, for an answer from a cache
+            ttl = min(ttl, expiration - time.time())
+        return b"".join(rrset[0].strings), ttl
+
+
+class CachedKeyVerifier(object):
+    """Mixin for dkim.DKIM and dkim.ARC taking public keys from key_cache,
+    when it is set, for DKIM-Signature, ARC-Message-Signature and ARC-Seal
+    verification."""
+
+    key_cache = None
+
+    def verify_sig(self, sig, include_headers, sig_header, dnsfunc):
+        if self.key_cache is None:
+            return super(CachedKeyVerifier, self).verify_sig(sig, include_headers, sig_header, dnsfunc)
+        try:
+            key = self.key_cache.load(sig[b's'], sig[b'd'], dnsfunc, timeout=self.timeout)
+        except KeyFormatError as e:
+            self.logger.error("%s" % e)
+            return False
+        except DnsTimeoutError as e:
+            self.logger.error('DnsTimeoutError: Domain: {0} Selector: {1} Error message: {2}'.format(
+                sig[b'd'], sig[b's'], e))
+            return False
+        self.pk, self.keysize, self.ktag, self.seqtlsrpt = key[:4]
+        return self.verify_sig_process(sig, include_headers, sig_header, dnsfunc)
@@ -0,0 +1,343 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""A message parsed once and shared by all of the checks."""
+
+import base64
+import re
+import threading
+from email.utils import getaddresses
+from dkim import ARC, DKIM, MessageFormatError, ValidationError, rfc822_parse
+from dkim.canonicalization import CanonicalizationPolicy, InvalidCanonicalizationPolicyError
+from dkim.crypto import HASH_ALGORITHMS
+from dkim.util import parse_tag_value
+from authheaders.bodyhash import hash_body
+from authheaders.arccache import CachedInstanceVerifier
+from authheaders.keycache import CachedKeyVerifier
+
+__all__ = [
+    "ParsedMessage",
+    "StreamedMessage",
+    "parse_message",
+    "message_bytes",
+    "get_from_addresses",
+    ]
+
+HEADER_END_RE = re.compile(b'\r?\n\r?\n')
+# An empty line, ending the headers
+BLANK_LINE_RE = re.compile(b'(?:^|\n)(\r?\n)')
+
+
+def get_from_addresses(headers):
+    """Return the addresses in the From header fields of parsed headers."""
+    return [a[1] for a in getaddresses(x[1].replace(b'\r\n', b'')
+        .decode(errors='ignore').strip() for x in headers
+        if x[0].lower() == b"from")]
+
+
+class ParsedMessage(object):
+    """An RFC822 message, split into headers and body only once.
+
+    authenticate_message, the check functions and sign_message all accept
+    one in place of the message bytes.  Parsing is done on first use, so a
+    badly formed message raises MessageFormatError from the same place it
+    would if the bytes had been passed.  Body hashes are computed once per
+    canonicalization, hash and length, and shared by all of the signatures
+    verified and made.
+
+    @param message: an RFC822 formatted message (with either \\n or \\r\\n line endings)
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self._headers = None
+        self._body = None
+        self._from_addresses = None
+        self._digests = {}
+
+    def _parse(self):
+        if self._headers is None:
+            self._headers, self._body = rfc822_parse(self.message)
+
+    @property
+    def headers(self):
+        """List of [name, value] header fields, as from dkim.rfc822_parse."""
+        self._parse()
+        return self._headers
+
+    @property
+    def body(self):
+        """The body, CRLF separated."""
+        self._parse()
+        return self._body
+
+    @property
+    def body_offset(self):
+        """Offset of the body in the original message."""
+        m = re.match(b'\r?\n', self.message)
+        if m:
+            return m.end()
+        m = HEADER_END_RE.search(self.message)
+        if m:
+            return m.end()
+        return len(self.message)
+
+    @property
+    def from_addresses(self):
+        """Decoded addresses from the From header field(s)."""
+        if self._from_addresses is None:
+            self._from_addresses = get_from_addresses(self.headers)
+        return self._from_addresses
+
+    def body_digests(self, specs):
+        """Hash the body for each of specs.
+        @param specs: an iterable of (body_algorithm, hasher, length) tuples,
+        as for bodyhash.hash_body
+        @return: A dict of each spec to (digest, canonicalized body length)
+        """
+        for spec in specs:
+            if spec not in self._digests:
+                body_algorithm, hasher, length = spec
+                body = body_algorithm.canonicalize_body(self.body)
+                h = hasher()
+                h.update(body if length is None else body[:length])
+                self._digests[spec] = (h.digest(), len(body))
+        return dict((spec, self._digests[spec]) for spec in specs)
+
+    def _load(self, signer, key_cache=None):
+        signer.headers = list(self.headers)
+        signer.body = self.body
+        signer.parsed = self
+        signer.key_cache = key_cache
+        return signer
+
+    def dkim(self, logger=None, key_cache=None):
+        """Return a dkim.DKIM for the message without parsing it again.
+        @param key_cache: An optional KeyCache for verification
+        """
+        return self._load(_DKIM(logger=logger), key_cache)
+
+    def arc(self, logger=None, key_cache=None, arc_cache=None):
+        """Return a dkim.ARC for the message without parsing it again.
+        @param key_cache: An optional KeyCache for verification
+        @param arc_cache: An optional ARCCache for verification
+        """
+        a = self._load(_ARC(logger=logger), key_cache)
+        a.arc_cache = arc_cache
+        return a
+
+
+class _BodyDigests(object):
+    # Checks bh= against the message's body_digests, so each body hash is
+    # computed once for all of the signatures, then leaves
+    # the header signature to dkim (with bh= removed, so it does not hash a
+    # body).  This stands in for the body hash step of dkimpy's
+    # verify_sig_process, so dkimpy is pinned (see setup.py) and
+    # test_body_digests_match_dkimpy fails when that method changes.
+
+    def verify_sig_process(self, sig, include_headers, sig_header, dnsfunc):
+        if b'bh' in sig:
+            spec = _body_spec(sig, self.tlsrpt)
+            bodyhash = self.parsed.body_digests([spec])[spec][0]
+            self.logger.debug("bh: %s" % base64.b64encode(bodyhash))
+            try:
+                bh = base64.b64decode(re.sub(br"\s+", b"", sig[b'bh']))
+            except TypeError as e:
+                raise MessageFormatError(str(e))
+            if bodyhash != bh:
+                raise ValidationError(
+                    "body hash mismatch (got %s, expected %s)" %
+                    (base64.b64encode(bodyhash), sig[b'bh']))
+            sig = dict(sig)
+            del sig[b'bh']
+        return super(_BodyDigests, self).verify_sig_process(sig, include_headers, sig_header, dnsfunc)
+
+
+class _DKIM(_BodyDigests, CachedKeyVerifier, DKIM):
+    pass
+
+
+class _ARC(_BodyDigests, CachedKeyVerifier, CachedInstanceVerifier, ARC):
+    pass
+
+
+def _body_spec(fields, tlsrpt=False):
+    # The body hash a signature's tags call for, for body_digests
+    try:
+        canon_policy = CanonicalizationPolicy.from_c_value(fields.get(b'c', b'simple/simple'))
+    except InvalidCanonicalizationPolicyError as e:
+        raise MessageFormatError("invalid c= value: %s" % e.args[0])
+    length = None
+    if b'l' in fields and not tlsrpt:
+        length = int(fields[b'l'])
+    return (canon_policy.body_algorithm, HASH_ALGORITHMS[fields[b'a']], length)
+
+
+class StreamedMessage(ParsedMessage):
+    """A message read from a file object, mmap or iterable of bytes chunks,
+    keeping only the headers in memory.
+
+    The body is canonicalized and hashed as it is read, once for all of the
+    body hashes the DKIM-Signature and ARC-Message-Signature header fields
+    call for, so memory use doesn't grow with the size of the body.  A body
+    hash that is asked for later (e.g. to sign the message) needs the body
+    read again, which is only possible if the source is seekable.  Reading
+    the source is serialized, so the checks can share one from several
+    threads.
+
+    @param source: a binary file object or mmap (read from its current
+    position), or an iterable of bytes
+    @param chunk_size: bytes read from a file object at a time
+    """
+
+    def __init__(self, source, chunk_size=65536):
+        super(StreamedMessage, self).__init__(None)
+        self.source = source
+        self.chunk_size = chunk_size
+        self._chunks = None
+        self._rest = b''
+        self._body_start = None
+        self._header_length = None
+        self._header_bytes = b''
+        self._consumed = False
+        self._has_body = True
+        self._lock = threading.RLock()
+        if hasattr(source, 'read'):
+            self._chunks = iter(lambda: source.read(chunk_size), b'')
+            if hasattr(source, 'seek') and getattr(source, 'seekable', lambda: True)():
+                self._body_start = source.tell()
+        else:
+            self._chunks = iter(source)
+
+    def _parse(self):
+        if self._headers is not None:
+            return
+        with self._lock:
+            if self._headers is None:
+                self._read_headers()
+
+    def _read_headers(self):
+        buf = b''
+        for chunk in self._chunks:
+            buf += chunk
+            m = BLANK_LINE_RE.search(buf)
+            if m:
+                break
+        else:
+            m = None
+        if m:
+            self._headers, _ = rfc822_parse(buf[:m.start(1)])
+            self._header_length = m.end()
+            self._rest = buf[m.end():]
+        else:
+            self._headers, _ = rfc822_parse(buf)
+            self._header_length = len(buf)
+            self._consumed = True
+            self._has_body = False
+        self._header_bytes = buf[:self._header_length]
+        if self._body_start is not None:
+            self._body_start += self._header_length
+
+    @property
+    def body(self):
+        """The whole body, CRLF separated.  Reading it defeats streaming."""
+        with self._lock:
+            body = b"".join(self._body_chunks())
+        return b"\r\n".join(re.split(b"\r?\n", body))
+
+    def read(self):
+        """The whole message, as bytes.  Reading it defeats streaming."""
+        with self._lock:
+            self._parse()
+            return self._header_bytes + b"".join(self._body_chunks())
+
+    @property
+    def body_offset(self):
+        """Offset of the body in the source."""
+        self._parse()
+        return self._header_length
+
+    def _body_chunks(self):
+        self._parse()
+        if not self._consumed:
+            self._consumed = True
+            if self._rest:
+                yield self._rest
+            self._rest = b''
+            for chunk in self._chunks:
+                yield chunk
+        elif self._body_start is not None:
+            self.source.seek(self._body_start)
+            for chunk in iter(lambda: self.source.read(self.chunk_size), b''):
+                yield chunk
+        elif not self._has_body:
+            return
+        else:
+            raise ValueError("message body has already been read")
+
+    def _signature_specs(self):
+        # The body hashes the message's signatures call for
+        specs = set()
+        for name, value in self.headers:
+            if name.lower() in (b'dkim-signature', b'arc-message-signature'):
+                try:
+                    specs.add(_body_spec(parse_tag_value(value)))
+                except Exception:
+                    pass
+        return specs
+
+    def body_digests(self, specs):
+        specs = list(specs)
+        with self._lock:
+            missing = set(specs) - set(self._digests)
+            if missing:
+                self._parse()
+                if not self._consumed:
+                    # First pass over the body: hash it for every signature too
+                    missing |= self._signature_specs()
+                self._digests.update(hash_body(self._body_chunks(), missing))
+        return dict((spec, self._digests[spec]) for spec in specs)
+
+    def _load(self, signer, key_cache=None):
+        # The body is only hashed, through body_digests
+        signer.headers = list(self.headers)
+        signer.body = b''
+        signer.parsed = self
+        signer.key_cache = key_cache
+        return signer
+
+
+def parse_message(msg):
+    """Return msg as a ParsedMessage, parsing it only if it isn't one.  A
+    message that isn't bytes (a file object, mmap or iterable of chunks) is
+    returned as a StreamedMessage."""
+    if isinstance(msg, ParsedMessage):
+        return msg
+    if isinstance(msg, (bytes, bytearray)):
+        return ParsedMessage(msg)
+    return StreamedMessage(msg)
+
+
+def message_bytes(msg):
+    """Return msg, as accepted by parse_message, as bytes (e.g. to send it to
+    another process).  A streamed message is read whole."""
+    msg = parse_message(msg)
+    if isinstance(msg, StreamedMessage):
+        return msg.read()
+    return msg.message
@@ -0,0 +1,198 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""Optional instrumentation of message authentication.
+
+Pass an object with timing and incr methods (see Metrics) as the metrics
+argument of authenticate_message, check_dkim, check_arc, check_dmarc,
+dmarc_per_from or discover_policy.  It is sent:
+
+timing(name, seconds) for the stages
+  authenticate_message, parse (header parsing), spf, dkim, arc, dmarc,
+  dmarc.discovery (per From domain) and dns (each query)
+incr(name, count) for the counters
+  dns.queries, dns.errors, dns.cache.hits and dns.cache.misses (when
+  dnsfunc is a DNSCache), dmarc.policy_cache.hits and
+  dmarc.policy_cache.misses
+
+Without a metrics object nothing is measured.  With an executor the checks
+run concurrently, so the object must be thread safe.
+"""
+
+import threading
+import time
+from dkim.dnsplug import get_txt
+from authheaders.dmarc_lookup import dns_query, get_existence_cache
+from authheaders.dnscache import DNSCache, call_dnsfunc
+
+__all__ = [
+    "Metrics",
+    "MetricsRecorder",
+    "InstrumentedDNS",
+    "default_dnsfunc",
+    "instrument_dnsfunc",
+    ]
+
+
+def default_dnsfunc(name, qtype='TXT', **kwargs):
+    """Answer a query as it would have been answered had no dnsfunc been
+    given: DKIM and ARC key (bytes) names by dkim's resolver, DMARC names by
+    dmarc_lookup.dns_query and existence (A, MX and AAAA) queries by
+    dmarc_lookup's existence cache."""
+    if isinstance(name, bytes):
+        return get_txt(name, **kwargs)
+    if qtype == 'TXT':
+        return dns_query(name, timeout=kwargs.get('timeout'))
+    return get_existence_cache()(name, qtype, **kwargs)
+
+
+class Metrics(object):
+    """Instrumentation sink that ignores everything.  Override the methods
+    to forward to e.g. a StatsD or Prometheus client."""
+
+    def timing(self, name, seconds):
+        """A stage named name took seconds."""
+
+    def incr(self, name, count=1):
+        """Add count to the counter named name."""
+
+
+class MetricsRecorder(Metrics):
+    """Metrics that keeps totals in memory.
+
+    timings is a dict of stage name to [count, total seconds, max seconds],
+    and counters a dict of counter name to count.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+
+    def timing(self, name, seconds):
+        with self.lock:
+            stats = self.timings.get(name)
+            if stats is None:
+                self.timings[name] = [1, seconds, seconds]
+            else:
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = max(stats[2], seconds)
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+
+class _Stage(object):
+    # Times a with block as a stage
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.timing(self.name, time.perf_counter() - self.start)
+
+
+class _NoStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_no_stage = _NoStage()
+
+
+def stage(metrics, name):
+    """Context manager timing a stage, doing nothing if metrics is None."""
+    if metrics is None:
+        return _no_stage
+    return _Stage(metrics, name)
+
+
+class InstrumentedDNS(object):
+    """dnsfunc counting and timing the queries made through it.
+
+    Without a dnsfunc to wrap, queries go where they would have gone had no
+    dnsfunc been given (see default_dnsfunc).
+
+    @param dnsfunc: the dns lookup function to wrap, or None
+    @param metrics: the Metrics to report to
+    """
+
+    def __init__(self, dnsfunc, metrics):
+        self.dnsfunc = dnsfunc
+        self.metrics = metrics
+
+    def __eq__(self, other):
+        # Compares as the wrapped dnsfunc, so the wrappers made for each
+        # message compare equal
+        if isinstance(other, InstrumentedDNS):
+            return self.dnsfunc == other.dnsfunc
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((InstrumentedDNS, self.dnsfunc))
+
+    def __call__(self, name, qtype='TXT', **kwargs):
+        if isinstance(self.dnsfunc, DNSCache):
+            return self.lookup(name, qtype, **kwargs)[0]
+        metrics = self.metrics
+        start = time.perf_counter()
+        try:
+            if self.dnsfunc is None:
+                return default_dnsfunc(name, qtype, **kwargs)
+            return call_dnsfunc(self.dnsfunc, name, qtype, **kwargs)
+        except Exception:
+            metrics.incr('dns.errors')
+            raise
+        finally:
+            metrics.timing('dns', time.perf_counter() - start)
+            metrics.incr('dns.queries')
+
+    def lookup(self, name, qtype='TXT', on_miss=None, **kwargs):
+        """Answer a query through the wrapped DNSCache, as DNSCache.lookup
+        does, counting cache hits and misses too."""
+        metrics = self.metrics
+        start = time.perf_counter()
+        try:
+            answer, cached = self.dnsfunc.lookup(name, qtype, on_miss, **kwargs)
+            metrics.incr('dns.cache.hits' if cached else 'dns.cache.misses')
+            return answer, cached
+        except Exception:
+            metrics.incr('dns.errors')
+            raise
+        finally:
+            metrics.timing('dns', time.perf_counter() - start)
+            metrics.incr('dns.queries')
+
+
+def instrument_dnsfunc(dnsfunc, metrics):
+    """Return dnsfunc wrapped to report to metrics, or as it is if metrics
+    is None or it is already wrapped (also inside a budget.BudgetedDNS)."""
+    if metrics is None or isinstance(dnsfunc, InstrumentedDNS) or \
+       isinstance(getattr(dnsfunc, 'dnsfunc', None), InstrumentedDNS):
+        return dnsfunc
+    return InstrumentedDNS(dnsfunc, metrics)
@@ -0,0 +1,66 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""TTL aware, LRU bounded cache of discovered DMARC policies."""
+
+from authheaders.dnscache import TTLCache
+
+__all__ = [
+    "PolicyCache",
+    ]
+
+
+class PolicyCache(TTLCache):
+    """Cache of DMARCPolicy results of DMARC policy discovery.
+
+    Pass an instance as the policy_cache argument of authenticate_message
+    (or of check_dmarc, dmarc_per_from and discover_policy) and repeat From
+    domains are served the effective policy (p/sp/np already applied),
+    alignment modes, org domain and result comment without any DNS lookups
+    or record parsing.  A policy is kept for the least TTL of the DNS
+    answers it was discovered from.  Lookup failures are not cached.
+
+    Policies are keyed by From domain and discovery options, not by dnsfunc,
+    so a cache should only be used with one dnsfunc.
+
+    @param max_entries: Number of policies kept before the least recently
+    used one is evicted
+    @param default_ttl: TTL for policies whose DNS answers do not carry one
+    @param negative_ttl: TTL for domains with no DMARC record
+    @param max_ttl: Upper bound for any cached TTL
+    """
+
+    def __init__(self, max_entries=10000, default_ttl=300, negative_ttl=300, max_ttl=86400):
+        super(PolicyCache, self).__init__(max_entries, max_ttl)
+        self.default_ttl = default_ttl
+        self.negative_ttl = negative_ttl
+
+    def lookup(self, key):
+        """Return the cached DMARCPolicy for a key, or None."""
+        return self.get(key)[1]
+
+    def store(self, key, policy):
+        """Cache a DMARCPolicy for its TTL."""
+        if policy.ttl is not None:
+            ttl = policy.ttl
+        elif policy.record:
+            ttl = self.default_ttl
+        else:
+            ttl = self.negative_ttl
+        self.put(key, policy, ttl)
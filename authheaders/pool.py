@@ -0,0 +1,181 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""Process pool running authenticate_message with warm per-worker state.
+
+DKIM and ARC signature verification is CPU bound, so a long lived pool of
+processes is used to spread it over the available cores.  Each worker
+loads the public suffix list index and the PSD registry and creates its DNS,
+DMARC policy, DKIM key and ARC caches once, when it starts, rather than once
+per message.
+"""
+
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from authheaders import authenticate_message
+from authheaders.arccache import ARCCache
+from authheaders.dnscache import DNSCache
+from authheaders.keycache import KeyCache
+from authheaders.message import message_bytes
+from authheaders.policycache import PolicyCache
+from authheaders.psddmarc import get_psd_registry
+from authheaders.psl import get_suffix_index
+
+__all__ = [
+    "VerifierPool",
+    ]
+
+# The worker's DNSCache, PolicyCache, KeyCache and ARCCache, set up by
+# _init_worker
+_dnsfunc = None
+_policy_cache = None
+_key_cache = None
+_arc_cache = None
+
+
+def _init_worker(dnsfunc, dns_cache_size):
+    global _dnsfunc, _policy_cache, _key_cache, _arc_cache
+    get_suffix_index()
+    get_psd_registry().registry()
+    _dnsfunc = DNSCache(dnsfunc, max_entries=dns_cache_size)
+    _policy_cache = PolicyCache(max_entries=dns_cache_size)
+    _key_cache = KeyCache(max_entries=dns_cache_size)
+    _arc_cache = ARCCache(max_entries=dns_cache_size)
+
+
+def _authenticate(msg, authserv_id, kwargs):
+    return authenticate_message(msg, authserv_id, dnsfunc=_dnsfunc, policy_cache=_policy_cache, key_cache=_key_cache, arc_cache=_arc_cache, **kwargs)
+
+
+class VerifierPool(object):
+    """A pool of processes for authenticate_message.
+
+    Use it as a context manager, or call close() when done.  submit() blocks
+    while max_pending messages are already queued or running, so a producer
+    can't get arbitrarily far ahead of the workers.
+
+    @param max_workers: Number of worker processes (default os.cpu_count())
+    @param max_pending: Number of messages queued or running before submit
+    blocks (default twice max_workers)
+    @param timeout: Default seconds to wait for each result, None for no
+    limit.  It is also each message's authenticate_message timeout, so a
+    task still running when the wait times out soon stops too
+    @param dnsfunc: An optional dns lookup function for the workers to wrap
+    in their DNSCache.  It must be picklable unless the pool forks
+    @param dns_cache_size: max_entries of each worker's DNSCache,
+    PolicyCache, KeyCache and ARCCache
+    @param mp_context: An optional multiprocessing context for the pool
+    """
+
+    def __init__(self, max_workers=None, max_pending=None, timeout=None, dnsfunc=None, dns_cache_size=10000, mp_context=None):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        if max_pending is None:
+            max_pending = 2 * max_workers
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = set()
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context,
+                                            initializer=_init_worker, initargs=(dnsfunc, dns_cache_size))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, msg, authserv_id, **kwargs):
+        """Queue a message for authentication, blocking while the pool is
+        full.  Takes the arguments of authenticate_message other than dnsfunc,
+        policy_cache, key_cache and arc_cache.  A streamed message (file
+        object, mmap or iterable of bytes) is read whole to send it to a
+        worker.  The timeout of authenticate_message defaults to the pool's.
+        @return: A concurrent.futures.Future of the Authentication-Results header
+        """
+        if self.timeout is not None:
+            kwargs.setdefault('timeout', self.timeout)
+        # Only the message bytes are sent to the worker
+        msg = message_bytes(msg)
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(_authenticate, msg, authserv_id, kwargs)
+        except BaseException:
+            self.slots.release()
+            raise
+        self.futures.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        self.futures.discard(future)
+        self.slots.release()
+
+    def result(self, future, timeout=None):
+        """Wait for a result from submit.  A task that times out is cancelled
+        if it has not started yet; a running one stops once its
+        authenticate_message timeout (see submit) is spent, with temperror
+        for the checks still needing DNS.  CPU bound work is not interrupted.
+        @raises: concurrent.futures.TimeoutError
+        """
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def authenticate(self, msg, authserv_id, timeout=None, **kwargs):
+        """authenticate_message, run in the pool.  timeout is also the
+        authenticate_message timeout.
+        @return: The Authentication-Results header
+        @raises: concurrent.futures.TimeoutError
+        """
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        return self.result(self.submit(msg, authserv_id, **kwargs), timeout)
+
+    def map(self, messages, authserv_id, timeout=None, **kwargs):
+        """Authenticate each message, yielding the Authentication-Results
+        headers in order.  At most max_pending messages are in flight.
+        timeout is also each message's authenticate_message timeout.
+        @raises: concurrent.futures.TimeoutError
+        """
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+        futures = deque()
+        try:
+            for msg in messages:
+                # Don't block in submit with finished results ready to yield
+                while futures and futures[0].done():
+                    yield self.result(futures.popleft(), timeout)
+                futures.append(self.submit(msg, authserv_id, **kwargs))
+            while futures:
+                yield self.result(futures.popleft(), timeout)
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def close(self, wait=True):
+        """Shut down the worker processes, cancelling queued messages."""
+        for future in list(self.futures):
+            future.cancel()
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,136 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""In memory copy of the psddmarc.org PSD DMARC participant registry."""
+
+import importlib.resources
+import os
+import threading
+import time
+from authheaders.dmarc_lookup import dns_query
+from authheaders.dnscache import TTLCache
+
+__all__ = [
+    "PSDRegistry",
+    "get_psd_registry",
+    ]
+
+PSD_LIST_HOST = '.psddmarc.org'
+
+
+def registry_location():
+    """Return the location of the locally installed registry copy."""
+    return importlib.resources.files('authheaders') / 'psddmarc.csv'
+
+
+class PSDRegistry(object):
+    """The PSD DMARC registry, parsed once and held as a frozenset.
+
+    The local psddmarc.csv is re-read whenever its mtime changes (checked at
+    most once per check_interval seconds).  If it is not available, the
+    psddmarc.org DNS list is queried instead.  Answers from the default
+    resolver, also through the package's dnsfunc wrappers, are cached for
+    dns_ttl seconds, with at most max_dns_entries names remembered.  Answers
+    from any other dnsfunc are not cached here: it is asked every time, and
+    caches them itself if it should (as a DNSCache does).
+    """
+
+    def __init__(self, location=None, check_interval=1.0, dns_ttl=3600, max_dns_entries=1024):
+        self.location = location
+        self.check_interval = check_interval
+        self.dns_ttl = dns_ttl
+        self.max_dns_entries = max_dns_entries
+        self.psds = None
+        self.mtime = None
+        self.next_check = 0
+        self.dns_cache = TTLCache(max_dns_entries)
+        self.lock = threading.Lock()
+
+    def _stat(self):
+        location = self.location or registry_location()
+        try:
+            return location, os.stat(location).st_mtime
+        except (OSError, TypeError):
+            return location, None
+
+    def _parse(self, location):
+        psds = set()
+        with open(location) as psd_file:
+            for line in psd_file:
+                sp = line.split(',')
+                if sp[1] == 'current':
+                    psds.add(sp[0][1:])
+        return frozenset(psds)
+
+    def registry(self):
+        """Return the frozenset of current PSDs, or None if no usable local
+        registry is installed."""
+        now = time.monotonic()
+        if now < self.next_check:
+            return self.psds
+        with self.lock:
+            self.next_check = now + self.check_interval
+            location, mtime = self._stat()
+            if mtime != self.mtime:
+                self.mtime = mtime
+                try:
+                    self.psds = self._parse(location) if mtime is not None else None
+                except Exception:
+                    self.psds = None
+            return self.psds
+
+    def _check_dns(self, psdname, dnsfunc):
+        # Wrappers (DNSCache, InstrumentedDNS, BudgetedDNS) keep what they
+        # wrap as dnsfunc, None for the default resolver
+        resolver = dnsfunc
+        while resolver is not None and resolver is not dns_query:
+            if not hasattr(resolver, 'dnsfunc'):
+                return bool(dnsfunc(psdname + PSD_LIST_HOST))
+            resolver = resolver.dnsfunc
+        found, listed = self.dns_cache.get(psdname)
+        if not found:
+            listed = bool(dnsfunc(psdname + PSD_LIST_HOST))
+            self.dns_cache.put(psdname, listed, self.dns_ttl)
+        return listed
+
+    def check(self, psdname, dnsfunc=dns_query):
+        """Return True if psdname is a registered PSD DMARC participant.
+        @param dnsfunc: dns lookup function for the psddmarc.org list, used
+        when there is no local registry
+        """
+        psds = self.registry()
+        if psds is not None:
+            return psdname in psds
+        return self._check_dns(psdname, dnsfunc or dns_query)
+
+    def clear(self):
+        """Forget the parsed registry and all cached DNS answers."""
+        with self.lock:
+            self.psds = None
+            self.mtime = None
+            self.next_check = 0
+            self.dns_cache.clear()
+
+
+_psd_registry = PSDRegistry()
+
+
+def get_psd_registry():
+    """Return the shared PSDRegistry."""
+    return _psd_registry
@@ -0,0 +1,374 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""Shared, process wide index of the Public Suffix List.
+
+Parsing public_suffix_list.txt is far more expensive than looking a domain
+up in it, so the list is parsed once into a SuffixIndex and reused for every
+organizational domain determination.  Results are also memoized per domain
+(see OrgDomainCache), since most lookups are for a small set of senders.
+
+The index can also be compiled to a binary snapshot (see write_snapshot),
+an open addressing hash table that is used through mmap without being
+parsed at all.  Processes that load the same snapshot share its pages.
+Snapshots are keyed by a digest of the list they were built from: one is
+written next to the embedded list by the pslupdate setup command, and
+otherwise, if $AUTHHEADERS_CACHE_DIR is set, one is compiled into it the
+first time a list is loaded.
+"""
+
+import hashlib
+import importlib.resources
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from authheaders.dnscache import TTLCache
+
+__all__ = [
+    "SuffixIndex",
+    "SuffixSnapshot",
+    "OrgDomainCache",
+    "get_org_domain_cache",
+    "get_suffix_index",
+    "reload_suffix_index",
+    "psl_location",
+    "snapshot_dir",
+    "write_snapshot",
+    ]
+
+SNAPSHOT_MAGIC = b'AHPSL\x00\x00\x01'
+# magic, sha256 of the list text, number of slots, number of rules
+SNAPSHOT_HEADER = struct.Struct('<8s32sII')
+# key hash, key offset, key length (0 for an empty slot), negate
+SNAPSHOT_SLOT = struct.Struct('<QIHBx')
+
+
+class SuffixIndex(object):
+    """Hash index of Public Suffix List rules keyed by reversed labels.
+
+    Each rule is stored as a tuple of labels, TLD first, mapped to 1 for an
+    exception (!) rule and 0 otherwise.  Every shorter prefix of a rule is
+    also present (as 0 unless it is itself an exception rule), which mirrors
+    the trie built by publicsuffix2 so that lookups give identical answers.
+    """
+
+    def __init__(self, lines, idna=True):
+        self.rules = {}
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith('//'):
+                continue
+            if idna:
+                line = line.encode('idna').decode()
+            self.add_rule(line.split()[0].lstrip('.'))
+
+    @classmethod
+    def from_file(cls, location):
+        """Build an index from a public suffix list file."""
+        with open(location, encoding='utf-8') as suffix_list:
+            return cls(suffix_list)
+
+    def add_rule(self, rule):
+        if rule.startswith('!'):
+            negate = 1
+            rule = rule[1:]
+        else:
+            negate = 0
+        labels = tuple(reversed(rule.split('.')))
+        for depth in range(1, len(labels)):
+            self.rules.setdefault(labels[:depth], 0)
+        self.rules[labels] = negate
+
+    def get_tld(self, domain, strict=False):
+        """Return the public suffix of domain, following wildcards.  If strict,
+        return None when the top label is not a listed TLD."""
+        if not domain:
+            return None
+        parts = domain.lower().strip('.').split('.')
+        if strict and (parts[-1],) not in self.rules:
+            return None
+        hits = [None] * len(parts)
+        hits[-1] = 0
+        # Candidate rule paths at the current depth, in the order a depth
+        # first trie traversal would visit them (wildcard before label).
+        paths = [()]
+        for depth in range(1, len(parts) + 1):
+            label = parts[-depth]
+            matched = []
+            for path in paths:
+                for name in ('*', label):
+                    key = path + (name,)
+                    negate = self.rules.get(key)
+                    if negate is not None:
+                        hits[-depth] = negate
+                        matched.append(key)
+            if not matched:
+                break
+            paths = matched
+        for i, what in enumerate(hits):
+            if what == 0:
+                return '.'.join(parts[i:])
+
+    def get_org_domain(self, domain):
+        """Return the organizational (registrable) domain for domain."""
+        if not domain:
+            return None
+        tld = self.get_tld(domain, strict=True)
+        parts = domain.lower().strip('.').split('.')
+        num_of_tld_parts = 0 if tld is None else tld.count('.') + 1
+        if len(parts) <= num_of_tld_parts:
+            return tld
+        return '.'.join(parts[-(num_of_tld_parts + 1):])
+
+
+def _key_hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def write_snapshot(index, path, digest):
+    """Compile a SuffixIndex to a snapshot file, replacing path atomically.
+    @param index: the SuffixIndex
+    @param path: the snapshot file to write
+    @param digest: sha256 digest of the list text the index was built from
+    """
+    nslots = 1
+    while nslots < 2 * len(index.rules):
+        nslots *= 2
+    table = bytearray(SNAPSHOT_SLOT.size * nslots)
+    blob = bytearray()
+    base = SNAPSHOT_HEADER.size + len(table)
+    for labels, negate in index.rules.items():
+        key = '.'.join(labels).encode('utf-8')
+        h = _key_hash(key)
+        i = h & (nslots - 1)
+        while SNAPSHOT_SLOT.unpack_from(table, i * SNAPSHOT_SLOT.size)[2]:
+            i = (i + 1) & (nslots - 1)
+        SNAPSHOT_SLOT.pack_into(table, i * SNAPSHOT_SLOT.size, h, base + len(blob), len(key), negate)
+        blob += key
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, digest, nslots, len(index.rules))
+    fd, tmp = tempfile.mkstemp('.tmp', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header + table + blob)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class _SnapshotRules(object):
+    # The rules of a snapshot, looked up like SuffixIndex.rules
+
+    def __init__(self, buf, nslots, count):
+        self.buf = buf
+        self.mask = nslots - 1
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def get(self, labels, default=None):
+        key = '.'.join(labels).encode('utf-8')
+        h = _key_hash(key)
+        i = h & self.mask
+        while True:
+            slot_hash, offset, length, negate = SNAPSHOT_SLOT.unpack_from(
+                self.buf, SNAPSHOT_HEADER.size + i * SNAPSHOT_SLOT.size)
+            if not length:
+                return default
+            if slot_hash == h and self.buf[offset:offset + length] == key:
+                return negate
+            i = (i + 1) & self.mask
+
+    def __contains__(self, labels):
+        return self.get(labels) is not None
+
+
+class SuffixSnapshot(SuffixIndex):
+    """A SuffixIndex read from a memory mapped snapshot file.
+
+    @param buf: the snapshot (an mmap, or bytes)
+    @param digest: if given, the sha256 digest of the list text the snapshot
+    must have been built from
+    @raises: ValueError if buf is not a snapshot of the expected list
+    """
+
+    def __init__(self, buf, digest=None):
+        if len(buf) < SNAPSHOT_HEADER.size:
+            raise ValueError('not a PSL snapshot')
+        magic, snapshot_digest, nslots, count = SNAPSHOT_HEADER.unpack_from(buf)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('not a PSL snapshot')
+        if digest is not None and snapshot_digest != digest:
+            raise ValueError('PSL snapshot is out of date')
+        if nslots & (nslots - 1) or len(buf) < SNAPSHOT_HEADER.size + nslots * SNAPSHOT_SLOT.size:
+            raise ValueError('PSL snapshot is truncated')
+        self.buf = buf
+        self.digest = snapshot_digest
+        self.rules = _SnapshotRules(buf, nslots, count)
+
+    @classmethod
+    def from_file(cls, location, digest=None):
+        """Map a snapshot file."""
+        with open(location, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(buf, digest)
+        except ValueError:
+            buf.close()
+            raise
+
+
+_suffix_index = None
+_suffix_index_lock = threading.Lock()
+
+
+def psl_location():
+    """Return the configured system PSL location, or None for the embedded
+    copy."""
+    try:
+        from authheaders.findpsl import location
+        return location
+    except ModuleNotFoundError:
+        return None
+
+
+def snapshot_dir():
+    """Return the directory PSL snapshots are compiled into on first use,
+    $AUTHHEADERS_CACHE_DIR, or None if it is not set (or empty), in which
+    case nothing is written."""
+    return os.environ.get('AUTHHEADERS_CACHE_DIR') or None
+
+
+def _open_snapshot(locations, digest):
+    for location in locations:
+        try:
+            return SuffixSnapshot.from_file(location, digest)
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+def _load_suffix_index():
+    location = psl_location()
+    snapshots = []
+    if location:
+        with open(location, 'rb') as suffix_list:
+            data = suffix_list.read()
+    else:
+        package = importlib.resources.files('authheaders')
+        data = (package / 'public_suffix_list.txt').read_bytes()
+        # Written by the pslupdate setup command
+        snapshots.append(str(package / 'public_suffix_list.bin'))
+    digest = hashlib.sha256(data).digest()
+    cache = snapshot_dir()
+    if cache:
+        snapshots.append(os.path.join(cache, 'psl-%s.bin' % digest.hex()[:32]))
+
+    index = _open_snapshot(snapshots, digest)
+    if index is not None:
+        return index
+    index = SuffixIndex(data.decode('utf-8').split('\n'))
+    if cache:
+        try:
+            os.makedirs(cache, exist_ok=True)
+            write_snapshot(index, snapshots[-1], digest)
+        except Exception:
+            # Only startup time is lost, the index in memory is used
+            pass
+    return index
+
+
+def get_suffix_index():
+    """Return the shared SuffixIndex, building it on first use."""
+    global _suffix_index
+    index = _suffix_index
+    if index is None:
+        with _suffix_index_lock:
+            if _suffix_index is None:
+                _suffix_index = _load_suffix_index()
+            index = _suffix_index
+    return index
+
+
+def reload_suffix_index():
+    """Re-read the public suffix list and replace the shared SuffixIndex.
+    Memoized organizational domains are dropped.
+
+    Use after the system PSL has been updated in a long running process.
+    """
+    global _suffix_index
+    index = _load_suffix_index()
+    with _suffix_index_lock:
+        _suffix_index = index
+    _org_domain_cache.clear()
+    return index
+
+
+class OrgDomainCache(TTLCache):
+    """LRU bounded memo of organizational domains from the shared
+    SuffixIndex.
+
+    Entries are dropped whenever the shared index is replaced (see
+    reload_suffix_index), so answers always come from the current list.
+
+    @param max_entries: Number of domains kept before the least recently
+    used one is evicted
+    """
+
+    def __init__(self, max_entries=10000):
+        super(OrgDomainCache, self).__init__(max_entries)
+        self.index = None
+
+    def get_org_domain(self, domain):
+        """Return the organizational domain for domain."""
+        index = get_suffix_index()
+        if not domain:
+            return index.get_org_domain(domain)
+        with self.lock:
+            if index is not self.index:
+                self.entries.clear()
+                self.index = index
+            found, org_domain = self._get(domain)
+            self._count(found)
+        if found:
+            return org_domain
+        org_domain = index.get_org_domain(domain)
+        with self.lock:
+            if index is self.index:
+                self._put(domain, org_domain)
+        return org_domain
+
+    def clear(self):
+        """Drop all memoized domains and reset the counters."""
+        with self.lock:
+            self.entries.clear()
+            self.index = None
+            self.hits = 0
+            self.misses = 0
+
+
+_org_domain_cache = OrgDomainCache()
+
+
+def get_org_domain_cache():
+    """Return the OrgDomainCache used by dmarc_lookup.get_org_domain."""
+    return _org_domain_cache
@@ -0,0 +1,223 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""Reusable DKIM and ARC signer holding a parsed private key.
+
+dkim.DKIM.sign and dkim.ARC.sign parse the private key on every call, with
+dkim.parse_pem_private_key.  This module replaces that function with one
+remembering the RSA keys it last parsed (the key parsed is the same either
+way), so a Signer hands dkimpy a key that is parsed once, and signing is
+left to dkimpy itself.  ed25519 keys, which are cheap to decode, are decoded
+by dkimpy each time.
+"""
+
+import functools
+import hashlib
+import threading
+from collections import OrderedDict
+import dkim
+from authres import AuthenticationResultsHeader
+from dkim import ARC, DKIM, KeyFormatError, NaClNotFoundError, ParameterError
+from dkim.crypto import HASH_ALGORITHMS, UnparsableKeyError
+from authheaders.message import parse_message
+
+try:
+    import nacl.encoding
+    import nacl.exceptions
+    import nacl.signing
+except ImportError:
+    pass
+
+__all__ = [
+    "Signer",
+    "get_signer",
+    ]
+
+#: Number of signers get_signer keeps, and of parsed RSA keys remembered
+MAX_SIGNERS = 64
+
+_parse_pem_private_key = dkim.parse_pem_private_key
+_parse_pem_private_key_cached = functools.lru_cache(maxsize=MAX_SIGNERS)(_parse_pem_private_key)
+
+
+def parse_pem_private_key(data):
+    """dkim.crypto.parse_pem_private_key, remembering the keys it parsed."""
+    if isinstance(data, bytes):
+        return _parse_pem_private_key_cached(data)
+    return _parse_pem_private_key(data)
+
+
+# Used by dkim.DKIM.sign and dkim.ARC.sign
+dkim.parse_pem_private_key = parse_pem_private_key
+
+
+def parse_private_key(privkey, signature_algorithm=b'rsa-sha256'):
+    """Parse a private key as dkim's sign methods do.
+    @raises: KeyFormatError if the key can't be parsed
+    """
+    if signature_algorithm == b'ed25519-sha256':
+        try:
+            return nacl.signing.SigningKey(privkey, encoder=nacl.encoding.Base64Encoder)
+        except NameError:
+            raise NaClNotFoundError('pynacl module required for ed25519 signing, see README.md')
+        except nacl.exceptions.ValueError:
+            raise KeyFormatError('invalid ed25519 private key or format')
+    try:
+        return parse_pem_private_key(privkey)
+    except UnparsableKeyError as e:
+        raise KeyFormatError(str(e))
+
+
+def _lower_headers(sig_headers):
+    if sig_headers is None:
+        return None
+    return tuple([x.lower() for x in sig_headers])
+
+
+def _load(signer, parsed):
+    # The message's headers and body, without parsing it again
+    signer.headers = list(parsed.headers)
+    signer.body = parsed.body
+    return signer
+
+
+class Signer(object):
+    """Signs messages with one key, selector and domain.
+
+    The key is parsed when the Signer is created, so a bad key raises
+    KeyFormatError then, and is not parsed again to sign.  Signers are safe
+    to share between threads.
+
+    @param selector: the DKIM selector value for the signature
+    @param domain: the DKIM domain value for the signature
+    @param privkey: a PKCS#1 private key in base64-encoded text form
+    @param sig_headers: a list of header names to sign (default for DKIM is
+    dkimpy's recommended headers present in the message)
+    @param signature_algorithm: b'rsa-sha256' (default), b'rsa-sha1' or
+    b'ed25519-sha256' (DKIM only)
+    @raises: KeyFormatError if the key can't be parsed
+    """
+
+    def __init__(self, selector, domain, privkey, sig_headers=None, signature_algorithm=b'rsa-sha256'):
+        if signature_algorithm not in HASH_ALGORITHMS:
+            raise ParameterError("Unsupported signature algorithm: " + str(signature_algorithm))
+        self.selector = selector
+        self.domain = domain
+        self.privkey = privkey
+        self.signature_algorithm = signature_algorithm
+        self.pk = parse_private_key(privkey, signature_algorithm)
+        self.sig_headers = sig_headers
+
+    def dkim_sign(self, msg, identity=None, length=False, canonicalize=(b'relaxed', b'relaxed'), logger=None, tlsrpt=False):
+        """DKIM sign a message with dkim.DKIM.sign.
+        @param msg: an RFC822 formatted message or a ParsedMessage
+        @param tlsrpt: the message is an RFC 8460 TLS report, as for dkim.DKIM
+        @return: The DKIM-Signature header field
+        """
+        d = _load(DKIM(logger=logger, signature_algorithm=self.signature_algorithm, tlsrpt=tlsrpt), parse_message(msg))
+        return d.sign(self.selector, self.domain, self.privkey, identity=identity, canonicalize=canonicalize,
+                      include_headers=self.sig_headers, length=length)
+
+    def arc_sign(self, msg, srv_id, timestamp=None, standardize=False, logger=None):
+        """Add an ARC set to a message with dkim.ARC.sign.
+        @param msg: an RFC822 formatted message or a ParsedMessage
+        @param srv_id: an authserv_id to identify AR headers to sign
+        @param timestamp: (for ARC testing) a manual timestamp to use for ARC signature generation
+        @param standardize: A testing flag for arc to output a standardized header format
+        @return: The ARC set header fields
+        """
+        return self._arc_sign(_load(ARC(logger=logger), parse_message(msg)), srv_id, timestamp, standardize)
+
+    def arc_seal(self, msg, srv_id, results, timestamp=None, standardize=False, logger=None):
+        """Add an ARC set to a message given the results of authenticating it,
+        as arc_sign would once an Authentication-Results header field with
+        them was added to the message.
+        @param msg: an RFC822 formatted message or a ParsedMessage
+        @param srv_id: the authserv_id of the results
+        @param results: a list of authres results, such as those of the
+        AuthenticationResultsHeader authenticate_message makes.  The chain
+        validation status is its arc result
+        @return: The ARC set header fields
+        """
+        a = _load(ARC(logger=logger), parse_message(msg))
+        header = AuthenticationResultsHeader(authserv_id=srv_id.decode('utf-8'), results=results)
+        value = str(header).encode('utf-8').split(b':', 1)[1]
+        a.headers.insert(0, [b'Authentication-Results', value + b'\r\n'])
+        return self._arc_sign(a, srv_id, timestamp, standardize)
+
+    def _arc_sign(self, a, srv_id, timestamp=None, standardize=False):
+        return a.sign(self.selector, self.domain, self.privkey, srv_id, include_headers=self.sig_headers,
+                      timestamp=timestamp, standardize=standardize)
+
+    def dkim_arc_sign(self, msg, srv_id, identity=None, length=False, canonicalize=(b'relaxed', b'relaxed'),
+                      timestamp=None, standardize=False, logger=None, tlsrpt=False):
+        """DKIM sign a message, then add an ARC set covering the new
+        DKIM-Signature, as dkim_sign followed by arc_sign would, with the
+        message parsed once.
+        @param msg: an RFC822 formatted message or a ParsedMessage
+        @param srv_id: an authserv_id to identify AR headers to sign
+        @return: The ARC set header fields followed by the DKIM-Signature
+        """
+        parsed = parse_message(msg)
+        dkim_header = self.dkim_sign(parsed, identity, length, canonicalize, logger, tlsrpt)
+        a = _load(ARC(logger=logger), parsed)
+        a.headers.insert(0, [b'DKIM-Signature', dkim_header[len(b'DKIM-Signature:'):]])
+        return self._arc_sign(a, srv_id, timestamp, standardize) + [dkim_header]
+
+    def sign(self, msg, sig='DKIM', srv_id=None, identity=None, length=None,
+             canonicalize=(b'relaxed', b'relaxed'), timestamp=None, logger=None,
+             standardize=False, tlsrpt=False):
+        """Sign a message and return the ARC or DKIM header(s).  Takes the
+        arguments of sign_message other than the key, selector, domain and
+        sig_headers, and tlsrpt (DKIM only), as for dkim.DKIM."""
+        if sig == "DKIM":
+            return self.dkim_sign(msg, identity=identity, length=length, canonicalize=canonicalize, logger=logger, tlsrpt=tlsrpt)
+        elif sig == "DKIM+ARC":
+            return self.dkim_arc_sign(msg, srv_id, identity=identity, length=length, canonicalize=canonicalize, timestamp=timestamp, standardize=standardize, logger=logger, tlsrpt=tlsrpt)
+        else:
+            return self.arc_sign(msg, srv_id, timestamp=timestamp, standardize=standardize, logger=logger)
+
+
+# Signers made by get_signer, most recently used last
+_signers = OrderedDict()
+_signers_lock = threading.Lock()
+
+
+def key_fingerprint(privkey):
+    """SHA-256 digest of a private key, to key signers by."""
+    if not isinstance(privkey, bytes):
+        privkey = privkey.encode('utf-8')
+    return hashlib.sha256(privkey).digest()
+
+
+def get_signer(selector, domain, privkey, sig_headers=None, signature_algorithm=b'rsa-sha256'):
+    """Return a shared Signer for a selector, domain and key, creating it
+    (and parsing the key) only the first time it is asked for."""
+    key = (selector, domain, key_fingerprint(privkey), _lower_headers(sig_headers), signature_algorithm)
+    with _signers_lock:
+        signer = _signers.get(key)
+        if signer is not None:
+            _signers.move_to_end(key)
+            return signer
+    signer = Signer(selector, domain, privkey, sig_headers, signature_algorithm)
+    with _signers_lock:
+        _signers[key] = signer
+        while len(_signers) > MAX_SIGNERS:
+            _signers.popitem(last=False)
+    return signer
@@ -0,0 +1,288 @@
+# This software is provided 'as-is', without any express or implied
+# warranty.  In no event will the author be held liable for any damages
+# arising from the use of this software.
+#
+# Permission is granted to anyone to use this software for any purpose,
+# including commercial applications, and to alter it and redistribute it
+# freely, subject to the following restrictions:
+#
+# 1. The origin of this software must not be misrepresented; you must not
+#    claim that you wrote the original software. If you use this software
+#    in a product, an acknowledgment in the product documentation would be
+#    appreciated but is not required.
+# 2. Altered source versions must be plainly marked as such, and must not be
+#    misrepresented as being the original software.
+# 3. This notice may not be removed or altered from any source distribution.
+#
+# Copyright (c) 2017 Valimail Inc
+# Contact: Gene Shuman <gene@valimail.com>
+#
+"""Offline benchmark of the authentication and signing hot paths.
+
+A corpus of messages is generated from a fixed seed, varying the body size,
+the number of DKIM signatures, the ARC chain length and the number of From
+addresses, and signed with the test key.  DNS is answered by a FakeResolver
+with a configurable per query latency, so runs need no network and are
+repeatable.  For each scenario, messages/sec, p50/p99 latency and peak
+(Python) memory are reported:
+
+  $ python authheaders/test/benchmark.py --messages 500 --latency 1
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from authheaders import authenticate_message, sign_message
+from authheaders.dnscache import DNSCache
+from authheaders.keycache import KeyCache
+from authheaders.psddmarc import get_psd_registry
+
+SCENARIOS = ['dkim', 'arc', 'dmarc', 'dmarcbis', 'psd', 'sign', 'arc-sign']
+
+#: The PSD used by the psd scenario, and its registry entry
+PSD = 'gov'
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+def read_test_data(filename):
+    with open(os.path.join(os.path.dirname(__file__), filename), 'rb') as f:
+        return f.read()
+
+
+class FakeResolver(object):
+    """dnsfunc answering from a dict of (name, qtype) to answer, after
+    sleeping for latency seconds.  Unknown names are answered with None.
+
+    @param records: dict of (name, qtype) to answer, names without the
+    trailing dot
+    @param latency: seconds each query takes
+    """
+
+    def __init__(self, records, latency=0.0):
+        self.records = records
+        self.latency = latency
+        self.queries = 0
+
+    def __call__(self, name, qtype='TXT', timeout=5):
+        self.queries += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if isinstance(name, bytes):
+            name = name.decode('ascii', 'replace')
+        return self.records.get((name.rstrip('.').lower(), qtype.upper()))
+
+
+class Corpus(object):
+    """Generated messages and the DNS records needed to check them.
+
+    @param count: number of messages
+    @param sizes: body sizes in bytes to choose from
+    @param signatures: numbers of DKIM signatures to choose from
+    @param arc_hops: ARC chain lengths to choose from
+    @param from_counts: numbers of From addresses to choose from
+    @param domains: number of distinct sending organizations
+    @param seed: random seed, so a corpus is the same from run to run
+    """
+
+    def __init__(self, count=200, sizes=(1024, 16384, 262144), signatures=(0, 1, 2),
+                 arc_hops=(0, 1, 3), from_counts=(1, 1, 1, 2), domains=20, seed=1):
+        self.rand = random.Random(seed)
+        self.key = read_test_data('test.private')
+        self.key_record = read_test_data('test.txt').strip()
+        self.records = {}
+        self.domains = []
+        for i in range(domains):
+            domain = 'org{0}.{1}'.format(i, PSD)
+            self.domains.append(domain)
+            # Every third organization relies on the PSD record, the rest
+            # publish their own (with sp/np on some)
+            if i % 3 == 0:
+                continue
+            record = 'v=DMARC1; p={0}'.format(('reject', 'quarantine', 'none')[i % 3])
+            if i % 2:
+                record += '; sp=quarantine; np=reject'
+            self.records[('_dmarc.' + domain, 'TXT')] = record
+            self.records[('mail.' + domain, 'A')] = '192.0.2.1'
+        self.records[('_dmarc.' + PSD, 'TXT')] = 'v=DMARC1; p=reject; psd=y'
+        self.messages = [self._message(i, self.rand.choice(sizes), self.rand.choice(signatures),
+                                       self.rand.choice(arc_hops), self.rand.choice(from_counts))
+                         for i in range(count)]
+
+    def _domain(self):
+        domain = self.rand.choice(self.domains)
+        if self.rand.random() < 0.5:
+            domain = self.rand.choice(('mail.', 'nx.')) + domain
+        return domain
+
+    def _key(self, selector, domain):
+        self.records[('{0}._domainkey.{1}'.format(selector, domain), 'TXT')] = self.key_record
+        return selector.encode(), domain.encode()
+
+    def _body(self, size):
+        lines = []
+        length = 0
+        while length < size:
+            line = ' '.join(self.rand.choice(WORDS) for _ in range(self.rand.randint(3, 14)))
+            lines.append(line)
+            length += len(line) + 2
+        return '\r\n'.join(lines).encode() + b'\r\n'
+
+    def _message(self, n, size, signatures, arc_hops, from_count):
+        from_domains = [self._domain() for _ in range(from_count)]
+        froms = ', '.join('Sender {0} <s{0}@{1}>'.format(i, domain) for i, domain in enumerate(from_domains))
+        headers = ('From: {0}\r\nTo: rcpt@example.net\r\nSubject: benchmark message {1}\r\n'
+                   'Date: Mon, 1 Jan 2024 00:00:00 +0000\r\nMessage-ID: <{1}@bench.example>\r\n'
+                   'MIME-Version: 1.0\r\n').format(froms, n).encode()
+        msg = headers + b'\r\n' + self._body(size)
+        for i in range(signatures):
+            # The top (checked) signature is usually by the author domain
+            if i == signatures - 1 and self.rand.random() < 0.8:
+                domain = from_domains[0]
+            else:
+                domain = self._domain()
+            selector, domain = self._key('s{0}'.format(i), domain)
+            msg = sign_message(msg, selector, domain, self.key, [b'from', b'to', b'subject', b'date']) + msg
+        for i in range(arc_hops):
+            srv_id = 'hop{0}.example.net'.format(i)
+            selector, domain = self._key('arc', srv_id)
+            msg = 'Authentication-Results: {0}; arc={1}\r\n'.format(srv_id, 'pass' if i else 'none').encode() + msg
+            msg = b''.join(sign_message(msg, selector, domain, self.key, [b'from', b'to', b'subject'], sig='ARC', srv_id=srv_id.encode())) + msg
+        return msg
+
+
+def _scenario(name, corpus, dnsfunc, key_cache=None):
+    # A function of a message for each scenario
+    if name == 'dkim':
+        return lambda msg: authenticate_message(msg, 'bench.example', dmarc=False, dnsfunc=dnsfunc, key_cache=key_cache)
+    if name == 'arc':
+        return lambda msg: authenticate_message(msg, 'bench.example', dkim=False, arc=True, dmarc=False, dnsfunc=dnsfunc, key_cache=key_cache)
+    if name == 'dmarc':
+        return lambda msg: authenticate_message(msg, 'bench.example', dnsfunc=dnsfunc, key_cache=key_cache)
+    if name == 'dmarcbis':
+        return lambda msg: authenticate_message(msg, 'bench.example', dnsfunc=dnsfunc, dmarcbis=True, key_cache=key_cache)
+    if name == 'psd':
+        return lambda msg: authenticate_message(msg, 'bench.example', dnsfunc=dnsfunc, psddmarc=True, key_cache=key_cache)
+    if name == 'sign':
+        return lambda msg: sign_message(msg, b'sign', b'bench.example', corpus.key, [b'from', b'to', b'subject', b'date'])
+    if name == 'arc-sign':
+        def arc_sign(msg):
+            msg = b'Authentication-Results: bench.example; arc=none\r\n' + msg
+            return sign_message(msg, b'sign', b'bench.example', corpus.key, [b'from', b'to', b'subject'], sig='ARC', srv_id=b'bench.example')
+        return arc_sign
+    raise ValueError('unknown scenario: {0}'.format(name))
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(corpus, scenarios=SCENARIOS, latency=0.0, cache=False, memory=True):
+    """Run each scenario over the corpus.
+    @param corpus: a Corpus
+    @param scenarios: names of the scenarios to run (see SCENARIOS)
+    @param latency: seconds each DNS query takes
+    @param cache: wrap the resolver in a DNSCache, and use a KeyCache (both
+    shared by a scenario's messages)
+    @param memory: also measure peak memory, in a second pass with
+    tracemalloc running
+    @return: A list of dicts of results, one per scenario
+    """
+    registry = get_psd_registry()
+    location = registry.location
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as psd_file:
+        psd_file.write('.{0},current,bench\n'.format(PSD))
+    registry.location = psd_file.name
+    registry.clear()
+    try:
+        results = []
+        for name in scenarios:
+            resolver = FakeResolver(corpus.records, latency)
+            dnsfunc = DNSCache(resolver) if cache else resolver
+            check = _scenario(name, corpus, dnsfunc, KeyCache() if cache else None)
+            latencies = []
+            start = time.perf_counter()
+            for msg in corpus.messages:
+                t = time.perf_counter()
+                check(msg)
+                latencies.append(time.perf_counter() - t)
+            elapsed = time.perf_counter() - start
+            result = {
+                'scenario': name,
+                'messages': len(corpus.messages),
+                'msgs_per_sec': len(corpus.messages) / elapsed,
+                'p50_ms': _percentile(latencies, 0.5) * 1000,
+                'p99_ms': _percentile(latencies, 0.99) * 1000,
+                'dns_queries': resolver.queries,
+                'peak_mem_kb': None,
+            }
+            if memory:
+                tracemalloc.start()
+                try:
+                    for msg in corpus.messages:
+                        check(msg)
+                    result['peak_mem_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+                finally:
+                    tracemalloc.stop()
+            results.append(result)
+        return results
+    finally:
+        registry.location = location
+        registry.clear()
+        os.unlink(psd_file.name)
+
+
+def _ints(value):
+    return tuple(int(x) for x in value.split(','))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark authheaders offline.')
+    parser.add_argument('-n', '--messages', type=int, default=200,
+                        help='Number of messages in the corpus')
+    parser.add_argument('--sizes', type=_ints, default=(1024, 16384, 262144),
+                        help='Comma separated body sizes (bytes)')
+    parser.add_argument('--signatures', type=_ints, default=(0, 1, 2),
+                        help='Comma separated DKIM signature counts')
+    parser.add_argument('--arc', type=_ints, default=(0, 1, 3),
+                        help='Comma separated ARC chain lengths')
+    parser.add_argument('--from', dest='from_counts', type=_ints, default=(1, 1, 1, 2),
+                        help='Comma separated From address counts')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Fake DNS latency per query (milliseconds)')
+    parser.add_argument('--cache', action='store_true',
+                        help='Wrap the fake resolver in a DNSCache and cache parsed DKIM keys')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip the peak memory pass')
+    parser.add_argument('-s', '--scenario', action='append', choices=SCENARIOS,
+                        help='Scenario to run (repeatable, default all)')
+    parser.add_argument('--json', action='store_true',
+                        help='Write results as JSON lines')
+    args = parser.parse_args()
+
+    corpus = Corpus(args.messages, args.sizes, args.signatures, args.arc, args.from_counts, seed=args.seed)
+    results = run(corpus, args.scenario or SCENARIOS, args.latency / 1000, args.cache, not args.no_memory)
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+        return
+    print('python {0}, {1} messages, {2} ms DNS latency'.format(
+        sys.version.split()[0], len(corpus.messages), args.latency))
+    print('{0:<10} {1:>10} {2:>9} {3:>9} {4:>8} {5:>12}'.format('scenario', 'msgs/sec', 'p50 ms', 'p99 ms', 'queries', 'peak mem kB'))
+    for r in results:
+        print('{0:<10} {1:>10.1f} {2:>9.2f} {3:>9.2f} {4:>8} {5:>12}'.format(
+            r['scenario'], r['msgs_per_sec'], r['p50_ms'], r['p99_ms'], r['dns_queries'],
+            '-' if r['peak_mem_kb'] is None else '{0:.0f}'.format(r['peak_mem_kb'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -21,9 +21,14 @@
 
 import unittest
 import doctest
+import hashlib
+import inspect
 import sys
 import os
-from authheaders import authenticate_message, sign_message, get_domain_part, dmarc_lookup
+import tempfile
+import time
+import authheaders
+from authheaders import authenticate_message, sign_message, get_domain_part, dmarc_lookup, psl, psddmarc, dnscache, message
 
 #import logging
 #logging.basicConfig(level=10)
@@ -81,6 +86,8 @@ Y+vtSBczUiKERHv1yRbcaQtZFh5wtiRrN04BLUTD21MycBX5jYchHjPY/wIDAQAB""",
           "_dmarc.gov": "v=DMARC1; p=reject; sp=none; np=reject; rua=mailto:dotgov_dmarc@cisa.dhs.gov; psd=y",
           "_dmarc.example.gov": "",
           "example.gov": "",
+          "gov.psddmarc.org": "127.0.0.2",
+          "example.gov.psddmarc.org": None,
         }
         try:
             if isinstance(domain, bytes):
@@ -111,6 +118,88 @@ Y+vtSBczUiKERHv1yRbcaQtZFh5wtiRrN04BLUTD21MycBX5jYchHjPY/wIDAQAB""",
         res = authenticate_message(self.message12, "example.com", dkim=False, spf=False, dnsfunc=self.dnsfunc, dmarcbis=True)
         self.assertEqual(res, 'Authentication-Results: example.com; dmarc=fail (Used Tree Walk, org one level below PSD) header.from=example.gov policy.dmarc=reject')
 
+    def test_authenticate_dmarc_psdsub_parallel(self):
+        res = authenticate_message(self.message12, "example.com", dkim=False, spf=False, dnsfunc=self.dnsfunc, dmarcbis=True, parallel_walk=True)
+        self.assertEqual(res, 'Authentication-Results: example.com; dmarc=fail (Used Tree Walk, org one level below PSD) header.from=example.gov policy.dmarc=reject')
+
+    def test_authenticate_psd_dns_cache(self):
+        expected = ('Authentication-Results: example.com; dmarc=fail (Used Public Suffix Domain Record) header.from=example.gov policy.dmarc=reject',
+                    'Authentication-Results: example.com; dmarc=fail (Used Tree Walk, org one level below PSD) header.from=example.gov policy.dmarc=reject')
+        for kwargs, result in zip(({'psddmarc': True}, {'dmarcbis': True}), expected):
+            cache = dnscache.DNSCache(self.dnsfunc)
+            for _ in range(2):
+                res = authenticate_message(self.message12, "example.com", dkim=False, dnsfunc=cache, **kwargs)
+                self.assertEqual(res, result)
+
+    def test_receiver_record_walk_parallel(self):
+        from concurrent.futures import ThreadPoolExecutor
+        def dnsfunc(domain):
+            time.sleep(0.05)
+            return {'_dmarc.c.example.com': 'v=DMARC1; p=none',
+                    '_dmarc.example.com': 'v=DMARC1; p=reject; psd=n'}.get(domain)
+        expected = dmarc_lookup.receiver_record_walk('a.b.c.example.com', dnsfunc=dnsfunc)
+        start = time.time()
+        res = dmarc_lookup.receiver_record_walk('a.b.c.example.com', dnsfunc=dnsfunc, parallel=True)
+        self.assertLess(time.time() - start, 0.2)
+        self.assertEqual(list(res.items()), list(expected.items()))
+        self.assertEqual(list(res), ['c.example.com', 'example.com'])
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            res = dmarc_lookup.receiver_record_walk('a.b.c.example.com', dnsfunc=dnsfunc, parallel=True, executor=executor)
+        self.assertEqual(list(res.items()), list(expected.items()))
+
+    def test_dmarcbis_short_circuit(self):
+        queries = []
+        def dnsfunc(domain):
+            queries.append(domain)
+            return {'_dmarc.mail.example.com': 'v=DMARC1; p=reject; psd=n'}.get(domain)
+        res = authheaders.dmarc_per_from('mail.example.com', dnsfunc=dnsfunc, dmarcbis=True, policy_only=True)
+        self.assertEqual(res[:4], ['mail.example.com', 'mail.example.com', 'Used Tree Walk Record which is PSD=n', 'reject'])
+        # The walk stops at the psd=n record, once it is known not to be
+        # a listed PSD
+        self.assertEqual(queries, ['_dmarc.mail.example.com', 'mail.example.com.psddmarc.org'])
+
+    def test_dmarcbis_full_walk(self):
+        queries = []
+        def dnsfunc(domain):
+            queries.append(domain)
+            return {'_dmarc.mail.example.com': 'v=DMARC1; p=none',
+                    '_dmarc.example.com': 'v=DMARC1; p=reject'}.get(domain)
+        res = authheaders.dmarc_per_from('mail.example.com', dnsfunc=dnsfunc, dmarcbis=True, policy_only=True)
+        self.assertEqual(res[:4], ['mail.example.com', 'example.com', 'Used Tree Walk Record', 'reject'])
+        self.assertEqual(queries[:3], ['_dmarc.mail.example.com', '_dmarc.example.com', '_dmarc.com'])
+
+    def test_dmarc_policy_find_bulk(self):
+        import io, json
+        from authheaders import dmarcpolicyfind
+        def dnsfunc(domain, qtype='TXT', timeout=5):
+            return {'_dmarc.example.com': 'v=DMARC1; p=reject',
+                    '_dmarc.example.net': 'v=DMARC1; p=none; sp=quarantine',
+                    '_dmarc.bad.example.com': 'v=DMARC1; p=none; reject',
+                    '_dmarc.gov': 'v=DMARC1; p=reject; sp=none; np=reject; psd=y',
+                    'gov.psddmarc.org': '127.0.0.2'}.get(domain)
+        domains = list(dmarcpolicyfind.read_domains(['example.com', '', '# comment', 'sub.example.net', 'bad.example.com', 'example.org', 'example.gov']))
+        results = list(dmarcpolicyfind.find_policies(domains, dnsfunc=dnsfunc, jobs=2))
+        common = [['example.com', 'example.com', 'Used From Domain Record', 'reject'],
+                  ['sub.example.net', 'example.net', 'Used Org Domain Record', 'quarantine'],
+                  ['bad.example.com', None, 'Error: missing tag or value: "v=DMARC1; p=none; reject"', None],
+                  ['example.org', None, 'None', '']]
+        self.assertEqual([res[:4] for res in results], common + [['example.gov', None, 'None', '']])
+        # Each --select mode, with the DNSCache the command line tool uses
+        expected = {'DMARC': common + [['example.gov', None, 'None', '']],
+                    'PSD': common + [['example.gov', 'gov', 'Used Public Suffix Domain Record', 'reject']],
+                    'DMARCbis': common[:1] + [['sub.example.net', 'example.net', 'Used Tree Walk Record', 'quarantine']] + common[2:] +
+                                [['example.gov', 'gov', 'Used Tree Walk, org one level below PSD', 'reject']]}
+        for select, kwargs in (('DMARC', {}), ('PSD', {'psddmarc': True}), ('DMARCbis', {'dmarcbis': True})):
+            cached = dmarcpolicyfind.find_policies(domains, dnsfunc=dnscache.DNSCache(dnsfunc), jobs=2, **kwargs)
+            self.assertEqual([res[:4] for res in cached], expected[select], select)
+        out = io.StringIO()
+        dmarcpolicyfind.write_results(results, out)
+        self.assertEqual(out.getvalue().splitlines()[:2], ['original_from,policydomain,result_comment,policy,record,orgdomain',
+                                                           'example.com,example.com,Used From Domain Record,reject,v=DMARC1; p=reject,example.com'])
+        out = io.StringIO()
+        dmarcpolicyfind.write_results(results, out, 'json')
+        self.assertEqual(json.loads(out.getvalue().splitlines()[1])['record'], {'v': 'DMARC1', 'p': 'none', 'sp': 'quarantine'})
+
     def test_authenticate_dmarc_mult_from(self):
         self.maxDiff = None
         res = authenticate_message(self.message3, "example.com", prev='Authentication-Results: example.com; dkim=fail header.d=example.com header.i=@example.com; dkim=pass header.d=example.org header.i=@example.org', spf=False, dkim=False, dnsfunc=self.dnsfunc)
@@ -136,6 +225,34 @@ Y+vtSBczUiKERHv1yRbcaQtZFh5wtiRrN04BLUTD21MycBX5jYchHjPY/wIDAQAB""",
         res = authenticate_message(self.message7, "example.com", prev='Authentication-Results: example.com; dkim=fail header.d=sub2.example.biz header.i=@sub2.example.biz', spf=False, dkim=False, dnsfunc=self.dnsfunc)
         self.assertEqual(res, "Authentication-Results: example.com; dkim=fail header.d=sub2.example.biz header.i=@sub2.example.biz; dmarc=fail (Used Org Domain Record) header.from=sub2.example.biz policy.dmarc=quarantine")
 
+    def test_authenticate_dmarc_np_txt_dnsfunc(self):
+        # A dnsfunc written for TXT lookups only, as before np= asked for
+        # A, MX and AAAA, is called with the name alone
+        def dnsfunc(domain):
+            return self.dnsfunc(domain)
+        cases = ((self.message6, "sub.example.biz", "reject"), (self.message7, "sub2.example.biz", "quarantine"))
+        for msg, domain, policy in cases:
+            prev = 'Authentication-Results: example.com; dkim=fail header.d=%s header.i=@%s' % (domain, domain)
+            expected = "%s; dmarc=fail (Used Org Domain Record) header.from=%s policy.dmarc=%s" % (prev, domain, policy)
+            for kwargs in ({}, {'metrics': authheaders.MetricsRecorder()}, {'timeout': 5, 'max_dns_queries': 20}):
+                res = authenticate_message(msg, "example.com", prev=prev, spf=False, dkim=False, dnsfunc=dnsfunc, **kwargs)
+                self.assertEqual(res, expected)
+            res = authenticate_message(msg, "example.com", prev=prev, spf=False, dkim=False, dnsfunc=dnscache.DNSCache(dnsfunc))
+            self.assertEqual(res, expected)
+
+    def test_domain_exists(self):
+        queries = []
+        def dnsfunc(domain, qtype):
+            time.sleep(0.05)
+            queries.append((domain, qtype))
+            return {('mx.example.com', 'MX'): 'mail.example.com'}.get((domain, qtype))
+        start = time.time()
+        self.assertFalse(dmarc_lookup.domain_exists('none.example.com', dnsfunc=dnsfunc))
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(sorted(queries), [('none.example.com', 'A'), ('none.example.com', 'AAAA'), ('none.example.com', 'MX')])
+        self.assertTrue(dmarc_lookup.domain_exists('mx.example.com', dnsfunc=dnsfunc))
+        self.assertTrue(dmarc_lookup.domain_exists('mx.example.com', dnsfunc=dnsfunc, parallel=False))
+
     def test_authenticate_dmarc_no_p(self):
         self.maxDiff = None
         res = authenticate_message(self.message9, "example.com", prev='Authentication-Results: example.com; dkim=fail header.d=nop.example.org header.i=@nop.example.org', spf=False, dkim=False, dnsfunc=self.dnsfunc)
@@ -150,6 +267,562 @@ Y+vtSBczUiKERHv1yRbcaQtZFh5wtiRrN04BLUTD21MycBX5jYchHjPY/wIDAQAB""",
         res = authenticate_message(self.message2, "example.com", prev=prev, spf=False, dmarc=False, dnsfunc=self.dnsfunc)
         self.assertEqual(res, "Authentication-Results: example.com; spf=pass smtp.mailfrom=gmail.com; dkim=pass header.d=example.com header.i=@example.com")
 
+    def test_authenticate_dns_cache(self):
+        cache = dnscache.DNSCache(self.dnsfunc)
+        expected = "Authentication-Results: example.com; dkim=pass header.d=example.com header.i=@example.com; dmarc=pass (Used From Domain Record) header.from=example.com policy.dmarc=reject"
+        res = authenticate_message(self.message2, "example.com", spf=False, dnsfunc=cache)
+        self.assertEqual(res, expected)
+        misses = cache.stats()['misses']
+        res = authenticate_message(self.message2, "example.com", spf=False, dnsfunc=cache)
+        self.assertEqual(res, expected)
+        self.assertEqual(cache.stats()['misses'], misses)
+        self.assertEqual(cache.stats()['hits'], misses)
+
+    def test_authenticate_policy_cache(self):
+        queries = []
+        def dnsfunc(domain, timeout=5):
+            queries.append(domain)
+            return self.dnsfunc(domain)
+        cache = authheaders.PolicyCache()
+        prev = 'Authentication-Results: example.com; dkim=fail header.d=sub2.example.biz header.i=@sub2.example.biz'
+        for msg, kwargs in ((self.message2, {}), (self.message7, {'prev': prev}), (self.message12, {'dmarcbis': True})):
+            expected = authenticate_message(msg, "example.com", dkim=False, dnsfunc=self.dnsfunc, **kwargs)
+            self.assertEqual(authenticate_message(msg, "example.com", dkim=False, dnsfunc=dnsfunc, policy_cache=cache, **kwargs), expected)
+            del queries[:]
+            self.assertEqual(authenticate_message(msg, "example.com", dkim=False, dnsfunc=dnsfunc, policy_cache=cache, **kwargs), expected)
+            self.assertEqual(queries, [])
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 3, 'entries': 3, 'hit_rate': 0.5})
+
+    def test_authenticate_metrics(self):
+        from concurrent.futures import ThreadPoolExecutor
+        metrics = authheaders.MetricsRecorder()
+        cache = dnscache.DNSCache(self.dnsfunc)
+        policies = authheaders.PolicyCache()
+        expected = authenticate_message(self.message2, "example.com", arc=True, dnsfunc=self.dnsfunc)
+        for _ in range(2):
+            res = authenticate_message(self.message2, "example.com", arc=True, dnsfunc=cache, policy_cache=policies, metrics=metrics)
+            self.assertEqual(res, expected)
+        self.assertEqual(set(metrics.timings), {'authenticate_message', 'parse', 'dkim', 'arc', 'dmarc', 'dmarc.discovery', 'dns'})
+        self.assertEqual(metrics.timings['authenticate_message'][0], 2)
+        self.assertEqual(metrics.counters['dns.queries'], metrics.timings['dns'][0])
+        self.assertEqual(metrics.counters['dns.cache.hits'] + metrics.counters['dns.cache.misses'], metrics.counters['dns.queries'])
+        self.assertEqual(metrics.counters['dmarc.policy_cache.hits'], 1)
+        self.assertEqual(metrics.counters['dmarc.policy_cache.misses'], 1)
+
+        metrics = authheaders.MetricsRecorder()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            res = authenticate_message(self.message7, "example.com", dnsfunc=self.dnsfunc, executor=executor, metrics=metrics)
+        self.assertEqual(res, authenticate_message(self.message7, "example.com", dnsfunc=self.dnsfunc))
+        # The existence probe stops at the first answer, so the count varies
+        self.assertGreaterEqual(metrics.counters['dns.queries'], 3)
+        self.assertEqual(metrics.timings['dkim'][0], 1)
+        self.assertEqual(metrics.timings['dmarc.discovery'][0], 1)
+
+    def test_dkim_signatures(self):
+        # An ESP signature on top of the author domain's
+        msg = sign_message(self.message, b"test", b"example.com", self.key, [b"From", b"To", b"Subject"]) + self.message
+        msg = sign_message(msg, b"test", b"esp.example.net", self.key, [b"From", b"To", b"Subject"]) + msg
+        def dnsfunc(domain, timeout=5):
+            if domain == b'test._domainkey.esp.example.net.':
+                time.sleep(0.3)
+                return read_test_data("test.txt")
+            return self.dnsfunc(domain)
+        res = authenticate_message(msg, "example.com", dnsfunc=dnsfunc)
+        self.assertEqual(res, "Authentication-Results: example.com; dkim=pass header.d=esp.example.net header.i=@esp.example.net; dmarc=fail (Used From Domain Record) header.from=example.com policy.dmarc=reject")
+        res = authenticate_message(msg, "example.com", dnsfunc=dnsfunc, dkim_all=True)
+        self.assertEqual(res, "Authentication-Results: example.com; dkim=pass header.d=esp.example.net header.i=@esp.example.net; dkim=pass header.d=example.com header.i=@example.com; dmarc=pass (Used From Domain Record) header.from=example.com policy.dmarc=reject")
+        # For DMARC alone, the aligned pass is enough
+        start = time.time()
+        res = authenticate_message(msg, "example.com", dnsfunc=dnsfunc, dkim=False, dkim_all=True)
+        self.assertLess(time.time() - start, 0.3)
+        self.assertEqual(res, "Authentication-Results: example.com; dmarc=pass (Used From Domain Record) header.from=example.com policy.dmarc=reject")
+        results = authheaders.check_dkim_signatures(msg, dnsfunc=dnsfunc, aligned=lambda passes: True)
+        self.assertEqual([r.header_d for r in results], ['example.com'])
+        self.assertEqual(len(authheaders.check_dkim_signatures(self.message2, dnsfunc=self.dnsfunc)), 1)
+
+    def test_policy_cache_ttl(self):
+        class Answer(list):
+            def __init__(self, txt, ttl):
+                list.__init__(self, ['"%s"' % txt])
+                self.rrset = self
+                self.ttl = ttl
+        def dnsfunc(domain, timeout=5):
+            return {'_dmarc.example.com': Answer('v=DMARC1; p=reject', 60)}.get(domain)
+        cache = authheaders.PolicyCache()
+        now = [0]
+        cache.clock = lambda: now[0]
+        policy = authheaders.discover_policy('example.com', dnsfunc=dnsfunc, policy_cache=cache)
+        self.assertEqual((policy.policy, policy.ttl), ('reject', 60))
+        now[0] = 59
+        self.assertIs(authheaders.discover_policy('example.com', dnsfunc=dnsfunc, policy_cache=cache), policy)
+        now[0] = 61
+        self.assertIsNot(authheaders.discover_policy('example.com', dnsfunc=dnsfunc, policy_cache=cache), policy)
+        # No record, and no TTL to go by: cached for the default
+        self.assertEqual(authheaders.discover_policy('example.org', dnsfunc=dnsfunc, policy_cache=cache).ttl, 300)
+        self.assertEqual(cache.entries[('example.org', False, False)][1], 61 + 300)
+
+    def test_policy_cache_ttl_negative(self):
+        import dns.message
+        import dns.rcode
+        import dns.rrset
+        from unittest import mock
+        class Answer(list):
+            def __init__(self, txt, ttl):
+                list.__init__(self, [txt])
+                self.rrset = self
+                self.ttl = ttl
+        def resolve(name, qtype, **kwargs):
+            if name == '_dmarc.example.com':
+                return Answer('"v=DMARC1; p=reject"', 3600)
+            response = dns.message.make_response(dns.message.make_query(name, qtype))
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            response.authority.append(dns.rrset.from_text('example.com.', 3600, 'IN', 'SOA', 'ns.example.com. host.example.com. 1 2 3 4 60'))
+            raise dns.resolver.NXDOMAIN(qnames=[name], responses={name: response})
+        with mock.patch.object(dnscache.dns.resolver, 'resolve', resolve), \
+             mock.patch.object(psddmarc.get_psd_registry(), 'registry', return_value=frozenset()):
+            # NXDOMAIN in the tree walk: kept for the SOA negative TTL
+            policy = authheaders.discover_policy('a.b.example.com', dmarcbis=True)
+            self.assertEqual((policy.policy, policy.ttl), ('reject', 60))
+            # Answers from a DNSCache: kept for the time they have left
+            cache = dnscache.DNSCache()
+            now = [0]
+            cache.clock = lambda: now[0]
+            cache('_dmarc.example.com')
+            now[0] = 3000
+            self.assertEqual(authheaders.discover_policy('example.com', dnsfunc=cache).ttl, 600)
+            self.assertEqual(cache.remaining_ttl('_dmarc.example.com'), 600)
+
+    def test_authenticate_async(self):
+        import asyncio
+        from authheaders.asyncsupport import authenticate_message_async
+        async def dnsfunc(domain, qtype='TXT', timeout=5):
+            await asyncio.sleep(0)
+            return self.dnsfunc(domain)
+        for msg, kwargs in ((self.message2, {}), (self.message7, {}), (self.message12, {'dmarcbis': True})):
+            expected = authenticate_message(msg, "example.com", dnsfunc=self.dnsfunc, **kwargs)
+            res = asyncio.run(authenticate_message_async(msg, "example.com", dnsfunc=dnsfunc, **kwargs))
+            self.assertEqual(res, expected)
+
+    def test_authenticate_async_lookups(self):
+        import asyncio
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from unittest import mock
+        from authheaders import asyncsupport
+        queries = []
+        async def dnsfunc(domain, qtype='TXT', timeout=5):
+            queries.append(domain)
+            return self.dnsfunc(domain)
+        # The PSD registry is looked up with dnsfunc too
+        psddmarc.get_psd_registry().clear()
+        expected = authenticate_message(self.message12, "example.com", dnsfunc=self.dnsfunc, dmarcbis=True)
+        psddmarc.get_psd_registry().clear()
+        threads = set()
+        def check_dkim(*args, **kwargs):
+            threads.add(threading.current_thread().name)
+            return authheaders.check_dkim(*args, **kwargs)
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix='checks') as executor:
+            with mock.patch.object(asyncsupport, 'check_dkim', check_dkim):
+                res = asyncio.run(asyncsupport.authenticate_message_async(self.message12, "example.com", dnsfunc=dnsfunc, dmarcbis=True, executor=executor))
+        self.assertEqual(res, expected)
+        self.assertIn('gov.psddmarc.org', queries)
+        self.assertTrue(threads and all(name.startswith('checks') for name in threads))
+        # Names still missing after the lookup rounds give temperror
+        prev = 'Authentication-Results: example.com; dkim=fail header.d=sub2.example.biz header.i=@sub2.example.biz'
+        with mock.patch.object(asyncsupport, 'MAX_LOOKUP_ROUNDS', 0):
+            res = asyncio.run(asyncsupport.authenticate_message_async(self.message7, "example.com", prev=prev, dnsfunc=dnsfunc))
+        self.assertEqual(res, "Authentication-Results: example.com; dkim=fail header.d=sub2.example.biz header.i=@sub2.example.biz; dmarc=temperror (DNS names unresolved after 0 lookup rounds) header.from=sub2.example.biz")
+
+    def test_authenticate_async_spf(self):
+        import asyncio
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from unittest import mock
+        from authres import SPFAuthenticationResult
+        from authheaders import asyncsupport
+        async def dnsfunc(domain, qtype='TXT', timeout=5):
+            return self.dnsfunc(domain)
+        # SPF runs alongside the DKIM check rather than before it
+        dkim_checked = threading.Event()
+        waited = []
+        def check_spf(ip, mail_from, helo):
+            waited.append(dkim_checked.wait(5))
+            return SPFAuthenticationResult(result='pass', smtp_mailfrom=mail_from)
+        def check_dkim(*args, **kwargs):
+            dkim_checked.set()
+            return authheaders.check_dkim(*args, **kwargs)
+        expected = authenticate_message(self.message2, "example.com", dnsfunc=self.dnsfunc)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            with mock.patch.dict(sys.modules, {'spf': mock.Mock()}), mock.patch.object(asyncsupport, 'check_spf', check_spf), mock.patch.object(asyncsupport, 'check_dkim', check_dkim):
+                res = asyncio.run(asyncsupport.authenticate_message_async(self.message2, "example.com", spf=True, ip="192.0.2.1", mail_from="test@example.com", dnsfunc=dnsfunc, executor=executor))
+        self.assertEqual(waited, [True])
+        self.assertEqual(res, expected.replace("example.com; ", "example.com; spf=pass smtp.mailfrom=example.com; ", 1))
+
+    def test_authenticate_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        prev = 'Authentication-Results: example.com; dkim=fail header.d=sub2.example.biz header.i=@sub2.example.biz'
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for msg, kwargs in ((self.message2, {}), (self.message3, {}), (self.message7, {'prev': prev}), (self.message10, {}), (self.message12, {'dmarcbis': True})):
+                expected = authenticate_message(msg, "example.com", dnsfunc=self.dnsfunc, **kwargs)
+                res = authenticate_message(msg, "example.com", dnsfunc=self.dnsfunc, executor=executor, **kwargs)
+                self.assertEqual(res, expected)
+
+    def test_authenticate_executor_concurrent(self):
+        from concurrent.futures import ThreadPoolExecutor
+        def dnsfunc(domain, timeout=5):
+            time.sleep(0.1)
+            return self.dnsfunc(domain)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            start = time.time()
+            res = authenticate_message(self.message2, "example.com", dnsfunc=dnsfunc, executor=executor)
+            self.assertLess(time.time() - start, 0.2)
+        self.assertEqual(res, "Authentication-Results: example.com; dkim=pass header.d=example.com header.i=@example.com; dmarc=pass (Used From Domain Record) header.from=example.com policy.dmarc=reject")
+
+    def test_parsed_message(self):
+        from unittest import mock
+        expected = authenticate_message(self.message2, "example.com", arc=True, dnsfunc=self.dnsfunc)
+        with mock.patch.object(message, 'rfc822_parse', wraps=message.rfc822_parse) as parse:
+            res = authenticate_message(self.message2, "example.com", arc=True, dnsfunc=self.dnsfunc)
+        self.assertEqual(res, expected)
+        self.assertEqual(parse.call_count, 1)
+        parsed = message.ParsedMessage(self.message2)
+        self.assertEqual(authenticate_message(parsed, "example.com", arc=True, dnsfunc=self.dnsfunc), expected)
+        self.assertEqual(parsed.from_addresses, ['test@example.com'])
+        self.assertEqual(parsed.body_offset, self.message2.index(b'\n\n') + 2)
+
+    def test_authenticate_batch(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from authheaders.batch import BatchMessage, authenticate_messages
+        prev = 'Authentication-Results: example.com; dkim=fail header.d=sub2.example.biz header.i=@sub2.example.biz'
+        messages = [self.message2, self.message3, BatchMessage(self.message7, prev=prev), self.message10, self.message2, message.ParsedMessage(self.message5)]
+        expected = [authenticate_message(self.message2, "example.com", arc=True, dnsfunc=self.dnsfunc),
+                    authenticate_message(self.message3, "example.com", arc=True, dnsfunc=self.dnsfunc),
+                    authenticate_message(self.message7, "example.com", prev=prev, arc=True, dnsfunc=self.dnsfunc),
+                    authenticate_message(self.message10, "example.com", arc=True, dnsfunc=self.dnsfunc),
+                    authenticate_message(self.message2, "example.com", arc=True, dnsfunc=self.dnsfunc),
+                    authenticate_message(self.message5, "example.com", arc=True, dnsfunc=self.dnsfunc)]
+        queried = []
+        def dnsfunc(domain, qtype='TXT', timeout=5):
+            queried.append((domain, qtype))
+            return self.dnsfunc(domain)
+        res = list(authenticate_messages(messages, "example.com", arc=True, dnsfunc=dnsfunc, batch_size=4))
+        self.assertEqual(res, expected)
+        self.assertEqual(len(queried), len(set(queried)))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            res = list(authenticate_messages(messages, "example.com", arc=True, dnsfunc=self.dnsfunc, executor=executor))
+        self.assertEqual(res, expected)
+        # Streamed messages are read whole for the workers
+        import io
+        streamed = [io.BytesIO(self.message2), iter([self.message3[:50], self.message3[50:]]), message.StreamedMessage(io.BytesIO(self.message10))]
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            res = list(authenticate_messages(streamed, "example.com", arc=True, dnsfunc=self.dnsfunc, executor=executor))
+        self.assertEqual(res, [expected[0], expected[1], expected[3]])
+
+    def test_verifier_pool(self):
+        import multiprocessing
+        from concurrent.futures import TimeoutError
+        from authheaders.pool import VerifierPool
+        messages = [self.message2, self.message3, self.message7, self.message10, message.ParsedMessage(self.message5)]
+        expected = [authenticate_message(msg, "example.com", arc=True, dnsfunc=self.dnsfunc) for msg in messages]
+        fork = multiprocessing.get_context('fork')
+        with VerifierPool(max_workers=2, max_pending=2, dnsfunc=self.dnsfunc, mp_context=fork) as pool:
+            self.assertEqual(list(pool.map(messages, "example.com", arc=True)), expected)
+            self.assertEqual(pool.authenticate(self.message2, "example.com", arc=True), expected[0])
+            # Streamed messages are read whole for the workers
+            import io
+            self.assertEqual(pool.authenticate(io.BytesIO(self.message2), "example.com", arc=True), expected[0])
+            self.assertEqual(list(pool.map((iter([msg]) for msg in messages[:2]), "example.com", arc=True)), expected[:2])
+        def dnsfunc(domain, timeout=5):
+            time.sleep(0.5)
+            return self.dnsfunc(domain)
+        with VerifierPool(max_workers=1, timeout=0.1, dnsfunc=dnsfunc, mp_context=fork) as pool:
+            self.assertRaises(TimeoutError, pool.authenticate, self.message2, "example.com")
+            # A running task stops once the timeout is spent too
+            future = pool.submit(self.message7, "example.com")
+            self.assertRaises(TimeoutError, pool.result, future)
+            self.assertIn("temperror", future.result(5))
+
+    def test_sign_message_signer(self):
+        from unittest import mock
+        from authheaders import signer
+        signer._signers.clear()
+        signer._parse_pem_private_key_cached.cache_clear()
+        with mock.patch.object(signer, 'parse_pem_private_key', wraps=signer.parse_pem_private_key) as parse:
+            for msg in (self.message, self.message5):
+                sig = sign_message(msg, b"test", b"example.com", self.key, [b"From", b"To", b"Subject"])
+                res = authenticate_message(sig + msg, "example.com", dmarc=False, dnsfunc=self.dnsfunc)
+                self.assertEqual(res, "Authentication-Results: example.com; dkim=pass header.d=example.com header.i=@example.com")
+        self.assertEqual(parse.call_count, 1)
+        # dkimpy's own sign() is handed the key parsed for the Signer
+        self.assertEqual(signer._parse_pem_private_key_cached.cache_info().misses, 1)
+        self.assertIs(signer.get_signer(b"test", b"example.com", self.key, [b"from", b"to", b"subject"]),
+                      signer.get_signer(b"test", b"example.com", self.key, [b"From", b"To", b"Subject"]))
+
+    def test_signer_matches_dkimpy(self):
+        import dkim
+        from unittest import mock
+        from authheaders.signer import Signer
+        msg = b"Authentication-Results: example.com; arc=none; dkim=pass header.d=example.com\n" + self.message
+        with mock.patch('time.time', return_value=1500000000):
+            # RFC 8460 reports are signed without l=
+            for tlsrpt in (False, True):
+                expected = dkim.DKIM(msg, tlsrpt=tlsrpt).sign(b"test", b"example.com", self.key, include_headers=[b"from", b"to"], canonicalize=(b"relaxed", b"relaxed"), length=True)
+                res = Signer(b"test", b"example.com", self.key, [b"from", b"to"]).dkim_sign(msg, length=True, tlsrpt=tlsrpt)
+                self.assertEqual(res, expected)
+            self.assertNotIn(b"l=", res)
+            # Signed header lists naming ARC header fields
+            arc_set = dkim.ARC(msg).sign(b"test", b"example.com", self.key, b"example.com", include_headers=[b"from", b"to"])
+            msg = b"Authentication-Results: example.com; arc=pass\n" + b"".join(arc_set) + msg
+            sig_headers = [b"from", b"to", b"arc-seal", b"arc-message-signature", b"arc-authentication-results"]
+            signer = Signer(b"test", b"example.com", self.key, sig_headers)
+            self.assertEqual(signer.arc_sign(msg, b"example.com"),
+                             dkim.ARC(msg).sign(b"test", b"example.com", self.key, b"example.com", include_headers=sig_headers))
+            self.assertEqual(signer.dkim_sign(msg),
+                             dkim.DKIM(msg).sign(b"test", b"example.com", self.key, include_headers=sig_headers, canonicalize=(b"relaxed", b"relaxed")))
+            self.assertRaises(dkim.ParameterError, dkim.ARC(msg).sign, b"test", b"example.com", self.key, b"example.com", include_headers=[b"to"])
+            self.assertRaises(dkim.ParameterError, Signer(b"test", b"example.com", self.key, [b"to"]).arc_sign, msg, b"example.com")
+
+    def test_body_digests_match_dkimpy(self):
+        import dkim
+        # _BodyDigests replaces the body hash step of this method; check it
+        # against the new version when dkimpy changes it
+        source = inspect.getsource(dkim.DomainSigner.verify_sig_process)
+        self.assertEqual(hashlib.sha256(source.encode('utf-8')).hexdigest(),
+                         'ab008897178aa566719f17da464ac72f4e7aac920559a2a78ad382c9613d4820')
+        msg = b"Authentication-Results: example.com; arc=none\n" + self.message
+        dkim_sig = dkim.DKIM(msg).sign(b"test", b"example.com", self.key, include_headers=[b"from", b"to"])
+        arc_set = dkim.ARC(msg).sign(b"test", b"example.com", self.key, b"example.com", include_headers=[b"from", b"to"])
+        length_sig = dkim.DKIM(msg).sign(b"test", b"example.com", self.key, include_headers=[b"from", b"to"], length=True)
+        simple_sig = dkim.DKIM(msg).sign(b"test", b"example.com", self.key, include_headers=[b"from", b"to"], canonicalize=(b"simple", b"simple"))
+
+        def outcome(verify):
+            try:
+                return verify(dnsfunc=self.dnsfunc)
+            except dkim.DKIMException as e:
+                return type(e), str(e)
+
+        for signed in (dkim_sig + msg, dkim_sig + msg + b"tampered\n", length_sig + msg + b"appended\n",
+                       simple_sig + msg, simple_sig + msg + b" \n", b"".join(arc_set) + msg, b"".join(arc_set) + msg + b"tampered\n"):
+            self.assertEqual(outcome(message.parse_message(signed).dkim().verify), outcome(dkim.DKIM(signed).verify))
+            self.assertEqual(outcome(message.parse_message(signed).arc().verify), outcome(dkim.ARC(signed).verify))
+
+    def test_sign_message_dkim_arc(self):
+        from unittest import mock
+        msg = b"Authentication-Results: example.com; arc=none; dkim=pass header.d=example.com\n" + self.message
+        with mock.patch('time.time', return_value=1500000000):
+            dkim_sig = sign_message(msg, b"test", b"example.com", self.key, [b"from", b"to"])
+            arc_set = sign_message(dkim_sig + msg, b"test", b"example.com", self.key, [b"from", b"to"], sig='ARC', srv_id=b"example.com")
+            res = sign_message(msg, b"test", b"example.com", self.key, [b"from", b"to"], sig='DKIM+ARC', srv_id=b"example.com")
+        self.assertEqual(res, arc_set + [dkim_sig])
+        res = authenticate_message(b"".join(res) + msg, "example.com", arc=True, dmarc=False, dnsfunc=self.dnsfunc)
+        self.assertEqual(res, "Authentication-Results: example.com; dkim=pass header.d=example.com header.i=@example.com; arc=pass")
+
+    def test_authenticate_and_seal(self):
+        from unittest import mock
+        with mock.patch('time.time', return_value=1500000000):
+            msg = sign_message(self.message, b"test", b"example.com", self.key, [b"From", b"To", b"Subject"]) + self.message
+        for _ in range(2):
+            with mock.patch('time.time', return_value=1500000000):
+                res, arc_set = authheaders.authenticate_and_seal(msg, "example.com", b"test", b"example.com", self.key, [b"from", b"to"], dnsfunc=self.dnsfunc)
+                expected = authenticate_message(msg, "example.com", arc=True, dnsfunc=self.dnsfunc)
+                self.assertEqual(res, expected)
+                self.assertEqual(arc_set, sign_message(expected.encode() + b"\r\n" + msg, b"test", b"example.com", self.key, [b"from", b"to"], sig='ARC', srv_id=b"example.com"))
+            # The next hop sees a valid chain
+            msg = b"".join(arc_set) + res.encode() + b"\r\n" + msg
+        self.assertEqual(res, "Authentication-Results: example.com; dkim=pass header.d=example.com header.i=@example.com; arc=pass; dmarc=pass (Used From Domain Record) header.from=example.com policy.dmarc=reject")
+
+    def test_dns_budget(self):
+        res = authenticate_message(self.message2, "example.com", dnsfunc=self.dnsfunc, max_dns_queries=1)
+        self.assertEqual(res, "Authentication-Results: example.com; dkim=pass header.d=example.com header.i=@example.com; dmarc=temperror (DNS query budget of 1 spent) header.from=example.com")
+        def dnsfunc(domain, timeout=5):
+            time.sleep(0.2)
+            return self.dnsfunc(domain)
+        start = time.time()
+        res = authenticate_message(self.message2, "example.com", dnsfunc=dnsfunc, timeout=0.1)
+        self.assertLess(time.time() - start, 0.35)
+        self.assertEqual(res, "Authentication-Results: example.com; dkim=pass header.d=example.com header.i=@example.com; dmarc=temperror (deadline passed) header.from=example.com")
+        msg = b"Authentication-Results: example.com; arc=none\n" + self.message
+        msg = b"".join(sign_message(msg, b"test", b"example.com", self.key, [b"from", b"to"], sig='DKIM+ARC', srv_id=b"example.com")) + msg
+        res = authenticate_message(msg, "example.com", arc=True, dnsfunc=self.dnsfunc, max_dns_queries=0)
+        self.assertEqual(res, "Authentication-Results: example.com; dkim=temperror header.d=example.com header.i=@example.com; arc=temperror (DNS query budget of 0 spent); dmarc=temperror (DNS query budget of 0 spent) header.from=example.com")
+
+    def test_dns_budget_cache_hits(self):
+        queries = []
+        def dnsfunc(domain, timeout=5):
+            queries.append(domain)
+            return self.dnsfunc(domain)
+        expected = "Authentication-Results: example.com; dkim=pass header.d=example.com header.i=@example.com; dmarc=pass (Used From Domain Record) header.from=example.com policy.dmarc=reject"
+        cache = dnscache.DNSCache(dnsfunc)
+        self.assertEqual(authenticate_message(self.message2, "example.com", dnsfunc=cache), expected)
+        del queries[:]
+        # Answers from the cache are not charged to the budget, and are
+        # still counted as cache hits
+        metrics = authheaders.MetricsRecorder()
+        res = authenticate_message(self.message2, "example.com", dnsfunc=cache, max_dns_queries=1, metrics=metrics)
+        self.assertEqual(res, expected)
+        self.assertEqual(queries, [])
+        self.assertEqual(metrics.counters['dns.cache.hits'], metrics.counters['dns.queries'])
+        self.assertNotIn('dns.cache.misses', metrics.counters)
+        # Queries that go upstream are
+        res = authenticate_message(self.message3, "example.com", dkim=False, dnsfunc=cache, max_dns_queries=0)
+        self.assertIn("dmarc=temperror (DNS query budget of 0 spent)", res)
+        self.assertEqual(queries, [])
+
+    def test_spf_budget(self):
+        import types
+        from unittest import mock
+        calls = []
+        def check2(ip, mail_from, helo, **kwargs):
+            calls.append(kwargs)
+            return 'pass', 'sender SPF authorized'
+        stub = types.SimpleNamespace(check2=check2)
+        with mock.patch.dict(sys.modules, {'spf': stub}), mock.patch.object(authheaders, 'spf', stub, create=True):
+            kwargs = dict(spf=True, dkim=False, dmarc=False, ip='192.0.2.1', mail_from='user@example.com', helo='mail.example.com', dnsfunc=self.dnsfunc)
+            expected = authenticate_message(self.message2, "example.com", **kwargs)
+            self.assertIn("spf=pass", expected)
+            self.assertEqual(calls, [{}])
+            self.assertEqual(authenticate_message(self.message2, "example.com", timeout=2, **kwargs), expected)
+            self.assertEqual(set(calls[1]), {'timeout', 'querytime'})
+            self.assertEqual(calls[1]['timeout'], calls[1]['querytime'])
+            self.assertTrue(0 < calls[1]['timeout'] <= 2)
+            self.assertEqual(authenticate_message(self.message2, "example.com", max_dns_queries=20, **kwargs), expected)
+            self.assertEqual(calls[2], {})
+            res = authenticate_message(self.message2, "example.com", max_dns_queries=0, **kwargs)
+            self.assertIn("spf=temperror", res)
+            self.assertEqual(len(calls), 3)
+
+    def test_dns_budget_timeout(self):
+        import dkim
+        import dns.exception
+        from authheaders import budget
+        # A resolver given the time left gives up just before the deadline
+        def dnsfunc(domain, timeout=5):
+            if timeout < 5:
+                raise dkim.DnsTimeoutError()
+            return self.dnsfunc(domain)
+        res = authenticate_message(self.message2, "example.com", dmarc=False, dnsfunc=dnsfunc, timeout=1)
+        self.assertEqual(res, "Authentication-Results: example.com; dkim=temperror header.d=example.com header.i=@example.com")
+        wrapped = budget.Budget(timeout=1).wrap(dnsfunc)
+        self.assertRaises(budget.BudgetExceeded, wrapped, b'test._domainkey.example.com.', timeout=5)
+        # A timeout shorter than the time left is the resolver's own
+        def timeout_dnsfunc(domain, timeout=5):
+            raise dns.exception.Timeout()
+        wrapped = budget.Budget(timeout=60).wrap(timeout_dnsfunc)
+        self.assertRaises(dns.exception.Timeout, wrapped, b'test._domainkey.example.com.', timeout=5)
+
+    def test_key_cache(self):
+        from unittest import mock
+        from authheaders import keycache
+        msg = b"Authentication-Results: example.com; arc=none; dkim=pass header.d=example.com\n" + self.message
+        msg = b"".join(sign_message(msg, b"test", b"example.com", self.key, [b"from", b"to"], sig='DKIM+ARC', srv_id=b"example.com")) + msg
+        queries = []
+        def dnsfunc(domain, timeout=5):
+            queries.append(domain)
+            return self.dnsfunc(domain)
+        cache = authheaders.KeyCache()
+        now = [0]
+        cache.clock = lambda: now[0]
+        expected = "Authentication-Results: example.com; dkim=pass header.d=example.com header.i=@example.com; arc=pass"
+        with mock.patch.object(keycache, 'evaluate_pk', wraps=keycache.evaluate_pk) as evaluate:
+            for _ in range(2):
+                res = authenticate_message(msg, "example.com", arc=True, dmarc=False, dnsfunc=dnsfunc, key_cache=cache)
+                self.assertEqual(res, expected)
+            # One lookup and parse for the DKIM-Signature, AMS and AS
+            self.assertEqual(queries, [b'test._domainkey.example.com.'])
+            self.assertEqual(evaluate.call_count, 1)
+            now[0] = cache.default_ttl + 1
+            self.assertEqual(authenticate_message(msg, "example.com", arc=True, dmarc=False, dnsfunc=dnsfunc, key_cache=cache), expected)
+            self.assertEqual(evaluate.call_count, 2)
+        self.assertEqual(cache.load(b"TEST", b"Example.com", dnsfunc).tags[b'k'], b'rsa')
+        # Missing keys are cached too
+        cache.negative_ttl = 60
+        no_key = lambda domain, timeout=5: queries.append(domain)
+        self.assertRaises(keycache.KeyFormatError, cache.load, b"none", b"example.com", no_key)
+        self.assertRaises(keycache.KeyFormatError, cache.load, b"none", b"example.com", no_key)
+        self.assertEqual(queries.count(b'none._domainkey.example.com.'), 1)
+        self.assertEqual(cache.entries[(b"none", b"example.com")][1], now[0] + 60)
+
+    def test_arc_cache(self):
+        from authheaders import arccache
+        queries = []
+        def dnsfunc(domain, timeout=5):
+            queries.append(domain)
+            return read_test_data("test.txt")
+        def add_hop(msg, i):
+            srv_id = 'hop{0}.example.net'.format(i).encode()
+            msg = b"Authentication-Results: " + srv_id + (b"; arc=pass\r\n" if i > 1 else b"; arc=none\r\n") + msg
+            return b"".join(sign_message(msg, b"s" + str(i).encode(), srv_id, self.key, [b"from", b"to", b"subject"], sig='ARC', srv_id=srv_id)) + msg
+        msg = self.message
+        for i in range(1, 4):
+            msg = add_hop(msg, i)
+        cache = authheaders.ARCCache()
+        expected = authenticate_message(msg, "example.com", dkim=False, dmarc=False, arc=True, dnsfunc=dnsfunc)
+        self.assertEqual(expected, "Authentication-Results: example.com; arc=pass")
+        self.assertEqual(authenticate_message(msg, "example.com", dkim=False, dmarc=False, arc=True, dnsfunc=dnsfunc, arc_cache=cache), expected)
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 2, 'entries': 3, 'hit_rate': 0.0})
+        # A hop later, only the new set is verified
+        msg = add_hop(msg, 4)
+        del queries[:]
+        self.assertEqual(authenticate_message(msg, "example.com", dkim=False, dmarc=False, arc=True, dnsfunc=dnsfunc, arc_cache=cache), expected)
+        self.assertEqual(queries, [b's4._domainkey.hop4.example.net.'] * 2)
+        self.assertEqual(cache.stats()['hits'], 3)
+        # The most recent AMS is still checked against the message
+        self.assertEqual(authenticate_message(msg + b"tampered", "example.com", dkim=False, dmarc=False, arc=True, dnsfunc=dnsfunc, arc_cache=cache),
+                         authenticate_message(msg + b"tampered", "example.com", dkim=False, dmarc=False, arc=True, dnsfunc=dnsfunc))
+        # Outcomes can be kept in a store, e.g. across processes
+        store = {}
+        authenticate_message(msg, "example.com", dkim=False, dmarc=False, arc=True, dnsfunc=dnsfunc, arc_cache=arccache.ARCCache(store=store))
+        del queries[:]
+        self.assertEqual(authenticate_message(msg, "example.com", dkim=False, dmarc=False, arc=True, dnsfunc=dnsfunc, arc_cache=arccache.ARCCache(store=store)), expected)
+        self.assertEqual(len(queries), 2)
+        # With TTLCache's get and put
+        cache = arccache.ARCCache(store=store)
+        key = next(iter(store))
+        self.assertEqual(cache.get(key), (True, store[key]))
+        self.assertEqual(cache.get('missing'), (False, None))
+        cache.put('new', {'as-valid': True})
+        self.assertEqual(store['new'], {'as-valid': True})
+
+    def test_streamed_message(self):
+        import io
+        import mmap
+        from concurrent.futures import ThreadPoolExecutor
+        from unittest import mock
+        with mock.patch('time.time', return_value=1500000000):
+            sig = sign_message(self.message, b"test", b"example.com", self.key, [b"from", b"to"])
+            self.assertEqual(sign_message(io.BytesIO(self.message), b"test", b"example.com", self.key, [b"from", b"to"]), sig)
+        msg = sig + self.message
+        expected = authenticate_message(msg, "example.com", dnsfunc=self.dnsfunc)
+        self.assertEqual(authenticate_message(io.BytesIO(msg), "example.com", dnsfunc=self.dnsfunc), expected)
+        self.assertEqual(authenticate_message((msg[i:i + 7] for i in range(0, len(msg), 7)), "example.com", dnsfunc=self.dnsfunc), expected)
+        with tempfile.TemporaryFile() as f:
+            f.write(msg + b"tampered")
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                self.assertEqual(authenticate_message(mm, "example.com", dnsfunc=self.dnsfunc), authenticate_message(msg + b"tampered", "example.com", dnsfunc=self.dnsfunc))
+        # DKIM and ARC checked in parallel share the one stream
+        arc_msg = b"Authentication-Results: example.com; arc=none\n" + self.message
+        arc_msg = b"".join(sign_message(arc_msg, b"test", b"example.com", self.key, [b"from", b"to"], sig='DKIM+ARC', srv_id=b"example.com")) + arc_msg
+        expected = authenticate_message(arc_msg, "example.com", arc=True, dnsfunc=self.dnsfunc)
+        self.assertIn("dkim=pass", expected)
+        self.assertIn("arc=pass", expected)
+        class SlowReader(io.BytesIO):
+            def read(self, size=-1):
+                time.sleep(0.001)
+                return super(SlowReader, self).read(size)
+        def chunks():
+            for i in range(0, len(arc_msg), 16):
+                time.sleep(0.001)
+                yield arc_msg[i:i + 16]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for _ in range(3):
+                self.assertEqual(authenticate_message(message.StreamedMessage(SlowReader(arc_msg), chunk_size=16), "example.com", arc=True, dnsfunc=self.dnsfunc, executor=executor), expected)
+                self.assertEqual(authenticate_message(chunks(), "example.com", arc=True, dnsfunc=self.dnsfunc, executor=executor), expected)
+        # A body hash the signatures don't call for needs the body again
+        streamed = message.StreamedMessage(iter([msg]))
+        authenticate_message(streamed, "example.com", dnsfunc=self.dnsfunc)
+        self.assertRaises(ValueError, sign_message, streamed, b"test", b"example.com", self.key, [b"from"], canonicalize=(b"simple", b"simple"))
+
     def test_get_domain_part(self):
         froms_to_test = [['test@example.com', 'example.com'], [""""Test, User" <test@example.com>""", 'example.com'], ["""Test User <test@sub2.example.biz>""", 'sub2.example.biz'], ["""=?UTF-8?B?QmVkIEJhdGggJiBCZXlvbmQ=?=<BdBth&Byond@example.com>""", 'example.com'], ]
         for body_from in froms_to_test:
@@ -212,6 +885,16 @@ This is a test message.
         res = authenticate_message(msg, "example.com", prev=prev, arc=True, dkim=False, spf=False, dmarc=False, dnsfunc=self.dnsfuncb)
         self.assertEqual(res, "Authentication-Results: example.com; spf=pass smtp.mailfrom=gmail.com; arc=pass")
 
+        import asyncio
+        from authheaders.asyncsupport import authenticate_message_async
+        async def dnsfunc(domain, timeout=5):
+            return self.dnsfuncb(domain)
+        res = asyncio.run(authenticate_message_async(msg, "example.com", prev=prev, arc=True, dkim=False, spf=False, dmarc=False, dnsfunc=dnsfunc))
+        self.assertEqual(res, "Authentication-Results: example.com; spf=pass smtp.mailfrom=gmail.com; arc=pass")
+
+        res = authenticate_message((msg[i:i + 5] for i in range(0, len(msg), 5)), "example.com", prev=prev, arc=True, dkim=False, spf=False, dmarc=False, dnsfunc=self.dnsfuncb)
+        self.assertEqual(res, "Authentication-Results: example.com; spf=pass smtp.mailfrom=gmail.com; arc=pass")
+
 
     def test_chain_validation_fail(self):
         msg = b"""MIME-Version: 1.0
@@ -293,6 +976,7 @@ uEzxBDAr518Z8VFbR41in3W4Y3yCDgQlLlcETrS+zYcL
 """
 
         res = sign_message(msg, b"dummy", b"example.org", privkey, b"mime-version:date:from:to:subject".split(b':'), sig='ARC', srv_id=b"lists.example.org", timestamp="12345", standardize=True)
+        self.assertEqual(res, sign_message(message.ParsedMessage(msg), b"dummy", b"example.org", privkey, b"mime-version:date:from:to:subject".split(b':'), sig='ARC', srv_id=b"lists.example.org", timestamp="12345", standardize=True))
 
         headers = [b'ARC-Seal: a=rsa-sha256; b=Pg8Yyk1AgYy2l+kb6iy+mY106AXm5EdgDwJhLP7+XyT6yaS38ZUho+bmgSDorV+LyARH4A 967A/oWMX3coyC7pAGyI+hA3+JifL7P3/aIVP4ooRJ/WUgT79snPuulxE15jg6FgQE68ObA1 /hy77BxdbD9EQxFGNcr/wCKQoeKJ8=; cv=none; d=example.org; i=1; s=dummy; t=12345', b'ARC-Message-Signature: a=rsa-sha256; b=XWeK9DxQ8MUm+Me5GLZ5lQ3L49RdoFv7m7VlrAkKb3/C7jjw33TrTY0KYI5lkowvEGnAtm 5lAqLz67FxA/VrJc2JiYFQR/mBoJLLz/hh9y77byYmSO9tLfIDe2A83+6QsXHO3K6PxTz7+v rCB4wHD9GADeUKVfHzmpZhFuYOa88=; bh=KWSe46TZKCcDbH4klJPo+tjk5LWJnVRlP5pvjXFZYLQ=; c=relaxed/relaxed; d=example.org; h=mime-version:date:from:to:subject; i=1; s=dummy; t=12345', b'ARC-Authentication-Results: i=1; lists.example.org; arc=none; spf=pass smtp.mfrom=jqd@d1.example; dkim=pass (1024-bit key) header.i=@d1.example; dmarc=pass']
         headers2 = [b'ARC-Seal: a=rsa-sha256; b=OI+GmgigM5/fJ8u+yoYCoT70Xa433kSYLvhZWtx4HdLnLB2wvKy9zX7KHFVOhfhZ6gWtsfMAufWx0rw+xgZNseDnejbz++2pPfj+jKUg+JF7VC15IbpPUloISLKjfiK1cxC+u7s9NLu1wI4QVsAT/M6RQ42MauUR/dBSdQdSMho=; cv=none; d=example.org; i=1; s=dummy; t=12345', b'ARC-Message-Signature: a=rsa-sha256; b=XWeK9DxQ8MUm+Me5GLZ5lQ3L49RdoFv7m7VlrAkKb3/C7jjw33TrTY0KYI5lkowvEGnAtm 5lAqLz67FxA/VrJc2JiYFQR/mBoJLLz/hh9y77byYmSO9tLfIDe2A83+6QsXHO3K6PxTz7+v rCB4wHD9GADeUKVfHzmpZhFuYOa88=; bh=KWSe46TZKCcDbH4klJPo+tjk5LWJnVRlP5pvjXFZYLQ=; c=relaxed/relaxed; d=example.org; h=mime-version:date:from:to:subject; i=1; s=dummy; t=12345', b'ARC-Authentication-Results: i=1; lists.example.org; arc=none; spf=pass smtp.mfrom=jqd@d1.example; dkim=pass header.i=@d1.example; dmarc=pass']
@@ -303,6 +987,227 @@ uEzxBDAr518Z8VFbR41in3W4Y3yCDgQlLlcETrS+zYcL
         # headers is dkimpy =< 1.1.6 and headers2 is >= 1.1.7
         self.assertTrue(res == headers or res == headers2)
 
+class TestSuffixIndex(unittest.TestCase):
+    def test_matches_publicsuffix2(self):
+        from publicsuffix2 import PublicSuffixList
+        with open(os.path.join(os.path.dirname(psl.__file__), 'public_suffix_list.txt')) as suffix_list:
+            reference = PublicSuffixList(suffix_list)
+        domains = ['example.com', 'sub.example.com', 'a.b.example.co.uk', 'co.uk', 'com',
+                   'foo.local', 'local', 'www.ck', 'x.y.ck', 'EXAMPLE.GOV', 'example.com.']
+        for domain in domains:
+            self.assertEqual(dmarc_lookup.get_org_domain(domain), reference.get_public_suffix(domain), domain)
+
+    def test_index_is_shared(self):
+        self.assertIs(psl.get_suffix_index(), psl.get_suffix_index())
+
+    def test_reload(self):
+        before = psl.get_suffix_index()
+        after = psl.reload_suffix_index()
+        self.assertIsNot(before, after)
+        self.assertIs(psl.get_suffix_index(), after)
+        self.assertEqual(dmarc_lookup.get_org_domain('mail.example.co.uk'), 'example.co.uk')
+
+    def test_snapshot(self):
+        location = os.path.join(os.path.dirname(psl.__file__), 'public_suffix_list.txt')
+        with open(location, 'rb') as suffix_list:
+            digest = hashlib.sha256(suffix_list.read()).digest()
+        index = psl.SuffixIndex.from_file(location)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'psl.bin')
+            psl.write_snapshot(index, path, digest)
+            snapshot = psl.SuffixSnapshot.from_file(path, digest)
+            self.assertEqual(len(snapshot.rules), len(index.rules))
+            domains = ['example.com', 'sub.example.com', 'a.b.example.co.uk', 'co.uk', 'com',
+                       'foo.local', 'local', 'www.ck', 'x.y.ck', 'EXAMPLE.GOV', 'example.com.',
+                       'a.b.kawasaki.jp', 'city.kawasaki.jp', 'x.city.kawasaki.jp']
+            for domain in domains:
+                self.assertEqual(snapshot.get_org_domain(domain), index.get_org_domain(domain), domain)
+                self.assertEqual(snapshot.get_tld(domain, strict=True), index.get_tld(domain, strict=True), domain)
+            self.assertRaises(ValueError, psl.SuffixSnapshot.from_file, path, hashlib.sha256(b'other').digest())
+            snapshot.buf.close()
+
+    def test_snapshot_cache_dir(self):
+        from unittest import mock
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.dict(os.environ):
+            os.environ.pop('AUTHHEADERS_CACHE_DIR', None)
+            with mock.patch.object(psl, 'write_snapshot', side_effect=AssertionError):
+                self.assertIsNone(psl.snapshot_dir())
+                self.assertIsInstance(psl._load_suffix_index(), psl.SuffixIndex)
+            # A snapshot that can't be written leaves the index in memory
+            os.environ['AUTHHEADERS_CACHE_DIR'] = os.path.join(tmp, 'dir')
+            with mock.patch.object(psl, 'write_snapshot', side_effect=OSError):
+                index = psl._load_suffix_index()
+            self.assertEqual(index.get_org_domain('mail.example.co.uk'), 'example.co.uk')
+            open(os.path.join(tmp, 'file'), 'w').close()
+            os.environ['AUTHHEADERS_CACHE_DIR'] = os.path.join(tmp, 'file')
+            self.assertIsInstance(psl._load_suffix_index(), psl.SuffixIndex)
+            os.environ['AUTHHEADERS_CACHE_DIR'] = tmp
+            self.assertIsInstance(psl._load_suffix_index(), psl.SuffixIndex)
+            snapshot = psl._load_suffix_index()
+            self.assertIsInstance(snapshot, psl.SuffixSnapshot)
+            self.assertEqual(snapshot.get_org_domain('mail.example.co.uk'), 'example.co.uk')
+            snapshot.buf.close()
+
+    def test_org_domain_cache(self):
+        cache = psl.OrgDomainCache(max_entries=2)
+        self.assertEqual(cache.get_org_domain('mail.example.co.uk'), 'example.co.uk')
+        self.assertEqual(cache.get_org_domain('mail.example.co.uk'), 'example.co.uk')
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'entries': 1, 'hit_rate': 0.5})
+        cache.get_org_domain('a.example.com')
+        cache.get_org_domain('b.example.com')
+        self.assertEqual(cache.stats()['entries'], 2)
+        self.assertNotIn('mail.example.co.uk', cache.entries)
+
+        shared = psl.get_org_domain_cache()
+        dmarc_lookup.get_org_domain('sub.example.gov')
+        self.assertIn('sub.example.gov', shared.entries)
+        psl.reload_suffix_index()
+        self.assertNotIn('sub.example.gov', shared.entries)
+        self.assertEqual(dmarc_lookup.get_org_domain('sub.example.gov'), 'example.gov')
+
+class TestPSDRegistry(unittest.TestCase):
+    def setUp(self):
+        self.queries = []
+
+    def dnsfunc(self, domain):
+        self.queries.append(domain)
+        return "127.0.0.2" if domain == "gov.psddmarc.org" else None
+
+    def write_registry(self, path, lines):
+        with open(path, 'w') as f:
+            f.write(''.join(lines))
+
+    def test_local_registry_reload(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'psddmarc.csv')
+            self.write_registry(path, ['.gov,current,x\n', '.example,withdrawn,x\n'])
+            registry = psddmarc.PSDRegistry(location=path, check_interval=0)
+            self.assertTrue(registry.check('gov', dnsfunc=self.dnsfunc))
+            self.assertFalse(registry.check('example', dnsfunc=self.dnsfunc))
+            self.write_registry(path, ['.example,current,x\n'])
+            os.utime(path, (0, 12345))
+            self.assertFalse(registry.check('gov', dnsfunc=self.dnsfunc))
+            self.assertTrue(registry.check('example', dnsfunc=self.dnsfunc))
+        self.assertEqual(self.queries, [])
+
+    def test_dns_fallback_cached(self):
+        from unittest import mock
+        from authheaders import budget
+        def query(domain, timeout=None):
+            return self.dnsfunc(domain)
+        registry = psddmarc.PSDRegistry(location='/nonexistent/psddmarc.csv', check_interval=0)
+        with mock.patch.object(psddmarc, 'dns_query', query):
+            self.assertTrue(registry.check('gov', dnsfunc=query))
+            self.assertTrue(registry.check('gov', dnsfunc=None))
+            self.assertFalse(registry.check('com', dnsfunc=query))
+            self.assertFalse(registry.check('com', dnsfunc=query))
+            # The default resolver behind the package's wrappers
+            self.assertTrue(registry.check('gov', dnsfunc=budget.Budget().wrap(None)))
+            self.assertTrue(registry.check('gov', dnsfunc=dnscache.DNSCache()))
+        self.assertEqual(self.queries, ['gov.psddmarc.org', 'com.psddmarc.org'])
+
+    def test_dns_fallback_injected(self):
+        from authheaders.asyncsupport import PrefetchedLookup
+        registry = psddmarc.PSDRegistry(location='/nonexistent/psddmarc.csv', check_interval=0)
+        # Answers of a dnsfunc the caller passes are neither remembered nor
+        # given to another dnsfunc
+        lookup = PrefetchedLookup({})
+        self.assertFalse(registry.check('gov', dnsfunc=lookup))
+        self.assertEqual(lookup.misses, {('gov.psddmarc.org', 'TXT')})
+        for _ in range(2):
+            self.assertTrue(registry.check('gov', dnsfunc=self.dnsfunc))
+        self.assertFalse(registry.check('gov', dnsfunc=lambda domain: None))
+        self.assertEqual(self.queries, ['gov.psddmarc.org', 'gov.psddmarc.org'])
+        self.assertEqual(list(registry.dns_cache.entries), [])
+
+    def test_dns_fallback_expires(self):
+        from unittest import mock
+        def query(domain, timeout=None):
+            return self.dnsfunc(domain)
+        registry = psddmarc.PSDRegistry(location='/nonexistent/psddmarc.csv', dns_ttl=0)
+        with mock.patch.object(psddmarc, 'dns_query', query):
+            registry.check('gov', dnsfunc=None)
+            registry.check('gov', dnsfunc=None)
+        self.assertEqual(self.queries, ['gov.psddmarc.org', 'gov.psddmarc.org'])
+
+class TestDNSCache(unittest.TestCase):
+    def setUp(self):
+        self.queries = []
+        self.now = 1000.0
+
+    def dnsfunc(self, domain, timeout=5):
+        self.queries.append(domain)
+        return None if domain.startswith('nx') else 'v=DMARC1; p=none'
+
+    def make_cache(self, **kwargs):
+        cache = dnscache.DNSCache(self.dnsfunc, **kwargs)
+        cache.clock = lambda: self.now
+        return cache
+
+    def test_ttl(self):
+        cache = self.make_cache(default_ttl=60)
+        cache('_dmarc.example.com')
+        cache(b'_dmarc.example.com.')
+        self.now += 61
+        cache('_dmarc.example.com')
+        self.assertEqual(self.queries, ['_dmarc.example.com', '_dmarc.example.com'])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'entries': 1, 'hit_rate': 1 / 3})
+
+    def test_negative(self):
+        cache = self.make_cache(negative_ttl=10)
+        self.assertIsNone(cache('nx.example.com'))
+        self.assertIsNone(cache('nx.example.com'))
+        self.now += 11
+        cache('nx.example.com')
+        self.assertEqual(len(self.queries), 2)
+
+    def test_lru(self):
+        cache = self.make_cache(max_entries=2)
+        cache('a.example')
+        cache('b.example')
+        cache('a.example')
+        cache('c.example')
+        cache('a.example')
+        cache('b.example')
+        self.assertEqual(self.queries, ['a.example', 'b.example', 'c.example', 'b.example'])
+
+    def test_ttl_cache(self):
+        cache = dnscache.TTLCache(max_entries=2, max_ttl=100)
+        cache.clock = lambda: self.now
+        cache.put('a', 1)
+        cache.put('b', 2, 1000)
+        cache.put('c', 3, 0)
+        self.assertEqual(cache.get('c'), (False, None))
+        self.assertEqual(cache.time_left('b'), 100)
+        self.now += 101
+        self.assertEqual(cache.get('a'), (True, 1))
+        self.assertEqual(cache.get('b'), (False, None))
+        cache.put('b', 2)
+        cache.put('c', 3)
+        self.assertNotIn('a', cache.entries)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2, 'entries': 2, 'hit_rate': 1 / 3})
+
+    def test_soa_negative_ttl(self):
+        import dns.message, dns.rrset
+        response = dns.message.make_response(dns.message.make_query('_dmarc.nx.example', 'TXT'))
+        self.assertEqual(dnscache.negative_ttl(response, 300), 300)
+        response.authority.append(dns.rrset.from_text('example.', 3600, 'IN', 'SOA', 'ns. host. 1 7200 3600 1209600 600'))
+        self.assertEqual(dnscache.negative_ttl(response, 300), 600)
+
+class TestBenchmark(unittest.TestCase):
+    def test_run(self):
+        import importlib.util
+        spec = importlib.util.spec_from_file_location('benchmark', os.path.join(os.path.dirname(__file__), 'benchmark.py'))
+        benchmark = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(benchmark)
+        corpus = benchmark.Corpus(4, sizes=(512,), signatures=(1,), arc_hops=(1,))
+        results = benchmark.run(corpus, memory=False)
+        self.assertEqual([r['scenario'] for r in results], benchmark.SCENARIOS)
+        for r in results:
+            self.assertGreater(r['msgs_per_sec'], 0)
+            self.assertLessEqual(r['p50_ms'], r['p99_ms'])
+        self.assertIsNone(psddmarc.get_psd_registry().location)
+
 def _test():
     return doctest.testmod(dmarc_lookup)
 
@@ -1,8 +1,11 @@
 from setuptools import setup
+from setuptools.command.build_py import build_py
 import distutils.cmd
 import distutils.log
 import setuptools
 import tempfile
+import hashlib
+import importlib.util
 import os
 import sys
 from urllib import request
@@ -42,7 +45,8 @@ class UpdatePublicSuffixList(distutils.cmd.Command):
         pass
 
     def run(self):
-        """Download to tempfile and move to authheaders/public_suffix_list.txt."""
+        """Download to tempfile and move to authheaders/public_suffix_list.txt,
+        then compile it to authheaders/public_suffix_list.bin."""
         tmpfile = tempfile.mkstemp(".tmp", dir="./authheaders")[1]
         url = 'https://publicsuffix.org/list/effective_tld_names.dat'
         self.announce(
@@ -50,6 +54,31 @@ class UpdatePublicSuffixList(distutils.cmd.Command):
             level=distutils.log.INFO)
         request.urlretrieve(url, tmpfile)
         os.rename(tmpfile, 'authheaders/public_suffix_list.txt')
+        compile_psl_snapshot(self)
+
+def compile_psl_snapshot(command):
+    """Compile authheaders/public_suffix_list.txt to
+    authheaders/public_suffix_list.bin."""
+    # Load psl.py on its own, since the package's dependencies may not
+    # be installed yet
+    spec = importlib.util.spec_from_file_location('psl', 'authheaders/psl.py')
+    psl = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(psl)
+    with open('authheaders/public_suffix_list.txt', 'rb') as f:
+        digest = hashlib.sha256(f.read()).digest()
+    command.announce(
+        'Compiling PSL snapshot',
+        level=distutils.log.INFO)
+    psl.write_snapshot(psl.SuffixIndex.from_file('authheaders/public_suffix_list.txt'),
+                       'authheaders/public_suffix_list.bin', digest)
+
+class BuildPy(build_py):
+    """build_py, compiling the PSL snapshot shipped with the package first."""
+
+    def run(self):
+        if 'public_suffix_list.bin' in data.get('authheaders', []):
+            compile_psl_snapshot(self)
+        build_py.run(self)
 
 class SetPSLLocation(distutils.cmd.Command):
     description = "Set location of system copy of PSL to use instead of embedded copy."
@@ -70,7 +99,7 @@ class SetPSLLocation(distutils.cmd.Command):
 
 
 data = {
-    'authheaders': ['public_suffix_list.txt'],
+    'authheaders': ['public_suffix_list.txt', 'public_suffix_list.bin'],
 }
 try:
     if os.path.getmtime('authheaders/findpsl.py') >= os.path.getmtime('setup.py'):
@@ -82,12 +111,12 @@ try:
         if data == {}:
             data = {'authheaders': ['psddmarc.csv'],}
         else:
-            data = {'authheaders': ['public_suffix_list.txt','psddmarc.csv'],}
+            data = {'authheaders': ['public_suffix_list.txt','public_suffix_list.bin','psddmarc.csv'],}
 except FileNotFoundError:
     pass
 
 requires=[
-    "dkimpy>=0.7.1",
+    "dkimpy==1.1.8",
     "authres>=1.2.0",
     "publicsuffix2",
     "dnspython"
@@ -129,6 +158,7 @@ setup(
     package_data=data,
     install_requires=requires,
     cmdclass={
+        'build_py': BuildPy,
         'psllocal': SetPSLLocation,
         'pslupdate': UpdatePublicSuffixList,
         'psddmarc': UpdatePSDDMARCList